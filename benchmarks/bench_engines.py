@@ -0,0 +1,68 @@
+"""
+Benchmarks the execution engines on a loop-heavy program.
+Usage: python3 benchmarks/bench_engines.py [iterations]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cpu import CPU
+from parser import Parser
+from translator import BlockTranslator
+from jit import JIT
+from program import CompactProgram
+from fusion import fuse
+
+LOOP_PROGRAM = """
+main:
+  li t0, 0
+  li t1, {iterations}
+  addi sp, sp, -16
+loop:
+  addi t0, t0, 1
+  sw t0, 0(sp)
+  lw t2, 0(sp)
+  add t3, t2, t0
+  bne t0, t1, loop
+  addi sp, sp, 16
+"""
+
+def run_interpreter(cpu, program):
+  return cpu.run(program)
+
+def run_fused(cpu, program):
+  return cpu.run(fuse(program))
+
+def run_block(cpu, program):
+  return BlockTranslator(program).run(cpu)
+
+def run_jit(cpu, program):
+  return JIT(program).run(cpu)
+
+def run_compact(cpu, program):
+  return CompactProgram(program).run(cpu)
+
+ENGINES = [("interp", run_interpreter), ("fused", run_fused), ("compact", run_compact),
+           ("block", run_block), ("jit", run_jit)]
+
+def main():
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  parse_result = Parser().parse_program(LOOP_PROGRAM.format(iterations=iterations))
+  program = parse_result['instructions']
+
+  baseline = None
+  for name, engine in ENGINES:
+    cpu = CPU()
+    cpu.reset(start_pc=parse_result['start_addr'])
+    start = time.perf_counter()
+    result = engine(cpu, program)
+    elapsed = time.perf_counter() - start
+    baseline = baseline or elapsed
+    print(f"{name:>8}: {result.steps} instructions in {elapsed:.3f}s "
+          f"({result.steps / elapsed / 1e6:.2f} MIPS, {baseline / elapsed:.1f}x)")
+
+if __name__ == '__main__':
+  main()
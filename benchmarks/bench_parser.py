@@ -0,0 +1,53 @@
+"""
+Benchmarks Parser.parse_program throughput on generated programs.
+Usage: python3 benchmarks/bench_parser.py [max_lines] [workers]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parser import Parser
+
+# A representative mix of base instructions, pseudos, labels, branches,
+# memory accesses and meta-syntax, repeated with unique labels.
+CHUNK = """\
+loop{n}:
+  addi t0, t0, 1
+  li t1, 100000
+  add t2, t0, t1
+  sw t2, -4(sp)
+  lw t3, -4(sp)
+  slli t4, t3, 2
+  beq t0, t1, done{n}
+  la a0, table
+  @assert ne(t0, 0)
+done{n}: xor a1, a1, a2  # comment
+"""
+CHUNK_LINES = CHUNK.count("\n")
+
+def generate(lines):
+  # Program of at least the requested number of lines.
+  body = "".join(CHUNK.format(n=n) for n in range(-(-lines // CHUNK_LINES)))
+  return ".data\ntable: .word 1, 2, 3, 4\n.text\nmain:\n" + body
+
+def main():
+  max_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+  lines = 1000
+  while lines <= max_lines:
+    source = generate(lines)
+    count = source.count("\n")
+    parser = Parser(workers=workers)
+    # Large programs need room for more than 4096 instructions.
+    parser.data_base = 1 << 30
+    start = time.perf_counter()
+    parser.parse_program(source)
+    elapsed = time.perf_counter() - start
+    print(f"{count:>9} lines in {elapsed:.3f}s ({count / elapsed:,.0f} lines/sec)")
+    lines *= 10
+
+if __name__ == '__main__':
+  main()
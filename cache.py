@@ -0,0 +1,174 @@
+"""
+This module provides a persistent on-disk cache of parse results.
+Entries are keyed by a hash of the assembly source together with the
+emulator version, the modules that build a parse result and the parser's
+mode, so a changed program, a changed emulator or a different kind of
+parse never reuses a stale entry.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+
+import expressions
+import instructions
+import parser
+import program
+from parser import Parser, DataView
+from version import __version__
+
+# Bumped whenever the layout of a cache entry changes.
+CACHE_FORMAT = 2
+SUFFIX = ".parse"
+
+def default_directory():
+  # $XDG_CACHE_HOME/vm-rv32, falling back to ~/.cache/vm-rv32.
+  base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+  return os.path.join(base, "vm-rv32")
+
+def _fingerprint():
+  # Hash of the modules whose objects end up in a cache entry.
+  digest = hashlib.sha256(f"{__version__}\0{CACHE_FORMAT}\0".encode())
+  for module in (parser, program, instructions, expressions):
+    with open(module.__file__, "rb") as f:
+      digest.update(f.read())
+  return digest.digest()
+
+def _mode(asm_parser):
+  # The parser options that change what parse_program returns.
+  asm_parser = asm_parser or Parser()
+  return f"workers={asm_parser.workers}\0lazy={asm_parser.lazy}\0".encode()
+
+class ParseCache:
+  """
+  Stores parse results as pickled files named by the hash of their source.
+  The cache is evicted by age first and then, oldest first, down to a size
+  budget. I/O errors and unpicklable results are never fatal: they just
+  turn into cache misses.
+  """
+
+  def __init__(self, directory=None, max_bytes=64 << 20, max_age=30 * 86400):
+    self.directory = directory or default_directory()
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    self.hits = 0
+    self.misses = 0
+    self._salt = None
+
+  def key(self, source, asm_parser=None):
+    # Hex digest identifying source parsed by asm_parser under the current
+    # emulator.
+    if self._salt is None:
+      self._salt = _fingerprint()
+    return hashlib.sha256(self._salt + _mode(asm_parser) + source.encode()).hexdigest()
+
+  def _path(self, key):
+    # File holding the entry for key.
+    return os.path.join(self.directory, key + SUFFIX)
+
+  def load(self, source, asm_parser=None):
+    # Returns the cached parse result for source, or None on a miss.
+    path = self._path(self.key(source, asm_parser))
+    try:
+      with open(path, "rb") as f:
+        entry = pickle.load(f)
+      os.utime(path)
+    except FileNotFoundError:
+      self.misses += 1
+      return None
+    except Exception:
+      # Unreadable or truncated entry; drop it and parse again.
+      self._remove(path)
+      self.misses += 1
+      return None
+    self.hits += 1
+    return {
+      'instructions': entry['instructions'],
+      'segments': entry['segments'],
+      'data': DataView(entry['segments']),
+      'labels': entry['labels'],
+      'hooks': entry['hooks'],
+      'fallthrough_hooks': entry['fallthrough_hooks'],
+      'start_addr': entry['start_addr'],
+    }
+
+  def store(self, source, result, asm_parser=None):
+    # Writes the parse result for source, then evicts old entries.
+    entry = {
+      'instructions': result['instructions'],
+      'segments': result['segments'],
+      'labels': result['labels'],
+      'hooks': result['hooks'],
+      'fallthrough_hooks': result['fallthrough_hooks'],
+      'start_addr': result['start_addr'],
+    }
+    tmp = None
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+      with os.fdopen(fd, "wb") as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+      # Atomic, so concurrent runs never see a partial entry.
+      os.replace(tmp, self._path(self.key(source, asm_parser)))
+    except Exception:
+      # Unpicklable results are not cached either; drop the partial file.
+      if tmp is not None and os.path.exists(tmp):
+        try:
+          os.unlink(tmp)
+        except OSError:
+          pass
+      return
+    self.evict()
+
+  def parse(self, source, asm_parser=None):
+    # Returns the parse result for source, parsing and storing it on a miss.
+    result = self.load(source, asm_parser)
+    if result is None:
+      result = (asm_parser or Parser()).parse_program(source)
+      self.store(source, result, asm_parser)
+    return result
+
+  def evict(self, now=None):
+    # Removes entries older than max_age, then the least recently used
+    # entries until the cache fits in max_bytes.
+    now = time.time() if now is None else now
+    entries = []
+    try:
+      names = os.listdir(self.directory)
+    except OSError:
+      return
+    for name in names:
+      if not name.endswith(SUFFIX): continue
+      path = os.path.join(self.directory, name)
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      if now - st.st_mtime > self.max_age:
+        self._remove(path)
+      else:
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self.max_bytes: break
+      self._remove(path)
+      total -= size
+
+  def clear(self):
+    # Removes every entry.
+    try:
+      names = os.listdir(self.directory)
+    except OSError:
+      return
+    for name in names:
+      if name.endswith(SUFFIX):
+        self._remove(os.path.join(self.directory, name))
+
+  def _remove(self, path):
+    # Deletes a cache file, ignoring files already removed by another run.
+    try:
+      os.remove(path)
+    except OSError:
+      pass
@@ -4,43 +4,282 @@ It coordinates the register file and memory, and implements the fetch-decode-exe
 """
 
 from registers import RegisterFile
-from memory import Memory
+from memory import Memory, PagedMemory
+from traps import Trap, MisalignedAccess, IllegalInstruction
+
+class StopReason:
+  """
+  Reasons for CPU.run() to return control to its caller.
+  """
+  HALT = 'halt'              # Halted by the stack check.
+  TRAP = 'trap'              # A trap was raised; it is recorded in CPU.trap.
+  EXIT = 'exit'              # The program issued the exit syscall (a7=10).
+  END = 'end'                # The PC left the program.
+  STEP_LIMIT = 'step_limit'  # The max_steps budget was used up.
+
+class RunResult:
+  """
+  The outcome of CPU.run(): why it stopped, how many instructions ran, and where.
+  """
+
+  def __init__(self, reason, steps, pc):
+    self.reason = reason
+    self.steps = steps
+    self.pc = pc
+
+  def __repr__(self):
+    return f"RunResult(reason={self.reason!r}, steps={self.steps}, pc=0x{self.pc:08X})"
+
+class CPUSnapshot:
+  """
+  Captured architectural state (registers, pc, memory) of a CPU.
+  """
+
+  def __init__(self, registers, pc, halted, exit_code, trap, memory):
+    self.registers = registers
+    self.pc = pc
+    self.halted = halted
+    self.exit_code = exit_code
+    self.trap = trap
+    self.memory = memory
 
 class CPU:
   """
   Represents the RISC-V CPU state and execution logic.
   """
 
-  def __init__(self, mem_size=65536):
+  def __init__(self, mem_size=65536, paged=False):
+    # Memory configuration. With paged=True the whole 32-bit space is
+    # addressable and mem_size only determines the stack placement.
+    self.mem_size = mem_size
+    self.paged = paged
     # The register file (x0-x31).
     self.registers = RegisterFile()
     # The byte-addressable memory.
-    self.memory = Memory(size=mem_size)
+    self.memory = self._create_memory()
     # The program counter.
     self.pc = 0
     # Flag to stop execution.
     self.halted = False
+    # a0 at the time of the exit syscall, None until then.
+    self.exit_code = None
+    # The Trap that halted execution, None until then.
+    self.trap = None
+    # Cached output of _predecode() for the last program run.
+    self._decoded = None
 
     # Stack configuration
     self.stack_base = mem_size
     self.stack_limit = mem_size // 2
     self.registers['sp'] = self.stack_base
 
+  def _create_memory(self):
+    # Builds a fresh memory of the configured kind.
+    if self.paged:
+      return PagedMemory()
+    return Memory(size=self.mem_size)
+
   def reset(self, start_pc=0):
     # Resets the CPU state.
-    mem_size = self.memory.size
     self.registers = RegisterFile()
-    self.memory = Memory(size=mem_size)
+    self.memory = self._create_memory()
     self.pc = start_pc
     self.halted = False
+    self.exit_code = None
+    self.trap = None
     self.registers['sp'] = self.stack_base
 
+  def snapshot(self):
+    # Captures registers, pc and memory, typically right after a program
+    # and its data have been loaded. Memory pages are shared copy-on-write.
+    return CPUSnapshot(self.registers.snapshot(), self.pc, self.halted,
+                       self.exit_code, self.trap, self.memory.snapshot())
+
+  def restore(self, snap):
+    # Returns to a snapshot's state. This replaces reset() plus reloading
+    # for repeated runs: only memory pages dirtied since the snapshot are
+    # rewritten.
+    self.registers.restore(snap.registers)
+    self.pc = snap.pc
+    self.halted = snap.halted
+    self.exit_code = snap.exit_code
+    self.trap = snap.trap
+    self.memory.restore(snap.memory)
+
+  def _check_stack(self):
+    # Halts if sp has left [stack_limit, stack_base].
+    sp_val = self.registers.regs[2]
+    if sp_val < self.stack_limit:
+        print(f"Runtime Error: Stack Overflow (sp=0x{sp_val:08X}, limit=0x{self.stack_limit:08X})")
+        self.halted = True
+    elif sp_val > self.stack_base:
+        print(f"Runtime Error: Stack Underflow (sp=0x{sp_val:08X}, base=0x{self.stack_base:08X})")
+        self.halted = True
+
+  def _take_trap(self, trap, pc):
+    # Records a trap raised by the instruction at pc and halts. The
+    # trapping instruction does not retire, so the PC stays on it.
+    if trap.pc is None:
+      trap.pc = pc
+    print(trap.message)
+    self.trap = trap
+    self.pc = trap.pc
+    self.halted = True
+
+  def _end(self, pc, steps):
+    # Result for a run that reached a pc holding no instruction: a
+    # misaligned pc is a fetch trap, anything else ends the run.
+    if pc & 3:
+      self._take_trap(MisalignedAccess(f"Misaligned instruction fetch at PC=0x{pc:08X}", addr=pc), pc)
+      return RunResult(StopReason.TRAP, steps, pc)
+    return RunResult(StopReason.END, steps, pc)
+
+  def _predecode(self, program):
+    # Flattens {address: [instruction]} into a dense list indexed by
+    # (pc - base) >> 2, plus a parallel list of stack-check flags, so the
+    # run loop needs neither dict lookups nor tag scans.
+    # The result is cached for the last program object seen.
+    if self._decoded is not None and self._decoded[0] is program:
+      return self._decoded[1:]
+    if getattr(program, 'lazy', False):
+      # Lazily parsed program: every slot starts empty and is decoded by
+      # the run loop the first time the PC reaches it.
+      base = program.base
+      code = [None] * ((program.end - base) >> 2)
+      checks = [False] * len(code)
+      self._decoded = (program, base, code, checks)
+      return base, code, checks
+    if program:
+      base = min(program)
+      code = [None] * (((max(program) - base) >> 2) + 1)
+    else:
+      base, code = 0, []
+    checks = [False] * len(code)
+    for addr, instructions in program.items():
+      if len(instructions) != 1 or (addr - base) & 3:
+        raise ValueError(f"Cannot predecode address 0x{addr:08X}: expected one word-aligned instruction")
+      idx = (addr - base) >> 2
+      code[idx] = instructions[0]
+      checks[idx] = "use_sp" in instructions[0].tags
+    self._decoded = (program, base, code, checks)
+    return base, code, checks
+
+  def run(self, program, max_steps=None, profile=None, trace=None):
+    # Runs program ({address: [instruction]}) from the current PC until it
+    # halts, exits, leaves the program, or executes max_steps instructions.
+    # Returns a RunResult. With profile (a profiler.Profile), the run also
+    # counts every instruction it executes by address; with trace (a
+    # tracefile.TraceWriter), it records each one.
+    if profile is not None or trace is not None:
+      result = self._run_instrumented(program, max_steps, profile, trace)
+      if trace is not None:
+        trace.stop(result.reason)
+      return result
+    base, code, checks = self._predecode(program)
+    span = len(code) << 2
+    budget = -1 if max_steps is None else max_steps
+    check_stack = self._check_stack
+    steps = 0
+    pc = self.pc
+    try:
+      while steps != budget:
+        pc = self.pc
+        offset = pc - base
+        if offset < 0 or offset >= span or offset & 3:
+          return self._end(pc, steps)
+        idx = offset >> 2
+        instr = code[idx]
+        if instr is None:
+          # Only lazily parsed programs can still supply an instruction here.
+          entry = program.get(pc)
+          if not entry:
+            return self._end(pc, steps)
+          instr = code[idx] = entry[0]
+          checks[idx] = "use_sp" in instr.tags
+        target = instr.execute(self)
+        steps += 1
+        self.pc = pc + 4 if target is None else target
+        if checks[idx]:
+          check_stack()
+        if self.halted:
+          reason = StopReason.HALT if self.exit_code is None else StopReason.EXIT
+          return RunResult(reason, steps, self.pc)
+    except Trap as trap:
+      self._take_trap(trap, pc)
+      return RunResult(StopReason.TRAP, steps, self.pc)
+    return RunResult(StopReason.STEP_LIMIT, steps, self.pc)
+
+  def _run_instrumented(self, program, max_steps, profile, trace):
+    # run() with a per-slot execution counter, the control transfers
+    # reported to the profile's call graph, and a trace record per
+    # instruction, each when asked for; kept apart so plain runs pay
+    # nothing for them.
+    base, code, checks = self._predecode(program)
+    counts = profile.cover(base, len(code)) if profile is not None else None
+    calls = profile.calls if profile is not None else None
+    # Trace plans by slot, made on first execution
+    plans = [None] * len(code) if trace is not None else None
+    regs = self.registers.regs
+    plan = None
+    span = len(code) << 2
+    budget = -1 if max_steps is None else max_steps
+    check_stack = self._check_stack
+    steps = 0
+    pc = self.pc
+    if calls is not None:
+      calls.resume(pc)
+    try:
+      while steps != budget:
+        pc = self.pc
+        offset = pc - base
+        if offset < 0 or offset >= span or offset & 3:
+          return self._end(pc, steps)
+        idx = offset >> 2
+        instr = code[idx]
+        if instr is None:
+          entry = program.get(pc)
+          if not entry:
+            return self._end(pc, steps)
+          instr = code[idx] = entry[0]
+          checks[idx] = "use_sp" in instr.tags
+        if counts is not None:
+          counts[idx] += 1
+        if plans is not None:
+          plan = plans[idx]
+          if plan is None:
+            plan = plans[idx] = trace.plan(instr)
+          # The address is taken before a load can overwrite its base
+          addr = (regs[plan[3]] + plan[4]) & 0xFFFFFFFF if plan[5] else 0
+        target = instr.execute(self)
+        steps += 1
+        if plans is not None:
+          trace.record(self, pc, plan, addr)
+        if target is None:
+          self.pc = pc + 4
+        else:
+          self.pc = target
+          if calls is not None:
+            calls.transfer(self, pc, target, instr, steps)
+        if checks[idx]:
+          check_stack()
+        if self.halted:
+          reason = StopReason.HALT if self.exit_code is None else StopReason.EXIT
+          return RunResult(reason, steps, self.pc)
+    except Trap as trap:
+      if trace is not None:
+        trace.fault(pc, plan)
+      self._take_trap(trap, pc)
+      return RunResult(StopReason.TRAP, steps, self.pc)
+    finally:
+      if calls is not None:
+        calls.pause(steps)
+    return RunResult(StopReason.STEP_LIMIT, steps, self.pc)
+
   def step(self, instruction_map):
     # Executes all instructions at current PC.
     # instruction_map is a dict {address: [instruction_objects]}.
     if self.pc not in instruction_map:
-      print(f"Error: No instruction at PC=0x{self.pc:08X}")
-      self.halted = True
+      self._take_trap(IllegalInstruction(f"Error: No instruction at PC=0x{self.pc:08X}"), self.pc)
       return
 
     instructions = instruction_map[self.pc]
@@ -48,13 +287,17 @@ class CPU:
     next_pc = self.pc + (4 * len(instructions))
     jump_pc = None
     
-    for instr in instructions:
-      result_pc = instr.execute(self)
-      if result_pc is not None:
-        jump_pc = result_pc
-      
-      if self.halted:
-        break
+    try:
+      for instr in instructions:
+        result_pc = instr.execute(self)
+        if result_pc is not None:
+          jump_pc = result_pc
+
+        if self.halted:
+          break
+    except Trap as trap:
+      self._take_trap(trap, self.pc)
+      return
     
     if jump_pc is not None:
       self.pc = jump_pc
@@ -63,10 +306,4 @@ class CPU:
 
     # Stack Protection (only if instruction used the 'sp' alias)
     if any("use_sp" in getattr(instr, 'tags', set()) for instr in instructions):
-      sp_val = self.registers['sp']
-      if sp_val < self.stack_limit:
-          print(f"Runtime Error: Stack Overflow (sp=0x{sp_val:08X}, limit=0x{self.stack_limit:08X})")
-          self.halted = True
-      elif sp_val > self.stack_base:
-          print(f"Runtime Error: Stack Underflow (sp=0x{sp_val:08X}, base=0x{self.stack_base:08X})")
-          self.halted = True
+      self._check_stack()
@@ -1,13 +1,50 @@
 """
 This module defines the expression classes for the functional assertion language.
-Each class implements an evaluate(cpu) method.
+Each class implements an evaluate(cpu) method, and source(temps), the same
+computation as Python source over the register list r, the memory mem and
+cpu. compile_expression() turns a tree into one function of cpu, folding
+constant subtrees, so meta instructions do not walk the tree on each run.
 """
 
+import itertools
+
+# Generated source -> compiled function, shared by identical expressions.
+_compiled = {}
+
+def _is_constant(code):
+  # True for the source of a folded value.
+  return code.isdigit() or code in ('True', 'False')
+
+def _folded(code, *parts):
+  # code, or the literal it evaluates to when all its parts are constant.
+  if all(_is_constant(part) for part in parts):
+    return repr(eval(code, {}))
+  return code
+
+def compile_expression(tree):
+  # Function of cpu returning tree.evaluate(cpu). Objects without source()
+  # are evaluated as they are.
+  if not isinstance(tree, Expression):
+    return tree.evaluate
+  body = tree.source(itertools.count())
+  fn = _compiled.get(body)
+  if fn is None:
+    lines = ["def expression(cpu):"]
+    if 'r[' in body: lines.append("  r = cpu.registers.regs")
+    if 'mem.' in body: lines.append("  mem = cpu.memory")
+    lines.append(f"  return {body}")
+    namespace = {}
+    exec(compile("\n".join(lines), f"<expression {body}>", "exec"), namespace)
+    fn = _compiled[body] = namespace['expression']
+  return fn
 
 class Expression:
   """Base class for all expressions."""
   def evaluate(self, cpu):
     raise NotImplementedError()
+  def source(self, temps):
+    # temps yields unique numbers for temporary names.
+    raise NotImplementedError()
 
 class Literal(Expression):
   def __init__(self, value):
@@ -15,16 +52,27 @@ class Literal(Expression):
     self.value = value & 0xFFFFFFFF
   def evaluate(self, cpu):
     return self.value
+  def source(self, temps):
+    return str(self.value)
 
 class RegAccess(Expression):
   def __init__(self, reg_index):
     self.reg_index = reg_index
   def evaluate(self, cpu):
-    return cpu.registers[self.reg_index]
+    return cpu.registers.regs[self.reg_index]
+  def source(self, temps):
+    # x0 always reads as zero
+    return f"r[{self.reg_index}]" if self.reg_index else "0"
 
 class PCAccess(Expression):
   def evaluate(self, cpu):
     return cpu.pc
+  def source(self, temps):
+    return "cpu.pc"
+
+# Memory type -> (size, signed) for Memory.read.
+_MEM_TYPES = {'u8': (1, False), 'u16': (2, False), 'u32': (4, False),
+              'i8': (1, True), 'i16': (2, True), 'i32': (4, True)}
 
 class MemAccess(Expression):
   def __init__(self, addr_expr, type_str):
@@ -33,71 +81,119 @@ class MemAccess(Expression):
   def evaluate(self, cpu):
     addr = self.addr_expr.evaluate(cpu)
     return cpu.memory.read_typed(addr, self.type_str)
+  def source(self, temps):
+    addr = self.addr_expr.source(temps)
+    if self.type_str in _MEM_TYPES:
+      size, signed = _MEM_TYPES[self.type_str]
+      return f"mem.read({addr}, {size}, {signed})"
+    # read_typed reports the unsupported type when it runs
+    return f"mem.read_typed({addr}, {self.type_str!r})"
 
 class BinaryOp(Expression):
+  # Python source with the operands as {0} and {1}.
+  template = None
+
   def __init__(self, left, right):
     self.left = left
     self.right = right
+  def source(self, temps):
+    left, right = self.left.source(temps), self.right.source(temps)
+    return _folded(self.template.format(left, right), left, right)
 
 class Eq(BinaryOp):
+  template = "({0} == {1})"
   def evaluate(self, cpu):
     return self.left.evaluate(cpu) == self.right.evaluate(cpu)
 
 class Ne(BinaryOp):
+  template = "({0} != {1})"
   def evaluate(self, cpu):
     return self.left.evaluate(cpu) != self.right.evaluate(cpu)
 
 class Lt(BinaryOp):
+  template = "({0} < {1})"
   def evaluate(self, cpu):
     return self.left.evaluate(cpu) < self.right.evaluate(cpu)
 
 class Gt(BinaryOp):
+  template = "({0} > {1})"
   def evaluate(self, cpu):
     return self.left.evaluate(cpu) > self.right.evaluate(cpu)
 
 class Le(BinaryOp):
+  template = "({0} <= {1})"
   def evaluate(self, cpu):
     return self.left.evaluate(cpu) <= self.right.evaluate(cpu)
 
 class Ge(BinaryOp):
+  template = "({0} >= {1})"
   def evaluate(self, cpu):
     return self.left.evaluate(cpu) >= self.right.evaluate(cpu)
 
 class AndExpr(BinaryOp):
+  template = "({0} and {1})"
   def evaluate(self, cpu):
     return self.left.evaluate(cpu) and self.right.evaluate(cpu)
+  def source(self, temps):
+    left = self.left.source(temps)
+    if _is_constant(left):
+      # A constant left side decides which operand is the result
+      return self.right.source(temps) if eval(left) else left
+    return self.template.format(left, self.right.source(temps))
 
 class OrExpr(BinaryOp):
+  template = "({0} or {1})"
   def evaluate(self, cpu):
     return self.left.evaluate(cpu) or self.right.evaluate(cpu)
+  def source(self, temps):
+    left = self.left.source(temps)
+    if _is_constant(left):
+      return left if eval(left) else self.right.source(temps)
+    return self.template.format(left, self.right.source(temps))
 
 class NotExpr(Expression):
   def __init__(self, inner):
     self.inner = inner
   def evaluate(self, cpu):
     return not self.inner.evaluate(cpu)
+  def source(self, temps):
+    inner = self.inner.source(temps)
+    return _folded(f"(not {inner})", inner)
 
 class Add(BinaryOp):
+  template = "(({0} + {1}) & 0xFFFFFFFF)"
   def evaluate(self, cpu):
     return (self.left.evaluate(cpu) + self.right.evaluate(cpu)) & 0xFFFFFFFF
 
 class Sub(BinaryOp):
+  template = "(({0} - {1}) & 0xFFFFFFFF)"
   def evaluate(self, cpu):
     return (self.left.evaluate(cpu) - self.right.evaluate(cpu)) & 0xFFFFFFFF
 
 class Mul(BinaryOp):
+  template = "(({0} * {1}) & 0xFFFFFFFF)"
   def evaluate(self, cpu):
     return (self.left.evaluate(cpu) * self.right.evaluate(cpu)) & 0xFFFFFFFF
 
 class Div(BinaryOp):
+  # The divisor is evaluated first and the dividend only when it is not 0.
+  template = "(0xFFFFFFFF if ({2} := {1}) == 0 else ({0} // {2}) & 0xFFFFFFFF)"
   def evaluate(self, cpu):
     right = self.right.evaluate(cpu)
     if right == 0: return 0xFFFFFFFF # Define division by zero behavior
     return (self.left.evaluate(cpu) // right) & 0xFFFFFFFF
+  def source(self, temps):
+    right = self.right.source(temps)
+    if _is_constant(right) and not eval(right):
+      return str(0xFFFFFFFF)
+    left = self.left.source(temps)
+    code = self.template.format(left, right, f"_t{next(temps)}")
+    return _folded(code, left, right)
 
 class Mod(BinaryOp):
+  template = "(0xFFFFFFFF if ({2} := {1}) == 0 else ({0} % {2}) & 0xFFFFFFFF)"
+  source = Div.source
   def evaluate(self, cpu):
     right = self.right.evaluate(cpu)
     if right == 0: return 0xFFFFFFFF # Define mod by zero behavior
     return (self.left.evaluate(cpu) % right) & 0xFFFFFFFF
-
@@ -0,0 +1,165 @@
+"""
+This module provides macro-op fusion for the RISC-V emulator.
+fuse() rewrites a parsed program so that common instruction pairs are
+dispatched once: the lui/auipc + addi of li and la, the auipc + load of a
+PC-relative lw, the auipc + jalr of a far call, and an ALU operation
+followed by a conditional branch (slt + bnez, addi + bne, ...).
+A fused instruction has the architectural effect of both halves and
+continues after the second. The second half keeps its own slot, so a jump
+into the middle of a pair runs it unfused. Run loops count a fused pair as
+one step.
+"""
+
+import operator
+import instructions as instr
+from registers import MASK32, WRITE_MASK
+from traps import Trap
+SIGN32 = 0x80000000
+
+# (size, signed) for each load.
+_LOADS = {instr.Lw: (4, True), instr.Lh: (2, True), instr.Lhu: (2, False),
+          instr.Lb: (1, True), instr.Lbu: (1, False)}
+
+# Conditional branch -> (comparison, operand bias). Signed comparisons
+# flip the sign bit so that comparing the biased values unsigned is exact.
+_BRANCHES = {
+  instr.Beq: (operator.eq, 0), instr.Bne: (operator.ne, 0),
+  instr.Blt: (operator.lt, SIGN32), instr.Bge: (operator.ge, SIGN32),
+  instr.Bltu: (operator.lt, 0), instr.Bgeu: (operator.ge, 0),
+}
+
+class Fused(instr.Instruction):
+  """
+  Base class for a fused pair at a fixed address. Keeps both original
+  halves; the stack check after the pair is the one after its second half.
+  """
+
+  __slots__ = ('first', 'second', 'next_pc')
+
+  def __init__(self, first, second, pc):
+    super().__init__()
+    self.first = first
+    self.second = second
+    self.next_pc = (pc + 8) & MASK32
+    self.tags = second.tags
+
+class FusedConstant(Fused):
+  """lui or auipc rd, then addi rd, rd: rd gets the combined value."""
+
+  __slots__ = ('rd', 'value')
+
+  def __init__(self, first, second, pc):
+    super().__init__(first, second, pc)
+    upper = first.imm << 12
+    if type(first) is instr.Auipc: upper += pc
+    self.rd = first.rd
+    self.value = (upper + second.imm) & WRITE_MASK[self.rd]
+
+  def execute(self, cpu):
+    cpu.registers.regs[self.rd] = self.value
+    return self.next_pc
+
+class FusedPcLoad(Fused):
+  """auipc rd, then a load based on rd: a load from a fixed address."""
+
+  __slots__ = ('rd', 'upper', 'load_rd', 'addr', 'size', 'signed', 'load_pc')
+
+  def __init__(self, first, second, pc):
+    super().__init__(first, second, pc)
+    self.rd = first.rd
+    self.upper = (pc + (first.imm << 12)) & WRITE_MASK[self.rd]
+    self.load_rd = second.rd
+    self.addr = (self.upper + second.imm) & MASK32
+    self.size, self.signed = _LOADS[type(second)]
+    self.load_pc = (pc + 4) & MASK32
+
+  def execute(self, cpu):
+    r = cpu.registers.regs
+    r[self.rd] = self.upper
+    try:
+      value = cpu.memory.read(self.addr, self.size, self.signed)
+    except Trap as trap:
+      # The auipc retired; the trap belongs to the load
+      if trap.pc is None:
+        trap.pc = self.load_pc
+      raise
+    r[self.load_rd] = value & WRITE_MASK[self.load_rd]
+    return self.next_pc
+
+class FusedFarCall(Fused):
+  """auipc rd, then jalr based on rd: a jump to a fixed target."""
+
+  __slots__ = ('rd', 'upper', 'link_rd', 'link', 'target')
+
+  def __init__(self, first, second, pc):
+    super().__init__(first, second, pc)
+    self.rd = first.rd
+    self.upper = (pc + (first.imm << 12)) & WRITE_MASK[self.rd]
+    self.link_rd = second.rd
+    self.link = self.next_pc & WRITE_MASK[self.link_rd]
+    self.target = (self.upper + second.imm) & 0xFFFFFFFE
+
+  def execute(self, cpu):
+    r = cpu.registers.regs
+    r[self.rd] = self.upper
+    r[self.link_rd] = self.link
+    return self.target
+
+class FusedBranch(Fused):
+  """An ALU operation, then a conditional branch on the updated registers."""
+
+  __slots__ = ('rs1', 'rs2', 'test', 'bias', 'taken')
+
+  def __init__(self, first, second, pc):
+    super().__init__(first, second, pc)
+    self.rs1 = second.rs1
+    self.rs2 = second.rs2
+    self.test, self.bias = _BRANCHES[type(second)]
+    self.taken = (pc + 4 + second.imm) & MASK32
+
+  def execute(self, cpu):
+    self.first.execute(cpu)
+    r = cpu.registers.regs
+    bias = self.bias
+    if self.test(r[self.rs1] ^ bias, r[self.rs2] ^ bias):
+      return self.taken
+    return self.next_pc
+
+def fusion_for(first, second):
+  # The Fused class for an adjacent pair, or None if it does not fuse.
+  if "use_sp" in first.tags:
+    # The stack check runs between the two halves
+    return None
+  cls = type(second)
+  if type(first) in (instr.Lui, instr.Auipc):
+    if cls is instr.Addi and second.rd == second.rs1 == first.rd:
+      return FusedConstant
+    if type(first) is instr.Auipc and getattr(second, 'rs1', None) == first.rd:
+      if cls in _LOADS:
+        return FusedPcLoad
+      if cls is instr.Jalr:
+        return FusedFarCall
+    return None
+  if cls in _BRANCHES and instr.is_alu(first):
+    return FusedBranch
+  return None
+
+def fuse(program):
+  # Returns a copy of program ({address: [instruction]}) in which every
+  # address that starts a fusable pair holds the fused instruction. Each
+  # slot is considered on its own, so the second half of one pair may
+  # itself start another for code that jumps to it.
+  fused = {}
+  for addr, instructions in program.items():
+    following = program.get(addr + 4)
+    if len(instructions) == 1 and following is not None and len(following) == 1:
+      cls = fusion_for(instructions[0], following[0])
+      if cls is not None:
+        fused[addr] = [cls(instructions[0], following[0], addr)]
+        continue
+    fused[addr] = instructions
+  return fused
+
+def fused_count(program):
+  # Number of fused pairs in a program returned by fuse().
+  return sum(1 for instructions in program.values() if isinstance(instructions[0], Fused))
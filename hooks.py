@@ -0,0 +1,77 @@
+"""
+This module attaches meta-instruction hooks to a parsed program.
+The parser keeps @assert, @print and @print_mem lines out of the text
+segment. A meta line becomes a hook on the address of the next
+instruction, in the 'hooks' entry of the parse result ({address: [meta
+instruction]}). When a label separates it from that instruction, jumps to
+the label must not run it, so it becomes a fall-through hook on the
+previous instruction instead, in 'fallthrough_hooks'.
+attach() wraps every hooked address so its hooks run around the
+instruction there; a run without attach() never looks at them, so
+stripping the meta lines costs nothing, as with 'python -O'.
+"""
+
+import instructions as instr
+from program import CompactProgram
+from registers import MASK32
+
+class Hooked(instr.Instruction):
+  """
+  An instruction with the meta instructions hooked to its address: hooks
+  run before it, fall-through hooks after it when execution continues at
+  the next address. Hooks after the last instruction of a program are held
+  by a Hooked without an instruction, which runs them and falls through to
+  the end.
+  """
+
+  __slots__ = ('instruction', 'hooks', 'fallthrough')
+
+  def __init__(self, instruction, hooks=(), fallthrough=()):
+    super().__init__()
+    self.instruction = instruction
+    self.hooks = tuple(hooks)
+    self.fallthrough = tuple(fallthrough)
+    if instruction is not None:
+      self.tags = instruction.tags
+
+  def execute(self, cpu):
+    # A failing assertion traps before the instruction runs.
+    for hook in self.hooks:
+      hook.execute(cpu)
+    if self.instruction is None:
+      return None
+    target = self.instruction.execute(cpu)
+    # Any returned target is a transfer of control, even to the next
+    # address: a branch over meta lines lands right after it.
+    if target is None and self.fallthrough and not cpu.halted:
+      # The meta lines sit before the next instruction, so they see its pc
+      pc = cpu.pc
+      cpu.pc = (pc + 4) & MASK32
+      for hook in self.fallthrough:
+        hook.execute(cpu)
+      cpu.pc = pc
+    return target
+
+def attach(program, hooks, fallthrough_hooks=None):
+  # Returns program ({address: [instruction]}, a CompactProgram or a
+  # LazyProgram) with hooks and fallthrough_hooks ({address: [meta
+  # instruction]}, as in a parse result) attached. The original program is
+  # left as it is.
+  fallthrough_hooks = fallthrough_hooks or {}
+  if not hooks and not fallthrough_hooks:
+    return program
+  if getattr(program, 'lazy', False):
+    return program.with_hooks(hooks, fallthrough_hooks)
+  wrapped = {}
+  for addr in hooks.keys() | fallthrough_hooks.keys():
+    entry = program.get(addr)
+    wrapped[addr] = Hooked(entry[0] if entry else None, hooks.get(addr, ()), fallthrough_hooks.get(addr, ()))
+  if isinstance(program, CompactProgram):
+    hooked = program.copy()
+    for addr, ins in wrapped.items():
+      hooked.put(addr, ins)
+    return hooked
+  hooked = dict(program)
+  for addr, ins in wrapped.items():
+    hooked[addr] = [ins]
+  return hooked
@@ -1,19 +1,55 @@
 """
 This module defines the instruction classes for the RISC-V emulator.
 Each class implements an execute(cpu) method.
+Immediates are normalized once at construction (sign-extended for I/S/B/J
+types, masked for shifts and U types), and every class uses __slots__.
+Faults are raised as traps (see traps.py) rather than halting the CPU.
 """
 
+from registers import WRITE_MASK
+from traps import IllegalInstruction, Breakpoint, EnvironmentCall, AssertionFailure
+from expressions import compile_expression
+
+# Shared by every untagged instruction; tag() replaces it on first use.
+NO_TAGS = frozenset()
+
+def sext12(imm):
+  # Sign-extends a 12-bit immediate.
+  imm &= 0xFFF
+  return imm - 0x1000 if imm & 0x800 else imm
+
+def shamt(imm):
+  # Keeps the five shift-amount bits of a shift immediate.
+  return imm & 0x1F
+
+def sext20(imm):
+  # Sign-extends a 20-bit immediate.
+  imm &= 0xFFFFF
+  return imm - 0x100000 if imm & 0x80000 else imm
+
+def is_alu(ins):
+  # Register-register or register-immediate arithmetic, which cannot trap.
+  return isinstance(ins, (RType, IType)) and not isinstance(ins, Load)
+
 class Instruction:
   """Base class for all instructions."""
+  __slots__ = ('tags',)
+
   def __init__(self):
-    self.tags = set()
+    self.tags = NO_TAGS
+
+  def tag(self, name):
+    # Adds a tag such as "use_sp" to this instruction.
+    self.tags = self.tags | {name}
 
   def execute(self, cpu):
-    raise NotImplementedError("Each instruction must implement execute.")
+    raise IllegalInstruction(f"Illegal instruction {type(self).__name__} at PC=0x{cpu.pc:08X}", pc=cpu.pc)
 
 # --- R-Type ---
 
 class RType(Instruction):
+  __slots__ = ('rd', 'rs1', 'rs2')
+
   def __init__(self, rd, rs1, rs2):
     super().__init__()
     self.rd = rd
@@ -21,336 +57,385 @@ class RType(Instruction):
     self.rs2 = rs2
 
 class Add(RType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    val = (cpu.registers[self.rs1] + cpu.registers[self.rs2]) & 0xFFFFFFFF
-    cpu.registers[self.rd] = val
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] + r[self.rs2]) & WRITE_MASK[self.rd]
 
 class Sub(RType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    val = (cpu.registers[self.rs1] - cpu.registers[self.rs2]) & 0xFFFFFFFF
-    cpu.registers[self.rd] = val
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] - r[self.rs2]) & WRITE_MASK[self.rd]
 
 class Sll(RType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    shamt = cpu.registers[self.rs2] & 0x1F
-    cpu.registers[self.rd] = (cpu.registers[self.rs1] << shamt) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    shamt = r[self.rs2] & 0x1F
+    r[self.rd] = (r[self.rs1] << shamt) & WRITE_MASK[self.rd]
 
 class Slt(RType):
+  __slots__ = ()
+
   def execute(self, cpu):
+    r = cpu.registers.regs
     # Signed comparison
-    v1 = cpu.registers[self.rs1]
+    v1 = r[self.rs1]
     if v1 & 0x80000000: v1 -= 0x100000000
-    v2 = cpu.registers[self.rs2]
+    v2 = r[self.rs2]
     if v2 & 0x80000000: v2 -= 0x100000000
-    cpu.registers[self.rd] = 1 if v1 < v2 else 0
+    r[self.rd] = (v1 < v2) & WRITE_MASK[self.rd]
 
 class Sltu(RType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    cpu.registers[self.rd] = 1 if cpu.registers[self.rs1] < cpu.registers[self.rs2] else 0
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] < r[self.rs2]) & WRITE_MASK[self.rd]
 
 class Xor(RType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    cpu.registers[self.rd] = cpu.registers[self.rs1] ^ cpu.registers[self.rs2]
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] ^ r[self.rs2]) & WRITE_MASK[self.rd]
 
 class Srl(RType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    shamt = cpu.registers[self.rs2] & 0x1F
-    cpu.registers[self.rd] = (cpu.registers[self.rs1] >> shamt) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    shamt = r[self.rs2] & 0x1F
+    r[self.rd] = (r[self.rs1] >> shamt) & WRITE_MASK[self.rd]
 
 class Sra(RType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    shamt = cpu.registers[self.rs2] & 0x1F
-    v1 = cpu.registers[self.rs1]
+    r = cpu.registers.regs
+    shamt = r[self.rs2] & 0x1F
+    v1 = r[self.rs1]
     if v1 & 0x80000000:
       res = ((v1 | 0xFFFFFFFF00000000) >> shamt) & 0xFFFFFFFF
     else:
       res = (v1 >> shamt) & 0xFFFFFFFF
-    cpu.registers[self.rd] = res
+    r[self.rd] = res & WRITE_MASK[self.rd]
 
 class Or(RType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    cpu.registers[self.rd] = cpu.registers[self.rs1] | cpu.registers[self.rs2]
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] | r[self.rs2]) & WRITE_MASK[self.rd]
 
 class And(RType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    cpu.registers[self.rd] = cpu.registers[self.rs1] & cpu.registers[self.rs2]
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] & r[self.rs2]) & WRITE_MASK[self.rd]
 
 # --- M-Extension ---
 
 class Mul(RType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    val = (cpu.registers[self.rs1] * cpu.registers[self.rs2]) & 0xFFFFFFFF
-    cpu.registers[self.rd] = val
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] * r[self.rs2]) & WRITE_MASK[self.rd]
 
 # --- I-Type ---
 
 class IType(Instruction):
+  __slots__ = ('rd', 'rs1', 'imm')
+
+  # Normalizes the immediate; shifts override this to keep the low five bits.
+  normalize = staticmethod(sext12)
+
   def __init__(self, rd, rs1, imm):
     super().__init__()
     self.rd = rd
     self.rs1 = rs1
-    # imm is usually 12-bit signed
-    self.imm = imm
+    self.imm = self.normalize(imm)
 
 class Addi(IType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    cpu.registers[self.rd] = (cpu.registers[self.rs1] + imm) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] + self.imm) & WRITE_MASK[self.rd]
 
 class Slti(IType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    v1 = cpu.registers[self.rs1]
+    r = cpu.registers.regs
+    v1 = r[self.rs1]
     if v1 & 0x80000000: v1 -= 0x100000000
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    cpu.registers[self.rd] = 1 if v1 < imm else 0
+    r[self.rd] = (v1 < self.imm) & WRITE_MASK[self.rd]
 
 class Sltiu(IType):
+  __slots__ = ()
+
   # For SLTIU, immediate is sign-extended then treated as unsigned.
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm = (imm - 0x1000) & 0xFFFFFFFF
-    else: imm = imm & 0xFFFFFFFF
-    cpu.registers[self.rd] = 1 if cpu.registers[self.rs1] < imm else 0
+    r = cpu.registers.regs
+    imm = self.imm & 0xFFFFFFFF
+    r[self.rd] = (r[self.rs1] < imm) & WRITE_MASK[self.rd]
 
 class Xori(IType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    cpu.registers[self.rd] = cpu.registers[self.rs1] ^ imm
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] ^ self.imm) & WRITE_MASK[self.rd]
 
 class Ori(IType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    cpu.registers[self.rd] = cpu.registers[self.rs1] | imm
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] | self.imm) & WRITE_MASK[self.rd]
 
 class Andi(IType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    cpu.registers[self.rd] = cpu.registers[self.rs1] & imm
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] & self.imm) & WRITE_MASK[self.rd]
 
 class Slli(IType):
+  __slots__ = ()
+  normalize = staticmethod(shamt)
+
   def execute(self, cpu):
-    cpu.registers[self.rd] = (cpu.registers[self.rs1] << (self.imm & 0x1F)) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] << self.imm) & WRITE_MASK[self.rd]
 
 class Srli(IType):
+  __slots__ = ()
+  normalize = staticmethod(shamt)
+
   def execute(self, cpu):
-    cpu.registers[self.rd] = (cpu.registers[self.rs1] >> (self.imm & 0x1F)) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    r[self.rd] = (r[self.rs1] >> self.imm) & WRITE_MASK[self.rd]
 
 class Srai(IType):
+  __slots__ = ()
+  normalize = staticmethod(shamt)
+
   def execute(self, cpu):
-    shamt = self.imm & 0x1F
-    v1 = cpu.registers[self.rs1]
+    r = cpu.registers.regs
+    shamt = self.imm
+    v1 = r[self.rs1]
     if v1 & 0x80000000:
       res = ((v1 | 0xFFFFFFFF00000000) >> shamt) & 0xFFFFFFFF
     else:
       res = (v1 >> shamt) & 0xFFFFFFFF
-    cpu.registers[self.rd] = res
+    r[self.rd] = res & WRITE_MASK[self.rd]
 
 # --- Load ---
 
 class Load(IType):
-  pass
+  __slots__ = ()
 
 class Lw(Load):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    addr = (cpu.registers[self.rs1] + imm) & 0xFFFFFFFF
-    val = cpu.memory.read(addr, 4, True)
-    if val is None:
-      cpu.halted = True
-      return
-    cpu.registers[self.rd] = val
+    r = cpu.registers.regs
+    r[self.rd] = cpu.memory.read((r[self.rs1] + self.imm) & 0xFFFFFFFF, 4, True) & WRITE_MASK[self.rd]
 
 class Lh(Load):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    addr = (cpu.registers[self.rs1] + imm) & 0xFFFFFFFF
-    val = cpu.memory.read(addr, 2, True)
-    if val is None:
-      cpu.halted = True
-      return
-    cpu.registers[self.rd] = val
+    r = cpu.registers.regs
+    r[self.rd] = cpu.memory.read((r[self.rs1] + self.imm) & 0xFFFFFFFF, 2, True) & WRITE_MASK[self.rd]
 
 class Lhu(Load):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    addr = (cpu.registers[self.rs1] + imm) & 0xFFFFFFFF
-    val = cpu.memory.read(addr, 2, False)
-    if val is None:
-      cpu.halted = True
-      return
-    cpu.registers[self.rd] = val
+    r = cpu.registers.regs
+    r[self.rd] = cpu.memory.read((r[self.rs1] + self.imm) & 0xFFFFFFFF, 2, False) & WRITE_MASK[self.rd]
 
 class Lb(Load):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    addr = (cpu.registers[self.rs1] + imm) & 0xFFFFFFFF
-    val = cpu.memory.read(addr, 1, True)
-    if val is None:
-      cpu.halted = True
-      return
-    cpu.registers[self.rd] = val
+    r = cpu.registers.regs
+    r[self.rd] = cpu.memory.read((r[self.rs1] + self.imm) & 0xFFFFFFFF, 1, True) & WRITE_MASK[self.rd]
 
 class Lbu(Load):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    addr = (cpu.registers[self.rs1] + imm) & 0xFFFFFFFF
-    val = cpu.memory.read(addr, 1, False)
-    if val is None:
-      cpu.halted = True
-      return
-    cpu.registers[self.rd] = val
+    r = cpu.registers.regs
+    r[self.rd] = cpu.memory.read((r[self.rs1] + self.imm) & 0xFFFFFFFF, 1, False) & WRITE_MASK[self.rd]
 
 # --- S-Type ---
 
 class SType(Instruction):
+  __slots__ = ('rs1', 'rs2', 'imm')
+
   def __init__(self, rs1, rs2, imm):
     super().__init__()
     self.rs1 = rs1
     self.rs2 = rs2
-    self.imm = imm
+    self.imm = sext12(imm)
 
 class Sw(SType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    addr = (cpu.registers[self.rs1] + imm) & 0xFFFFFFFF
-    if not cpu.memory.write(addr, 4, cpu.registers[self.rs2]):
-      cpu.halted = True
+    r = cpu.registers.regs
+    cpu.memory.write((r[self.rs1] + self.imm) & 0xFFFFFFFF, 4, r[self.rs2])
 
 class Sh(SType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    addr = (cpu.registers[self.rs1] + imm) & 0xFFFFFFFF
-    if not cpu.memory.write(addr, 2, cpu.registers[self.rs2]):
-      cpu.halted = True
+    r = cpu.registers.regs
+    cpu.memory.write((r[self.rs1] + self.imm) & 0xFFFFFFFF, 2, r[self.rs2])
 
 class Sb(SType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    addr = (cpu.registers[self.rs1] + imm) & 0xFFFFFFFF
-    if not cpu.memory.write(addr, 1, cpu.registers[self.rs2]):
-      cpu.halted = True
+    r = cpu.registers.regs
+    cpu.memory.write((r[self.rs1] + self.imm) & 0xFFFFFFFF, 1, r[self.rs2])
 
 # --- B-Type ---
 
 class BType(Instruction):
+  __slots__ = ('rs1', 'rs2', 'imm')
+
   def __init__(self, rs1, rs2, imm):
     super().__init__()
     self.rs1 = rs1
     self.rs2 = rs2
-    self.imm = imm # Relative offset
+    self.imm = sext12(imm) # Relative offset
 
 class Beq(BType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    if cpu.registers[self.rs1] == cpu.registers[self.rs2]:
-      return (cpu.pc + imm) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    if r[self.rs1] == r[self.rs2]:
+      return (cpu.pc + self.imm) & 0xFFFFFFFF
 
 class Bne(BType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    if cpu.registers[self.rs1] != cpu.registers[self.rs2]:
-      return (cpu.pc + imm) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    if r[self.rs1] != r[self.rs2]:
+      return (cpu.pc + self.imm) & 0xFFFFFFFF
 
 class Blt(BType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    v1 = cpu.registers[self.rs1]
+    r = cpu.registers.regs
+    v1 = r[self.rs1]
     if v1 & 0x80000000: v1 -= 0x100000000
-    v2 = cpu.registers[self.rs2]
+    v2 = r[self.rs2]
     if v2 & 0x80000000: v2 -= 0x100000000
     if v1 < v2:
-      return (cpu.pc + imm) & 0xFFFFFFFF
+      return (cpu.pc + self.imm) & 0xFFFFFFFF
 
 class Bge(BType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    v1 = cpu.registers[self.rs1]
+    r = cpu.registers.regs
+    v1 = r[self.rs1]
     if v1 & 0x80000000: v1 -= 0x100000000
-    v2 = cpu.registers[self.rs2]
+    v2 = r[self.rs2]
     if v2 & 0x80000000: v2 -= 0x100000000
     if v1 >= v2:
-      return (cpu.pc + imm) & 0xFFFFFFFF
+      return (cpu.pc + self.imm) & 0xFFFFFFFF
 
 class Bltu(BType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    if cpu.registers[self.rs1] < cpu.registers[self.rs2]:
-      return (cpu.pc + imm) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    if r[self.rs1] < r[self.rs2]:
+      return (cpu.pc + self.imm) & 0xFFFFFFFF
 
 class Bgeu(BType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    if cpu.registers[self.rs1] >= cpu.registers[self.rs2]:
-      return (cpu.pc + imm) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    if r[self.rs1] >= r[self.rs2]:
+      return (cpu.pc + self.imm) & 0xFFFFFFFF
 
 # --- U-Type ---
 
 class UType(Instruction):
+  __slots__ = ('rd', 'imm')
+
   def __init__(self, rd, imm):
     super().__init__()
     self.rd = rd
-    self.imm = imm # 20-bit imm
+    self.imm = imm & 0xFFFFF # 20-bit imm
 
 class Lui(UType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFFFF
-    cpu.registers[self.rd] = (imm << 12) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    r[self.rd] = (self.imm << 12) & WRITE_MASK[self.rd]
 
 class Auipc(UType):
+  __slots__ = ()
+
   def execute(self, cpu):
-    imm = self.imm & 0xFFFFF
-    cpu.registers[self.rd] = (cpu.pc + (imm << 12)) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    r[self.rd] = (cpu.pc + (self.imm << 12)) & WRITE_MASK[self.rd]
 
 # --- J-Type ---
 
 class Jal(Instruction):
+  __slots__ = ('rd', 'imm')
+
   def __init__(self, rd, imm):
     super().__init__()
     self.rd = rd
-    self.imm = imm
+    self.imm = sext20(imm)
 
   def execute(self, cpu):
-    imm = self.imm & 0xFFFFF # 20-bit
-    if imm & 0x80000: imm -= 0x100000
-    cpu.registers[self.rd] = (cpu.pc + 4) & 0xFFFFFFFF
-    return (cpu.pc + imm) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    r[self.rd] = (cpu.pc + 4) & WRITE_MASK[self.rd]
+    return (cpu.pc + self.imm) & 0xFFFFFFFF
 
 class Jalr(Instruction):
+  __slots__ = ('rd', 'rs1', 'imm')
+
   def __init__(self, rd, rs1, imm):
     super().__init__()
     self.rd = rd
     self.rs1 = rs1
-    self.imm = imm
+    self.imm = sext12(imm)
 
   def execute(self, cpu):
-    imm = self.imm & 0xFFF
-    if imm & 0x800: imm -= 0x1000
-    target = (cpu.registers[self.rs1] + imm) & 0xFFFFFFFE
-    cpu.registers[self.rd] = (cpu.pc + 4) & 0xFFFFFFFF
+    r = cpu.registers.regs
+    target = (r[self.rs1] + self.imm) & 0xFFFFFFFE
+    r[self.rd] = (cpu.pc + 4) & WRITE_MASK[self.rd]
     return target
 
 # --- Meta Instructions ---
 
 class Print(Instruction):
+  __slots__ = ('reg_name', 'reg_index')
+
   def __init__(self, reg_name, reg_index):
     super().__init__()
     self.reg_name = reg_name
@@ -360,21 +445,30 @@ class Print(Instruction):
     if self.reg_index == 'pc':
       val = cpu.pc
     else:
-      val = cpu.registers[self.reg_index]
+      val = cpu.registers.regs[self.reg_index]
     print(f"[DEBUG] {self.reg_name} = {val} (0x{val:08X})")
 
 class PrintExpression(Instruction):
+  __slots__ = ('expr_obj', 'expr_str', 'compiled')
+
   def __init__(self, expr_obj, expr_str):
     super().__init__()
     self.expr_obj = expr_obj
     self.expr_str = expr_str
+    self.compiled = compile_expression(expr_obj)
+
+  def __reduce__(self):
+    # Pickles the tree; the compiled function is rebuilt on load.
+    return (PrintExpression, (self.expr_obj, self.expr_str), (None, {'tags': self.tags}))
 
   def execute(self, cpu):
-    val = self.expr_obj.evaluate(cpu)
+    val = self.compiled(cpu)
     print(f"[DEBUG] {self.expr_str} = {val} (0x{val:08X})")
 
 
 class PrintMem(Instruction):
+  __slots__ = ('addr_expr', 'type_str', 'n')
+
   def __init__(self, addr_expr, type_str, n):
     super().__init__()
     self.addr_expr = addr_expr # Could be a constant or expression
@@ -393,37 +487,47 @@ class PrintMem(Instruction):
       addr += size
 
 class Assert(Instruction):
+  __slots__ = ('expression_tree', 'line_text', 'compiled')
+
   def __init__(self, expression_tree, line_text):
     super().__init__()
     self.expression_tree = expression_tree
     self.line_text = line_text
+    # Compiled once; identical expressions share the function.
+    self.compiled = compile_expression(expression_tree)
+
+  def __reduce__(self):
+    # Pickles the tree; the compiled function is rebuilt on load.
+    return (Assert, (self.expression_tree, self.line_text), (None, {'tags': self.tags}))
 
   def execute(self, cpu):
-    # expression_tree should have an evaluate(cpu) method.
-    result = self.expression_tree.evaluate(cpu)
+    result = self.compiled(cpu)
     if not result:
-      print(f"[ASSERTION FAILED] {self.line_text}")
-      cpu.halted = True
-      raise AssertionError(f"Assertion failed: {self.line_text}")
+      raise AssertionFailure(f"[ASSERTION FAILED] {self.line_text}", pc=cpu.pc)
 
 # --- System ---
 
 class System(Instruction):
-  pass
+  __slots__ = ()
 
 class Fence(System):
+  __slots__ = ()
+
   def execute(self, cpu):
     pass
 
 class Ecall(System):
+  __slots__ = ()
+
   def execute(self, cpu):
-    syscall_num = cpu.registers[17] # a7
+    r = cpu.registers.regs
+    syscall_num = r[17] # a7
     if syscall_num == 1: # Print Integer
-        val = cpu.registers[10] # a0
+        val = r[10] # a0
         if val & 0x80000000: val -= 0x100000000
         print(val, end="", flush=True)
     elif syscall_num == 4: # Print String
-        addr = cpu.registers[10] # a0
+        addr = r[10] # a0
         s = ""
         while True:
             char_code = cpu.memory.read_byte(addr)
@@ -432,12 +536,13 @@ class Ecall(System):
             addr += 1
         print(s, end="", flush=True)
     elif syscall_num == 10: # Exit
+        cpu.exit_code = r[10]
         cpu.halted = True
     else:
-        print(f"\n[System] Unknown syscall: {syscall_num} at PC=0x{cpu.pc:08X}")
-        cpu.halted = True
+        raise EnvironmentCall(f"\n[System] Unknown syscall: {syscall_num} at PC=0x{cpu.pc:08X}", pc=cpu.pc)
 
 class Ebreak(System):
+  __slots__ = ()
+
   def execute(self, cpu):
-    print(f"[System] EBREAK triggered at PC=0x{cpu.pc:08X}")
-    cpu.halted = True
+    raise Breakpoint(f"[System] EBREAK triggered at PC=0x{cpu.pc:08X}", pc=cpu.pc)
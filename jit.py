@@ -0,0 +1,428 @@
+"""
+This module provides the tiered JIT for the RISC-V emulator.
+Blocks start out interpreted; once a block has been entered often enough,
+Python source is generated for the superblock starting there and compiled
+with compile()/exec(). Registers live in local variables inside a
+superblock and are written back only when it exits.
+"""
+
+import io
+from contextlib import redirect_stdout
+
+import instructions as instr
+from cpu import RunResult, StopReason
+from registers import MASK32
+from traps import Trap
+
+# Exit status returned by a compiled superblock. A load or store that
+# traps returns the Trap itself as the status instead.
+EXIT_OK = 0
+EXIT_STACK = 2   # sp left the stack bounds after an 'sp' instruction.
+
+# Longest path, in instructions, that a superblock may contain.
+MAX_SUPERBLOCK = 256
+
+# Budget passed to superblocks when the run has no step limit.
+UNLIMITED = 1 << 62
+
+_R_EXPR = {
+  instr.Add: "({a} + {b}) & 0xFFFFFFFF",
+  instr.Sub: "({a} - {b}) & 0xFFFFFFFF",
+  instr.Sll: "({a} << ({b} & 0x1F)) & 0xFFFFFFFF",
+  instr.Slt: "1 if ({a} ^ 0x80000000) < ({b} ^ 0x80000000) else 0",
+  instr.Sltu: "1 if {a} < {b} else 0",
+  instr.Xor: "{a} ^ {b}",
+  instr.Srl: "{a} >> ({b} & 0x1F)",
+  instr.Sra: "((({a} ^ 0x80000000) - 0x80000000) >> ({b} & 0x1F)) & 0xFFFFFFFF",
+  instr.Or: "{a} | {b}",
+  instr.And: "{a} & {b}",
+  instr.Mul: "({a} * {b}) & 0xFFFFFFFF",
+}
+
+# {imm} is the sign-extended immediate, {uimm} the same value as 32 bits
+# and {shamt} its low five bits.
+_I_EXPR = {
+  instr.Addi: "({a} + {imm}) & 0xFFFFFFFF",
+  instr.Slti: "1 if (({a} ^ 0x80000000) - 0x80000000) < {imm} else 0",
+  instr.Sltiu: "1 if {a} < {uimm} else 0",
+  instr.Xori: "{a} ^ {uimm}",
+  instr.Ori: "{a} | {uimm}",
+  instr.Andi: "{a} & {uimm}",
+  instr.Slli: "({a} << {shamt}) & 0xFFFFFFFF",
+  instr.Srli: "{a} >> {shamt}",
+  instr.Srai: "((({a} ^ 0x80000000) - 0x80000000) >> {shamt}) & 0xFFFFFFFF",
+}
+
+_BRANCH_COND = {
+  instr.Beq: "{a} == {b}",
+  instr.Bne: "{a} != {b}",
+  instr.Blt: "({a} ^ 0x80000000) < ({b} ^ 0x80000000)",
+  instr.Bge: "({a} ^ 0x80000000) >= ({b} ^ 0x80000000)",
+  instr.Bltu: "{a} < {b}",
+  instr.Bgeu: "{a} >= {b}",
+}
+
+_LOADS = {instr.Lw: (4, True), instr.Lh: (2, True), instr.Lhu: (2, False),
+          instr.Lb: (1, True), instr.Lbu: (1, False)}
+_STORES = {instr.Sw: 4, instr.Sh: 2, instr.Sb: 1}
+
+# Instructions that never end a block.
+_STRAIGHT = set(_R_EXPR) | set(_I_EXPR) | set(_LOADS) | set(_STORES) | {instr.Lui, instr.Auipc, instr.Fence}
+
+class JITMismatch(Exception):
+  """
+  Raised in check mode when a superblock and the interpreter disagree.
+  """
+  pass
+
+class Superblock:
+  """
+  A compiled superblock: its start address, the longest path through it,
+  its generated source and the compiled function fn(r, mem, budget),
+  which returns (next_pc, steps, status).
+  """
+
+  __slots__ = ('start', 'max_length', 'source', 'fn')
+
+  def __init__(self, start, max_length, source, fn):
+    self.start = start
+    self.max_length = max_length
+    self.source = source
+    self.fn = fn
+
+def _reg(idx):
+  # Local variable (or constant) standing for register idx.
+  return f"x{idx}" if idx else "0"
+
+class _Emitter:
+  # Accumulates the body of one superblock.
+
+  def __init__(self, start, stack_bounds):
+    self.start = start
+    self.stack_bounds = stack_bounds
+    self.lines = []
+    self.read = set()
+    self.written = set()
+    self.max_length = 0
+
+  def use(self, *regs):
+    for idx in regs:
+      if idx: self.read.add(idx)
+
+  def define(self, idx):
+    self.written.add(idx)
+    # Registers are loaded at entry even when first written, so that every
+    # exit can write back the same set of locals.
+    self.read.add(idx)
+
+  def emit(self, depth, line):
+    self.lines.append("  " * depth + line)
+
+  def exit(self, depth, next_pc, steps, status=EXIT_OK):
+    # Leaves the superblock after `steps` instructions on this path.
+    self.max_length = max(self.max_length, steps)
+    self.emit(depth, "@WRITEBACK@")
+    self.emit(depth, f"return {next_pc}, n + {steps}, {status}")
+
+  def loop(self, depth, steps):
+    # Jumps back to the start of the superblock.
+    self.max_length = max(self.max_length, steps)
+    self.emit(depth, f"n += {steps}")
+    self.emit(depth, f"if n + @MAXLEN@ > budget:")
+    self.emit(depth + 1, "@WRITEBACK@")
+    self.emit(depth + 1, f"return {self.start}, n, {EXIT_OK}")
+    self.emit(depth, "continue")
+
+def _emit_straight(em, ins, addr, steps):
+  # Emits a straight-line instruction. Returns False if it is not supported.
+  cls = type(ins)
+  depth = 2
+  if cls in _R_EXPR:
+    em.use(ins.rs1, ins.rs2)
+    if ins.rd:
+      em.define(ins.rd)
+      expr = _R_EXPR[cls].format(a=_reg(ins.rs1), b=_reg(ins.rs2))
+      em.emit(depth, f"{_reg(ins.rd)} = {expr}")
+    return True
+  if cls in _I_EXPR:
+    em.use(ins.rs1)
+    if ins.rd:
+      em.define(ins.rd)
+      imm = ins.imm
+      expr = _I_EXPR[cls].format(a=_reg(ins.rs1), imm=imm, uimm=imm & MASK32, shamt=imm & 0x1F)
+      em.emit(depth, f"{_reg(ins.rd)} = {expr}")
+    return True
+  if cls in _LOADS:
+    size, signed = _LOADS[cls]
+    em.use(ins.rs1)
+    em.emit(depth, "try:")
+    em.emit(depth + 1, f"v = read(({_reg(ins.rs1)} + {ins.imm}) & 0xFFFFFFFF, {size}, {signed})")
+    em.emit(depth, "except Trap as e:")
+    em.exit(depth + 1, addr, steps, "e")
+    if ins.rd:
+      em.define(ins.rd)
+      em.emit(depth, f"{_reg(ins.rd)} = v & 0xFFFFFFFF")
+    return True
+  if cls in _STORES:
+    em.use(ins.rs1, ins.rs2)
+    em.emit(depth, "try:")
+    em.emit(depth + 1, f"write(({_reg(ins.rs1)} + {ins.imm}) & 0xFFFFFFFF, {_STORES[cls]}, {_reg(ins.rs2)})")
+    em.emit(depth, "except Trap as e:")
+    em.exit(depth + 1, addr, steps, "e")
+    return True
+  if cls is instr.Lui or cls is instr.Auipc:
+    if ins.rd:
+      value = ins.imm << 12
+      if cls is instr.Auipc:
+        value = (addr + value) & MASK32
+      em.define(ins.rd)
+      em.emit(depth, f"{_reg(ins.rd)} = {value}")
+    return True
+  if cls is instr.Fence:
+    return True
+  return False
+
+def generate(program, start, stack_bounds, max_length=MAX_SUPERBLOCK):
+  # Generates the source of the superblock starting at start, following
+  # fall-through and statically known jal targets. Returns (source, max
+  # path length), or None if the first instruction cannot be compiled.
+  em = _Emitter(start, stack_bounds)
+  limit, base = stack_bounds
+  depth = 2
+  addr = start
+  steps = 0
+  visited = set()
+  while True:
+    entry = program.get(addr)
+    if entry is None or len(entry) != 1 or addr in visited or steps >= max_length:
+      if steps == 0:
+        return None
+      em.exit(depth, addr, steps)
+      break
+    visited.add(addr)
+    ins = entry[0]
+    cls = type(ins)
+    em.emit(depth, f"# 0x{addr:08X}: {cls.__name__}")
+    if _emit_straight(em, ins, addr, steps):
+      steps += 1
+      next_addr = addr + 4
+    elif cls in _BRANCH_COND:
+      em.use(ins.rs1, ins.rs2)
+      target = (addr + ins.imm) & MASK32
+      cond = _BRANCH_COND[cls].format(a=_reg(ins.rs1), b=_reg(ins.rs2))
+      steps += 1
+      em.emit(depth, f"if {cond}:")
+      if "use_sp" in ins.tags:
+        # The stack check runs whichever way the branch goes.
+        em.use(2)
+        em.emit(depth + 1, f"if not {limit} <= x2 <= {base}:")
+        em.exit(depth + 2, target, steps, EXIT_STACK)
+      if target == start:
+        em.loop(depth + 1, steps)
+      else:
+        em.exit(depth + 1, target, steps)
+      next_addr = addr + 4
+    elif cls is instr.Jal:
+      target = (addr + ins.imm) & MASK32
+      if ins.rd:
+        em.define(ins.rd)
+        em.emit(depth, f"{_reg(ins.rd)} = {(addr + 4) & MASK32}")
+      steps += 1
+      if "use_sp" in ins.tags:
+        em.use(2)
+        em.emit(depth, f"if not {limit} <= x2 <= {base}:")
+        em.exit(depth + 1, target, steps, EXIT_STACK)
+      if target == start:
+        em.loop(depth, steps)
+        break
+      addr = target
+      continue
+    elif cls is instr.Jalr:
+      em.use(ins.rs1)
+      em.emit(depth, f"t = ({_reg(ins.rs1)} + {ins.imm}) & 0xFFFFFFFE")
+      if ins.rd:
+        em.define(ins.rd)
+        em.emit(depth, f"{_reg(ins.rd)} = {(addr + 4) & MASK32}")
+      steps += 1
+      if "use_sp" in ins.tags:
+        em.use(2)
+        em.emit(depth, f"if not {limit} <= x2 <= {base}:")
+        em.exit(depth + 1, "t", steps, EXIT_STACK)
+      em.exit(depth, "t", steps)
+      break
+    else:
+      # System, meta or unknown instructions are left to the interpreter.
+      if steps == 0:
+        return None
+      em.exit(depth, addr, steps)
+      break
+    if "use_sp" in ins.tags:
+      em.use(2)
+      em.emit(depth, f"if not {limit} <= x2 <= {base}:")
+      em.exit(depth + 1, next_addr, steps, EXIT_STACK)
+    addr = next_addr
+
+  regs = sorted(em.read | em.written)
+  writeback = "; ".join(f"r[{i}] = x{i}" for i in sorted(em.written)) or "pass"
+  out = [f"def superblock_{start:08x}(r, mem, budget):",
+         "  read = mem.read",
+         "  write = mem.write"]
+  if regs:
+    out.append("  " + ", ".join(f"x{i}" for i in regs) + " = " + ", ".join(f"r[{i}]" for i in regs))
+  out.append("  n = 0")
+  out.append("  while True:")
+  for line in em.lines:
+    stripped = line.lstrip()
+    indent = line[:len(line) - len(stripped)]
+    if stripped == "@WRITEBACK@":
+      line = indent + writeback
+    out.append(line.replace("@MAXLEN@", str(em.max_length)))
+  return "\n".join(out) + "\n", em.max_length
+
+def _memory_image(memory):
+  # Comparable view of a memory's contents, for check mode.
+  contents = memory.snapshot().contents
+  if isinstance(contents, dict):
+    return {num: bytes(page) for num, page in contents.items() if any(page)}
+  return contents
+
+class JIT:
+  """
+  Tiered execution engine. Blocks are interpreted and counted until they
+  have been entered `threshold` times, then compiled as superblocks.
+  With dump set to a text stream, every generated source is written to it.
+  With check=True, every superblock execution is replayed on the
+  interpreter and the resulting state compared.
+  """
+
+  def __init__(self, program=None, threshold=50, dump=None, check=False):
+    self.program = program
+    self.threshold = threshold
+    self.dump = dump
+    self.check = check
+    # pc -> Superblock, or None if the code at pc cannot be compiled.
+    self.superblocks = {}
+    self.counts = {}
+    self.block_lengths = {}
+    self.stack_bounds = None
+    self.jit_steps = 0
+
+  def invalidate(self, program=None):
+    # Drops all compiled code and counters, optionally switching program.
+    if program is not None:
+      self.program = program
+    self.superblocks = {}
+    self.counts = {}
+    self.block_lengths = {}
+
+  def compile(self, pc):
+    # Generates and compiles the superblock starting at pc.
+    generated = generate(self.program, pc, self.stack_bounds)
+    if generated is None:
+      self.superblocks[pc] = None
+      return None
+    source, max_length = generated
+    if self.dump is not None:
+      self.dump.write(f"# --- superblock at 0x{pc:08X} ---\n{source}\n")
+    namespace = {"Trap": Trap}
+    exec(compile(source, f"<superblock 0x{pc:08X}>", "exec"), namespace)
+    sb = Superblock(pc, max_length, source, namespace[f"superblock_{pc:08x}"])
+    self.superblocks[pc] = sb
+    return sb
+
+  def _block_length(self, pc):
+    # Instructions from pc up to and including the next control transfer,
+    # system or meta instruction; this is one tier-0 dispatch.
+    length = self.block_lengths.get(pc)
+    if length is None:
+      length = 0
+      addr = pc
+      while True:
+        entry = self.program.get(addr)
+        if entry is None:
+          break
+        length += 1
+        addr += 4
+        if type(entry[0]) not in _STRAIGHT:
+          break
+      self.block_lengths[pc] = length
+    return length
+
+  def _run_checked(self, cpu, sb, r, mem, budget):
+    # Runs sb, then replays the same steps on the interpreter and compares.
+    # A trapping superblock is replayed up to and including the trapping
+    # instruction, and the trap kind and pc are compared instead of halted.
+    before = cpu.snapshot()
+    next_pc, steps, status = sb.fn(r, mem, budget)
+    trapped = isinstance(status, Trap)
+    jit_end = (type(status).__name__, next_pc) if trapped else status != EXIT_OK
+    jit_state = (tuple(r), next_pc, jit_end, _memory_image(mem))
+    cpu.restore(before)
+    with redirect_stdout(io.StringIO()):
+      cpu.run(self.program, max_steps=steps + 1 if trapped else steps)
+    if trapped:
+      ref_end = (type(cpu.trap).__name__, cpu.pc) if cpu.trap is not None else None
+    else:
+      ref_end = cpu.halted
+    ref_state = (tuple(r), cpu.pc, ref_end, _memory_image(mem))
+    if jit_state != ref_state:
+      diffs = [f"x{i}: jit=0x{a:08X} interp=0x{b:08X}"
+               for i, (a, b) in enumerate(zip(jit_state[0], ref_state[0])) if a != b]
+      if jit_state[1] != ref_state[1]:
+        diffs.append(f"pc: jit=0x{jit_state[1]:08X} interp=0x{ref_state[1]:08X}")
+      if jit_state[2] != ref_state[2]:
+        diffs.append(f"{'trap' if trapped else 'halted'}: jit={jit_state[2]} interp={ref_state[2]}")
+      if jit_state[3] != ref_state[3]:
+        diffs.append("memory contents differ")
+      raise JITMismatch(f"Superblock 0x{sb.start:08X} diverged after {steps} steps: " + ", ".join(diffs))
+    cpu.halted = False
+    cpu.trap = None
+    return next_pc, steps, status
+
+  def run(self, cpu, program=None, max_steps=None):
+    # Runs from cpu.pc like CPU.run(), switching to compiled superblocks
+    # for hot code. Passing a different program invalidates compiled code.
+    if program is not None and program is not self.program:
+      self.invalidate(program)
+    bounds = (cpu.stack_limit, cpu.stack_base)
+    if bounds != self.stack_bounds:
+      self.invalidate()
+      self.stack_bounds = bounds
+    superblocks, counts = self.superblocks, self.counts
+    threshold = self.threshold
+    r = cpu.registers.regs
+    mem = cpu.memory
+    steps = 0
+    while True:
+      budget = UNLIMITED if max_steps is None else max_steps - steps
+      if budget <= 0:
+        return RunResult(StopReason.STEP_LIMIT, steps, cpu.pc)
+      pc = cpu.pc
+      sb = superblocks.get(pc)
+      if sb is None and pc not in superblocks:
+        count = counts.get(pc, 0) + 1
+        counts[pc] = count
+        if count >= threshold:
+          sb = self.compile(pc)
+      if sb is not None and sb.max_length <= budget:
+        if self.check:
+          next_pc, n, status = self._run_checked(cpu, sb, r, mem, budget)
+        else:
+          next_pc, n, status = sb.fn(r, mem, budget)
+        cpu.pc = next_pc
+        steps += n
+        self.jit_steps += n
+        if status == EXIT_OK:
+          continue
+        if status == EXIT_STACK:
+          cpu._check_stack()
+          return RunResult(StopReason.HALT, steps, cpu.pc)
+        cpu._take_trap(status, next_pc)
+        return RunResult(StopReason.TRAP, steps, cpu.pc)
+      length = self._block_length(pc)
+      if length == 0:
+        return cpu._end(pc, steps)
+      result = cpu.run(self.program, max_steps=min(length, budget))
+      steps += result.steps
+      if result.reason != StopReason.STEP_LIMIT:
+        return RunResult(result.reason, steps, cpu.pc)
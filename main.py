@@ -3,71 +3,291 @@ This is the main entry point for the RISC-V 32I assembly emulator.
 It provides a command-line interface to load and execute RISC-V programs.
 """
 
+import os
 import sys
+import zlib
 import argparse
 from cpu import CPU
 from parser import Parser
+from cache import ParseCache
+from translator import BlockTranslator
+from jit import JIT
+from program import CompactProgram
+from fusion import fuse, fused_count
+from peephole import optimize
+from hooks import attach
+from profiler import (Profile, CallGraph, Symbols, write_report, write_listing, write_collapsed,
+                      write_call_report, write_callgrind)
+from objfile import is_object, load_object, write_object, SUFFIX
+from tracefile import TraceWriter, read_trace
+from traps import AssertionFailure
 
-def main():
-  # Set up command-line argument parsing.
-  parser = argparse.ArgumentParser(description="RISC-V 32I Assembly Emulator")
-  parser.add_argument("source", help="The RISC-V assembly file to execute")
-  parser.add_argument("--trace", action="store_true", help="Print PC at each step")
-  
-  args = parser.parse_args()
+def assemble(argv):
+  # 'main.py assemble prog.s [-o prog.rvo]': parse once and write an object file.
+  parser = argparse.ArgumentParser(prog="main.py assemble", description="Assemble a program into a .rvo object file")
+  parser.add_argument("source", help="The RISC-V assembly file to assemble")
+  parser.add_argument("-o", "--output", help="Object file to write (default: source with a .rvo suffix)")
+  args = parser.parse_args(argv)
+  output = args.output or os.path.splitext(args.source)[0] + SUFFIX
 
-  # Read the source file.
+  # Stream the source: generated programs can be far larger than memory.
   try:
     with open(args.source, 'r') as f:
-      source_code = f.read()
-  except Exception as e:
+      parse_result = Parser().parse_stream(f)
+  except OSError as e:
     print(f"Error reading source file: {e}")
     sys.exit(1)
-
-  # Parse the program.
-  asm_parser = Parser()
-  try:
-    parse_result = asm_parser.parse_program(source_code)
-    instruction_map = parse_result['instructions']
-    data_map = parse_result['data']
-    start_addr = parse_result['start_addr']
   except Exception as e:
     print(f"Error parsing program: {e}")
     sys.exit(1)
+  try:
+    write_object(output, parse_result)
+  except Exception as e:
+    print(f"Error writing object file: {e}")
+    sys.exit(1)
+
+def dump_trace(argv):
+  # 'main.py dump-trace prog.rvt': print a binary trace as text.
+  parser = argparse.ArgumentParser(prog="main.py dump-trace", description="Print a --trace file as text")
+  parser.add_argument("trace", help="The trace file to print")
+  args = parser.parse_args(argv)
+  try:
+    with open(args.trace, 'rb') as f:
+      for record in read_trace(f):
+        line = f"0x{record.pc:08X} {record.instruction or '?'}"
+        if record.rd is not None:
+          line += f" x{record.rd}=0x{record.value:08X}"
+        if record.mem_op:
+          line += f" {record.mem_op} [0x{record.addr:08X}]=0x{record.data:X}"
+        if record.fault:
+          line += " fault"
+        print(line)
+  except (OSError, ValueError, zlib.error) as e:
+    print(f"Error reading trace: {e}")
+    sys.exit(1)
+
+def write_profile(args, parse_result, profile):
+  # Prints the --profile hot spots and writes the listing and collapsed
+  # stacks, and with --call-graph the function table and callgrind file.
+  symbols = Symbols(parse_result['labels'])
+  write_report(profile, symbols, sys.stdout)
+  if profile.calls is not None:
+    profile.calls.finish()
+    write_call_report(profile.calls, sys.stdout)
+  prefix = args.profile_prefix or os.path.splitext(args.source)[0]
+  try:
+    with open(prefix + ".folded", 'w') as out:
+      write_collapsed(profile, symbols, out)
+    if profile.calls is not None:
+      with open(prefix + ".callgrind", 'w') as out:
+        write_callgrind(profile, out, command=args.source)
+    if not is_object(args.source):
+      # Object files carry no source to annotate.
+      with open(args.source, 'r') as f:
+        line_table = Parser().line_table(f)
+      with open(args.source, 'r') as f, open(prefix + ".lst", 'w') as out:
+        write_listing(profile, f, line_table, out)
+  except OSError as e:
+    print(f"Error writing profile: {e}")
+    sys.exit(1)
+
+def main():
+  if sys.argv[1:2] == ["assemble"]:
+    return assemble(sys.argv[2:])
+  if sys.argv[1:2] == ["dump-trace"]:
+    return dump_trace(sys.argv[2:])
+
+  # Set up command-line argument parsing.
+  parser = argparse.ArgumentParser(description="RISC-V 32I Assembly Emulator")
+  parser.add_argument("source", help="The RISC-V assembly file or .rvo object file to execute "
+                                     "(run 'main.py assemble prog.s' to build one)")
+  parser.add_argument("--trace", metavar="FILE",
+                      help="Write a binary record of every executed instruction to FILE, on the interpreter "
+                           "(print it with 'main.py dump-trace FILE')")
+  parser.add_argument("--trace-compress", action="store_true", help="zlib-compress the --trace file as it is written")
+  parser.add_argument("--trace-ring", type=int, metavar="N",
+                      help="Keep only the last N --trace records, written if the run stops other than by exiting")
+  parser.add_argument("--paged", action="store_true", help="Use sparse paged memory covering the full 32-bit address space")
+  parser.add_argument("--engine", choices=["interp", "block", "jit", "compact"], default="interp",
+                      help="Execution engine: the instruction interpreter, the basic-block translator, "
+                           "the tiered JIT or table dispatch over the compact array program")
+  parser.add_argument("--jit-threshold", type=int, default=50, help="Block entries before the JIT compiles a superblock")
+  parser.add_argument("--jit-dump", action="store_true", help="Write the source of each compiled superblock to stderr")
+  parser.add_argument("--jit-check", action="store_true", help="Replay every superblock on the interpreter and compare state")
+  parser.add_argument("--no-cache", action="store_true", help="Always parse the source instead of using the on-disk parse cache")
+  parser.add_argument("--stream", action="store_true", help="Parse the source line by line into the compact form, "
+                                                             "bounding memory for very large programs (implies --no-cache)")
+  parser.add_argument("--lazy", action="store_true",
+                      help="Only lay out the program up front and parse each line when it first executes "
+                           "(implies --no-cache; not with --engine compact)")
+  parser.add_argument("--validate", action="store_true",
+                      help="With --lazy, parse every line before running and report all syntax errors")
+  parser.add_argument("--parse-workers", type=int, default=None,
+                      help="Run the second parser pass of large programs in this many processes")
+  parser.add_argument("--peephole", action="store_true",
+                      help="Collapse no-ops and constant chains at load time with the interp and compact engines")
+  parser.add_argument("--fuse", action="store_true",
+                      help="Dispatch common instruction pairs (li, la, lw label, far call, ALU + branch) as one fused "
+                           "operation with the interp and compact engines")
+  parser.add_argument("-O", "--no-meta", action="store_true",
+                      help="Strip @assert, @print and @print_mem lines; the run never checks for them")
+  parser.add_argument("--profile", action="store_true",
+                      help="Count executions per instruction (on the interpreter), print the hottest addresses at "
+                           "exit and write an annotated listing (.lst) and collapsed stacks (.folded)")
+  parser.add_argument("--call-graph", action="store_true",
+                      help="Profile with a shadow call stack (implies --profile): print inclusive and exclusive "
+                           "counts per function and write a callgrind file (.callgrind)")
+  parser.add_argument("--profile-prefix",
+                      help="Path prefix of the --profile output files (default: the source path without its suffix)")
+  parser.add_argument("--stats", action="store_true", help="Print execution statistics at exit")
+  
+  args = parser.parse_args()
+  if args.trace_ring is not None and args.trace_ring < 1:
+    parser.error("--trace-ring must be at least 1")
+  if args.validate and not args.lazy:
+    parser.error("--validate requires --lazy")
+  if args.lazy and args.engine == "compact":
+    # The compact form encodes every line up front, which defeats --lazy.
+    parser.error("--lazy cannot be used with --engine compact")
+
+  if is_object(args.source):
+    # Object files are mapped directly, with no parsing.
+    try:
+      parse_result = load_object(args.source)
+    except Exception as e:
+      print(f"Error loading object file: {e}")
+      sys.exit(1)
+  elif args.stream:
+    try:
+      with open(args.source, 'r') as f:
+        parse_result = Parser().parse_stream(f)
+    except OSError as e:
+      print(f"Error reading source file: {e}")
+      sys.exit(1)
+    except Exception as e:
+      print(f"Error parsing program: {e}")
+      sys.exit(1)
+  else:
+    # Read the source file.
+    try:
+      with open(args.source, 'r') as f:
+        source_code = f.read()
+    except Exception as e:
+      print(f"Error reading source file: {e}")
+      sys.exit(1)
+
+    # Parse the program.
+    asm_parser = Parser(workers=args.parse_workers, lazy=args.lazy)
+    try:
+      if args.no_cache or args.lazy:
+        parse_result = asm_parser.parse_program(source_code)
+      else:
+        parse_result = ParseCache().parse(source_code, asm_parser)
+    except Exception as e:
+      print(f"Error parsing program: {e}")
+      sys.exit(1)
+
+  instruction_map = parse_result['instructions']
+  segments = parse_result['segments']
+  start_addr = parse_result['start_addr']
+
+  if args.validate and hasattr(instruction_map, 'validate'):
+    errors = instruction_map.validate()
+    for trap in errors:
+      print(trap.message)
+    if errors:
+      sys.exit(1)
+
+  if isinstance(instruction_map, CompactProgram) and args.engine != "compact":
+    # The other engines work on instruction objects; decode them once.
+    instruction_map = dict(instruction_map.items())
+
+  if not args.no_meta:
+    # Meta lines run as hooks on the address of the instruction they precede.
+    instruction_map = attach(instruction_map, parse_result['hooks'], parse_result['fallthrough_hooks'])
+
+  # Load-time rewrites for the engines that dispatch every instruction. The
+  # block and JIT engines already run straight-line code as one unit, and
+  # lazily parsed programs are left as they are rather than decoded up front.
+  rewrite = args.engine in ("interp", "compact") and not getattr(instruction_map, 'lazy', False)
+  eliminated = fused = None
+  if args.peephole and rewrite:
+    instruction_map, eliminated = optimize(instruction_map)
+  if args.fuse and rewrite:
+    instruction_map = fuse(instruction_map)
+    fused = fused_count(instruction_map)
 
   # Initialize the CPU.
-  cpu = CPU()
+  cpu = CPU(paged=args.paged)
   
   # Reset CPU to start address
   cpu.reset(start_pc=start_addr)
 
-  # Load data into memory
-  for addr, val in data_map.items():
-    cpu.memory.write_byte(addr, val)
+  # Load data into memory, one bulk copy per segment
+  for base, chunk in segments:
+    cpu.memory.load_segment(base, chunk)
   
+  if args.call_graph:
+    profile = Profile(CallGraph(Symbols(parse_result['labels'])))
+  else:
+    profile = Profile() if args.profile else None
+
+  trace_file = trace = None
+  if args.trace:
+    try:
+      trace_file = open(args.trace, 'wb')
+    except OSError as e:
+      print(f"Error writing trace: {e}")
+      sys.exit(1)
+    trace = TraceWriter(trace_file, compress=args.trace_compress, ring=args.trace_ring)
+
   # Execution loop.
   try:
-    while not cpu.halted:
-      if args.trace:
-        print(f"Trace: PC=0x{cpu.pc:08X}")
-      
-      cpu.step(instruction_map)
-      
-      # If PC goes beyond instruction map and no jump occurred, we stop.
-      if cpu.pc not in instruction_map and not cpu.halted:
-        break
-    
-    if cpu.halted and cpu.registers[17] != 10: # a7=10 is clean exit
-      # If we halted due to an error, exit 1.
-      # Syscall 10 (Exit) is not an error.
-      pass
-        
-  except AssertionError:
-    # Assertion error already printed a message.
-    sys.exit(1)
+    if profile is not None or trace is not None:
+      # Counting and tracing run on the interpreter whatever the engine.
+      result = cpu.run(instruction_map, profile=profile, trace=trace)
+      if args.stats:
+        print(f"[Stats] {result.steps} instructions")
+    elif args.engine == "block":
+      translator = BlockTranslator(instruction_map)
+      result = translator.run(cpu)
+      if args.stats:
+        print(f"[Stats] {result.steps} instructions, {len(translator.blocks)} blocks, "
+              f"hit rate {translator.hit_rate:.1%}")
+    elif args.engine == "jit":
+      jit = JIT(instruction_map, threshold=args.jit_threshold,
+                dump=sys.stderr if args.jit_dump else None, check=args.jit_check)
+      result = jit.run(cpu)
+      if args.stats:
+        print(f"[Stats] {result.steps} instructions, {len(jit.superblocks)} superblocks, "
+              f"{jit.jit_steps} compiled")
+    elif args.engine == "compact":
+      compact = instruction_map if isinstance(instruction_map, CompactProgram) else CompactProgram(instruction_map)
+      result = compact.run(cpu)
+      if args.stats:
+        print(f"[Stats] {result.steps} instructions, {len(compact)} encoded in {compact.nbytes} bytes")
+    else:
+      result = cpu.run(instruction_map)
+      if args.stats:
+        print(f"[Stats] {result.steps} instructions")
   except Exception as e:
     print(f"Runtime Error: {e}")
     sys.exit(1)
+  finally:
+    if trace is not None:
+      trace.close()
+      trace_file.close()
+  if args.stats and eliminated is not None:
+    print(f"[Stats] {eliminated} instructions eliminated by the peephole pass")
+  if args.stats and fused is not None:
+    print(f"[Stats] {fused} fused instruction pairs")
+
+  if profile is not None:
+    write_profile(args, parse_result, profile)
+
+  if isinstance(cpu.trap, AssertionFailure):
+    # The run loop already printed the assertion message.
+    sys.exit(1)
 
 if __name__ == "__main__":
   main()
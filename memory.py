@@ -4,16 +4,62 @@ It implements byte-addressable memory with support for various data types.
 """
 
 import struct
+import sys
+
+from traps import LoadAccessFault, StoreAccessFault
+
+# Little-endian accessors for each access width: (unsigned, signed).
+_FORMATS = {1: ('B', 'b'), 2: ('H', 'h'), 4: ('I', 'i')}
+_STRUCTS = {
+  size: (struct.Struct('<' + u), struct.Struct('<' + s))
+  for size, (u, s) in _FORMATS.items()
+}
+_MASKS = {1: 0xFF, 2: 0xFFFF, 4: 0xFFFFFFFF}
+_SHIFTS = {1: 0, 2: 1, 4: 2}
+
+# memoryview casts use the host byte order, so they are only a valid
+# shortcut for little-endian accesses on a little-endian host.
+_NATIVE_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+# Page geometry used for sparse allocation and snapshot dirty tracking.
+PAGE_SHIFT = 12
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_MASK = PAGE_SIZE - 1
+
+class MemorySnapshot:
+  """
+  An immutable capture of a memory's contents, created by Memory.snapshot().
+  """
+
+  __slots__ = ('owner', 'contents')
+
+  def __init__(self, owner, contents):
+    # The memory the snapshot was taken from.
+    self.owner = owner
+    # bytes for Memory, {page number: bytearray} for PagedMemory.
+    self.contents = contents
 
 class Memory:
   """
-  A byte-addressable memory model using a pre-allocated list.
-  Default size is 64KB. Includes bounds checking.
+  A byte-addressable memory model backed by a pre-allocated bytearray.
+  Default size is 64KB. Out-of-bounds accesses raise LoadAccessFault or
+  StoreAccessFault.
   """
 
   def __init__(self, size=65536):
     self.size = size
-    self._data = [0] * size
+    self._data = bytearray(size)
+    self._view = memoryview(self._data)
+    # Typed views for naturally aligned half/word access: size -> (unsigned, signed).
+    self._aligned = {}
+    if _NATIVE_LITTLE_ENDIAN:
+      for width in (2, 4):
+        if size % width == 0:
+          u, s = _FORMATS[width]
+          self._aligned[width] = (self._view.cast(u), self._view.cast(s))
+    # Pages written since the last snapshot/restore, and that snapshot.
+    self._dirty = set()
+    self._baseline = None
 
   def _check_bounds(self, addr, size):
     # Returns True if access is valid, False otherwise.
@@ -21,46 +67,84 @@ class Memory:
       return False
     return True
 
+  def snapshot(self):
+    # Captures the current contents and starts tracking dirty pages against them.
+    snap = MemorySnapshot(self, bytes(self._data))
+    self._dirty = set()
+    self._baseline = snap
+    return snap
+
+  def restore(self, snap):
+    # Rolls memory back to a snapshot. Restoring the most recent snapshot
+    # only rewrites the pages dirtied since it was taken.
+    if len(snap.contents) != self.size:
+      raise ValueError("Snapshot size does not match memory size")
+    if snap is self._baseline:
+      data, contents = self._data, snap.contents
+      for page_num in self._dirty:
+        start = page_num << PAGE_SHIFT
+        data[start:start + PAGE_SIZE] = contents[start:start + PAGE_SIZE]
+    else:
+      self._data[:] = snap.contents
+    self._dirty = set()
+    self._baseline = snap
+
+  def load_segment(self, addr, buffer):
+    # Copies a bytes-like buffer into memory at addr with a single bounds check.
+    size = len(buffer)
+    if not self._check_bounds(addr, size):
+      raise StoreAccessFault(f"Memory Error: Segment out of bounds at 0x{addr:08X} (size {size})", addr=addr)
+    if not size:
+      return
+    self._data[addr:addr + size] = buffer
+    self._dirty.update(range(addr >> PAGE_SHIFT, ((addr + size - 1) >> PAGE_SHIFT) + 1))
+
   def write_byte(self, addr, value):
     # Writes a single byte to memory with bounds checking.
     if not self._check_bounds(addr, 1):
-      print(f"Memory Error: Write out of bounds at 0x{addr:08X}")
-      return False
+      raise StoreAccessFault(f"Memory Error: Write out of bounds at 0x{addr:08X}", addr=addr)
     self._data[addr] = value & 0xFF
-    return True
+    self._dirty.add(addr >> PAGE_SHIFT)
 
   def read_byte(self, addr):
     # Reads a single byte from memory with bounds checking.
     if not self._check_bounds(addr, 1):
-      print(f"Memory Error: Read out of bounds at 0x{addr:08X}")
-      return 0
+      raise LoadAccessFault(f"Memory Error: Read out of bounds at 0x{addr:08X}", addr=addr)
     return self._data[addr]
 
   def write(self, addr, size, value):
     # Writes multiple bytes in little-endian format.
-    if not self._check_bounds(addr, size):
-      print(f"Memory Error: Write out of bounds at 0x{addr:08X} (size {size})")
-      return False
-    for i in range(size):
-      self._data[addr + i] = (value >> (i * 8)) & 0xFF
-    return True
+    if addr < 0 or (addr + size) > self.size:
+      raise StoreAccessFault(f"Memory Error: Write out of bounds at 0x{addr:08X} (size {size})", addr=addr)
+    self._dirty.add(addr >> PAGE_SHIFT)
+    if size == 1:
+      self._data[addr] = value & 0xFF
+      return
+    if (addr & PAGE_MASK) + size > PAGE_SIZE:
+      self._dirty.update(range((addr >> PAGE_SHIFT) + 1, ((addr + size - 1) >> PAGE_SHIFT) + 1))
+    views = self._aligned.get(size)
+    if views is not None and not addr & (size - 1):
+      views[0][addr >> _SHIFTS[size]] = value & _MASKS[size]
+    elif size in _STRUCTS:
+      _STRUCTS[size][0].pack_into(self._data, addr, value & _MASKS[size])
+    else:
+      self._data[addr:addr + size] = (value & ((1 << (size * 8)) - 1)).to_bytes(size, 'little')
 
   def read(self, addr, size, signed=False):
     # Reads multiple bytes in little-endian format.
-    if not self._check_bounds(addr, size):
-      print(f"Memory Error: Read out of bounds at 0x{addr:08X} (size {size})")
-      return None
-    
-    value = 0
-    for i in range(size):
-      value |= self._data[addr + i] << (i * 8)
-    
-    if signed:
-      bits = size * 8
-      if value & (1 << (bits - 1)):
-        value -= 1 << bits
-    
-    return value
+    if addr < 0 or (addr + size) > self.size:
+      raise LoadAccessFault(f"Memory Error: Read out of bounds at 0x{addr:08X} (size {size})", addr=addr)
+    if size == 1:
+      value = self._data[addr]
+      if signed and value & 0x80:
+        value -= 0x100
+      return value
+    views = self._aligned.get(size)
+    if views is not None and not addr & (size - 1):
+      return views[signed][addr >> _SHIFTS[size]]
+    if size in _STRUCTS:
+      return _STRUCTS[size][signed].unpack_from(self._data, addr)[0]
+    return int.from_bytes(self._data[addr:addr + size], 'little', signed=signed)
 
   def read_typed(self, addr, type_str):
     # Reads a value based on a type string.
@@ -68,7 +152,7 @@ class Memory:
     size_key = type_str[1:] if type_str[0] in 'ui' else type_str
     if size_key not in size_map:
       raise ValueError(f"Unsupported memory type size: {type_str}")
-    
+
     signed = type_str.startswith('i')
     size = size_map[size_key]
     return self.read(addr, size, signed)
@@ -79,6 +163,130 @@ class Memory:
     size_key = type_str[1:] if type_str[0] in 'ui' else type_str
     if size_key not in size_map:
       raise ValueError(f"Unsupported memory type size: {type_str}")
-    
+
     size = size_map[size_key]
     return self.write(addr, size, value)
+
+class PagedMemory(Memory):
+  """
+  A sparse memory model covering the full 32-bit address space.
+  4KB pages are allocated on first write; untouched pages read as zero.
+  """
+
+  def __init__(self, size=1 << 32):
+    self.size = size
+    # page number -> bytearray(PAGE_SIZE), used for reads.
+    self._pages = {}
+    # The subset of _pages that is private to this memory and may be written
+    # in place. Pages missing here are shared with the baseline snapshot and
+    # are copied on their first write, so its keys are also the dirty set.
+    self._writable = {}
+    self._baseline = None
+
+  @property
+  def resident_pages(self):
+    # Number of pages that have been allocated so far.
+    return len(self._pages)
+
+  def _page_for_write(self, page_num):
+    # Returns a writable page for page_num, allocating or copying it on first use.
+    page = self._writable.get(page_num)
+    if page is None:
+      shared = self._pages.get(page_num)
+      page = bytearray(shared) if shared is not None else bytearray(PAGE_SIZE)
+      self._pages[page_num] = self._writable[page_num] = page
+    return page
+
+  def snapshot(self):
+    # Captures the current pages. No data is copied: every page becomes
+    # shared and is only duplicated when it is next written.
+    snap = MemorySnapshot(self, dict(self._pages))
+    self._writable = {}
+    self._baseline = snap
+    return snap
+
+  def restore(self, snap):
+    # Rolls memory back to a snapshot. Restoring the most recent snapshot
+    # only touches the pages dirtied since it was taken.
+    if not isinstance(snap.contents, dict):
+      raise ValueError("Snapshot was not taken from a paged memory")
+    if snap is self._baseline:
+      pages, contents = self._pages, snap.contents
+      for page_num in self._writable:
+        shared = contents.get(page_num)
+        if shared is None:
+          del pages[page_num]
+        else:
+          pages[page_num] = shared
+    else:
+      self._pages = dict(snap.contents)
+    self._writable = {}
+    self._baseline = snap
+
+  def load_segment(self, addr, buffer):
+    # Copies a bytes-like buffer into memory at addr, one slice per page.
+    size = len(buffer)
+    if not self._check_bounds(addr, size):
+      raise StoreAccessFault(f"Memory Error: Segment out of bounds at 0x{addr:08X} (size {size})", addr=addr)
+    src = memoryview(buffer)
+    done = 0
+    while done < size:
+      a = addr + done
+      offset = a & PAGE_MASK
+      n = min(PAGE_SIZE - offset, size - done)
+      self._page_for_write(a >> PAGE_SHIFT)[offset:offset + n] = src[done:done + n]
+      done += n
+
+  def write_byte(self, addr, value):
+    # Writes a single byte to memory with bounds checking.
+    if not self._check_bounds(addr, 1):
+      raise StoreAccessFault(f"Memory Error: Write out of bounds at 0x{addr:08X}", addr=addr)
+    self._page_for_write(addr >> PAGE_SHIFT)[addr & PAGE_MASK] = value & 0xFF
+
+  def read_byte(self, addr):
+    # Reads a single byte from memory with bounds checking.
+    if not self._check_bounds(addr, 1):
+      raise LoadAccessFault(f"Memory Error: Read out of bounds at 0x{addr:08X}", addr=addr)
+    page = self._pages.get(addr >> PAGE_SHIFT)
+    return page[addr & PAGE_MASK] if page is not None else 0
+
+  def write(self, addr, size, value):
+    # Writes multiple bytes in little-endian format.
+    if addr < 0 or (addr + size) > self.size:
+      raise StoreAccessFault(f"Memory Error: Write out of bounds at 0x{addr:08X} (size {size})", addr=addr)
+    offset = addr & PAGE_MASK
+    if offset + size <= PAGE_SIZE:
+      page_num = addr >> PAGE_SHIFT
+      page = self._writable.get(page_num) or self._page_for_write(page_num)
+      if size == 1:
+        page[offset] = value & 0xFF
+      elif size in _STRUCTS:
+        _STRUCTS[size][0].pack_into(page, offset, value & _MASKS[size])
+      else:
+        page[offset:offset + size] = (value & ((1 << (size * 8)) - 1)).to_bytes(size, 'little')
+      return
+    # The access straddles a page boundary; fall back to byte stores.
+    for i in range(size):
+      a = addr + i
+      self._page_for_write(a >> PAGE_SHIFT)[a & PAGE_MASK] = (value >> (i * 8)) & 0xFF
+
+  def read(self, addr, size, signed=False):
+    # Reads multiple bytes in little-endian format.
+    if addr < 0 or (addr + size) > self.size:
+      raise LoadAccessFault(f"Memory Error: Read out of bounds at 0x{addr:08X} (size {size})", addr=addr)
+    offset = addr & PAGE_MASK
+    if offset + size <= PAGE_SIZE:
+      page = self._pages.get(addr >> PAGE_SHIFT)
+      if page is None:
+        return 0
+      if size in _STRUCTS:
+        return _STRUCTS[size][signed].unpack_from(page, offset)[0]
+      return int.from_bytes(page[offset:offset + size], 'little', signed=signed)
+    # The access straddles a page boundary; gather the bytes one by one.
+    raw = bytearray(size)
+    for i in range(size):
+      a = addr + i
+      page = self._pages.get(a >> PAGE_SHIFT)
+      if page is not None:
+        raw[i] = page[a & PAGE_MASK]
+    return int.from_bytes(raw, 'little', signed=signed)
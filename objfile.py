@@ -0,0 +1,208 @@
+"""
+This module reads and writes precompiled RISC-V object files (.rvo).
+An object file holds the columns of a CompactProgram, the data segments,
+the symbol table, the side table of instructions kept as objects and the
+meta-instruction hooks, so a program can be assembled once and then run
+many times without parsing. Loading maps the file and casts the columns
+in place; only the small side and hook tables are decoded up front.
+
+Every section is plain data. Meta instructions are stored as their
+source line and parsed again on load, so a crafted file can at worst
+fail to load; it never gets to run Python code.
+
+Layout (little-endian, every section 4-byte aligned):
+  header    magic, format version, opcode table checksum, start address,
+            text base, slot count, instruction count, segment count,
+            symbol, side table and hook table sizes
+  columns   opcode, rd, rs1, rs2, imm as int32[slots], then int8 flags[slots]
+  segments  per segment: base u32, length u32, bytes
+  symbols   JSON {label: address}
+  objects   JSON list of the instructions referenced by OBJECT slots
+  hooks     JSON [{address: [meta instruction]}, the same for fall-through hooks]
+"""
+
+import json
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+
+import instructions as instr
+from parser import Parser, DataView
+from program import CompactProgram, OPCODES
+
+MAGIC = b"RVO\x01"
+FORMAT_VERSION = 3
+SUFFIX = ".rvo"
+
+_HEADER = struct.Struct('<4sHHIIIIIIIII')
+_SEGMENT = struct.Struct('<II')
+
+# Opcode ids are positions in program.OPCODES, so files are only valid for
+# the table they were written with.
+OPCODE_CHECKSUM = zlib.crc32(",".join(cls.__name__ for cls, _, _ in OPCODES).encode())
+
+_NATIVE_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+def _pad(n):
+  # Bytes needed to round n up to a multiple of 4.
+  return -n & 3
+
+def _le(column):
+  # Little-endian bytes of an array column.
+  if not _NATIVE_LITTLE_ENDIAN and column.itemsize > 1:
+    column = array(column.typecode, column)
+    column.byteswap()
+  return column.tobytes()
+
+def _meta_line(ins):
+  # Source line of a meta instruction, or None for any other instruction.
+  if isinstance(ins, instr.Assert): return f"@assert {ins.line_text}"
+  if isinstance(ins, instr.PrintExpression): return f"@print {ins.expr_str}"
+  if isinstance(ins, instr.PrintMem): return f"@print_mem {ins.addr_expr} {ins.type_str} {ins.n}"
+  if isinstance(ins, instr.Print): return f"@print {ins.reg_name}"
+  return None
+
+def _fields(cls):
+  # Slot names of an instruction class, tags excluded.
+  return [name for klass in cls.__mro__ for name in getattr(klass, '__slots__', ()) if name != 'tags']
+
+def _encode(ins):
+  # JSON form of an instruction: a meta instruction as its source line,
+  # anything else as its class name and integer fields.
+  line = _meta_line(ins)
+  if line is not None:
+    entry = {'meta': line}
+  else:
+    cls = type(ins)
+    fields = {name: getattr(ins, name) for name in _fields(cls)}
+    if getattr(instr, cls.__name__, None) is not cls or any(type(v) is not int for v in fields.values()):
+      raise ValueError(f"{cls.__name__} cannot be written to an object file")
+    entry = {'class': cls.__name__, 'fields': fields}
+  if ins.tags:
+    entry['tags'] = sorted(ins.tags)
+  return entry
+
+def _decode(entry, asm_parser):
+  # Instruction for an entry written by _encode. Only instruction classes
+  # with integer fields are built directly; meta lines go through the parser.
+  if 'meta' in entry:
+    ins = asm_parser.parse_meta(entry['meta'])
+    if ins is None:
+      raise ValueError(f"unknown meta line {entry['meta']!r}")
+  else:
+    cls = getattr(instr, entry['class'], None)
+    fields = entry['fields']
+    if (not isinstance(cls, type) or not issubclass(cls, instr.Instruction)
+        or sorted(fields) != sorted(_fields(cls)) or any(type(v) is not int for v in fields.values())):
+      raise ValueError(f"bad instruction {entry['class']!r}")
+    ins = cls.__new__(cls)
+    for name, value in fields.items():
+      setattr(ins, name, value)
+  tags = entry.get('tags', [])
+  if any(type(tag) is not str for tag in tags):
+    raise ValueError("bad instruction tags")
+  ins.tags = frozenset(tags) or instr.NO_TAGS
+  return ins
+
+def _encode_hooks(hooks):
+  # JSON form of an {address: [meta instruction]} table.
+  return {str(addr): [_encode(ins) for ins in metas] for addr, metas in hooks.items()}
+
+def _decode_hooks(table, asm_parser):
+  # Inverse of _encode_hooks.
+  return {int(addr): [_decode(entry, asm_parser) for entry in entries] for addr, entries in table.items()}
+
+def is_object(path):
+  # True if path starts with the object file magic.
+  try:
+    with open(path, 'rb') as f:
+      return f.read(len(MAGIC)) == MAGIC
+  except OSError:
+    return False
+
+def write_object(path, result):
+  # Writes a parse result (as returned by Parser.parse_program) to path.
+  program = result['instructions']
+  if not isinstance(program, CompactProgram):
+    program = CompactProgram(program)
+  slots = len(program.opcode)
+  symbols = json.dumps(result['labels'], sort_keys=True).encode()
+  objects = json.dumps([_encode(ins) for ins in program.objects]).encode()
+  hooks = json.dumps([_encode_hooks(result['hooks']), _encode_hooks(result['fallthrough_hooks'])]).encode()
+  segments = result['segments']
+
+  parts = [_HEADER.pack(MAGIC, FORMAT_VERSION, 0, OPCODE_CHECKSUM, result['start_addr'],
+                        program.base, slots, len(program), len(segments), len(symbols), len(objects),
+                        len(hooks))]
+  for column in (program.opcode, program.rd, program.rs1, program.rs2, program.imm):
+    parts.append(_le(array('i', column)))
+  parts.append(bytes(array('b', program.flags)) + bytes(_pad(slots)))
+  for base, chunk in segments:
+    parts.append(_SEGMENT.pack(base, len(chunk)) + bytes(chunk) + bytes(_pad(len(chunk))))
+  parts.append(symbols + bytes(_pad(len(symbols))))
+  parts.append(objects + bytes(_pad(len(objects))))
+  parts.append(hooks)
+  with open(path, 'wb') as f:
+    f.write(b"".join(parts))
+
+def load_object(path):
+  # Maps an object file and returns a parse-result dict whose instructions
+  # are a CompactProgram backed directly by the mapped columns.
+  with open(path, 'rb') as f:
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  view = memoryview(buf)
+  offset = 0
+
+  def take(n):
+    # Next n bytes of the file, skipping padding to the following section.
+    nonlocal offset
+    if offset + n > len(view):
+      raise ValueError(f"{path}: truncated object file")
+    chunk = view[offset:offset + n]
+    offset += n + _pad(n)
+    return chunk
+
+  (magic, version, _, checksum, start_addr, base, slots, count,
+   nsegments, symbols_size, objects_size, hooks_size) = _HEADER.unpack(take(_HEADER.size))
+  if magic != MAGIC:
+    raise ValueError(f"{path}: not a RISC-V object file")
+  if version != FORMAT_VERSION or checksum != OPCODE_CHECKSUM:
+    raise ValueError(f"{path}: object file was built by an incompatible emulator; reassemble it")
+
+  columns = []
+  for _ in range(5):
+    raw = take(4 * slots)
+    if _NATIVE_LITTLE_ENDIAN:
+      columns.append(raw.cast('i'))
+    else:
+      column = array('i', raw.tobytes())
+      column.byteswap()
+      columns.append(column)
+  flags = take(slots).cast('b')
+
+  segments = []
+  for _ in range(nsegments):
+    seg_base, length = _SEGMENT.unpack(take(_SEGMENT.size))
+    segments.append((seg_base, take(length)))
+
+  labels = json.loads(bytes(take(symbols_size)))
+  asm_parser = Parser()
+  try:
+    objects = [_decode(entry, asm_parser) for entry in json.loads(bytes(take(objects_size)))]
+    hooks, fallthrough_hooks = (_decode_hooks(table, asm_parser)
+                                for table in json.loads(bytes(take(hooks_size))))
+  except Exception as e:
+    raise ValueError(f"{path}: bad side or hook table: {e}") from e
+
+  program = CompactProgram.from_columns(base, *columns, flags, objects, count)
+  return {
+    'instructions': program,
+    'segments': segments,
+    'data': DataView(segments),
+    'labels': labels,
+    'hooks': hooks,
+    'fallthrough_hooks': fallthrough_hooks,
+    'start_addr': start_addr,
+  }
@@ -1,11 +1,244 @@
 """
 This module implements the Parser for the RISC-V assembly emulator.
 It handles labels, instructions, and meta-syntax assertions.
+Meta lines take no address space: each becomes a hook on the address of
+the next instruction, or, when a label separates it from that instruction,
+a fall-through hook on the previous one (see hooks.py).
+Each source line is tokenized once, in the first pass, into a Statement
+that the second pass turns into instructions through a mnemonic table.
 """
 
+import copy
+import gc
 import re
+import tempfile
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import accumulate
 import instructions as instr
 import expressions as expr
+from hooks import Hooked
+from program import CompactProgram
+from traps import IllegalInstruction
+
+_LABEL_RE = re.compile(r'^([a-zA-Z_.]\w*):(.*)')
+# Operand tokens: everything between whitespace, commas and parentheses.
+_OPERAND_RE = re.compile(r'[^\s,()]+')
+_DIRECTIVE_SPLIT_RE = re.compile(r'\s+')
+_WORD_SPLIT_RE = re.compile(r'[\s,]+')
+_STRING_RE = re.compile(r'"(.*)"')
+_EXPR_TOKEN_RE = re.compile(r'[a-zA-Z_]\w*|0x[0-9a-fA-F]+|0b[01]+|-?\d+|[(),\[\]]')
+_EXPR_INT_RE = re.compile(r'^-?\d+|0x[0-9a-fA-F]+')
+
+# Expression functions: name -> (class, argument count).
+_EXPR_OPS = {
+  'eq': (expr.Eq, 2), 'ne': (expr.Ne, 2), 'lt': (expr.Lt, 2), 'gt': (expr.Gt, 2),
+  'le': (expr.Le, 2), 'ge': (expr.Ge, 2), 'and': (expr.AndExpr, 2), 'or': (expr.OrExpr, 2),
+  'not': (expr.NotExpr, 1), 'add': (expr.Add, 2), 'sub': (expr.Sub, 2), 'mul': (expr.Mul, 2),
+  'div': (expr.Div, 2), 'mod': (expr.Mod, 2),
+}
+
+# Reach of a single jal, in bytes either side of the call site. Jal keeps a
+# 20-bit byte offset (see instructions.sext20), so this is +/-512 KiB.
+JAL_RANGE = 1 << 19
+
+def _fits12(value):
+  # True when value is a signed 12-bit immediate.
+  return -2048 <= value <= 2047
+
+class DataView(Mapping):
+  """
+  Read-only {address: byte} view over the contiguous data segments
+  emitted by the parser, for callers that inspect individual bytes.
+  """
+
+  def __init__(self, segments):
+    self.segments = segments
+
+  def __getitem__(self, addr):
+    for base, chunk in self.segments:
+      if base <= addr < base + len(chunk):
+        return chunk[addr - base]
+    raise KeyError(addr)
+
+  def __iter__(self):
+    for base, chunk in self.segments:
+      yield from range(base, base + len(chunk))
+
+  def __len__(self):
+    return sum(len(chunk) for _, chunk in self.segments)
+
+class Statement:
+  """
+  A tokenized source line: the mnemonic, its operand tokens and whether the
+  line names the 'sp' alias. Built once in the first pass and reused for
+  size estimation and instruction building.
+  """
+
+  __slots__ = ('line_no', 'text', 'mnemonic', 'args', 'uses_sp')
+
+  def __init__(self, line_no, text):
+    self.line_no = line_no
+    self.text = text
+    parts = _OPERAND_RE.findall(text)
+    self.mnemonic = parts[0].lower()
+    self.args = parts[1:]
+    self.uses_sp = 'sp' in parts
+
+class Unparsed(instr.Instruction):
+  """
+  Stands in for the instructions of a lazily parsed line that failed to
+  parse; executing it raises the parse error as an IllegalInstruction.
+  """
+
+  __slots__ = ('message', 'pc')
+
+  def __init__(self, message, pc):
+    super().__init__()
+    self.message = message
+    self.pc = pc
+
+  def execute(self, cpu):
+    raise IllegalInstruction(self.message, pc=self.pc)
+
+class LazyProgram(Mapping):
+  """
+  {address: [instruction]} view over laid-out statements that are only
+  built into instructions when an address is first looked up. The layout
+  is the one parse_program produces. A line that fails to parse is built
+  into Unparsed instructions, so every engine traps precisely when it is
+  reached; validate() reports them all. Meta lines are parsed up front
+  with the rest of pass one.
+  """
+
+  # Tells CPU.run to decode slots on first execution.
+  lazy = True
+
+  def __init__(self, parser, statements, base, end):
+    # Statements decode against a private copy of the parser and its labels,
+    # so parsing something else with it later changes nothing here.
+    self.parser = copy.copy(parser)
+    self.parser.labels = dict(parser.labels)
+    self.addrs = [addr for addr, _ in statements]
+    self.statements = [stmt for _, stmt in statements]
+    self.base = base
+    self.end = end
+    # address -> [meta instruction], see with_hooks()
+    self.hooks = {}
+    self.fallthrough_hooks = {}
+    self._built = {} # statement index -> [instruction]
+    self._entries = {} # address -> [instruction]
+
+  def _build(self, i):
+    # Instructions produced by statement i, built on first use. A line
+    # that fails fills its slots with Unparsed instructions.
+    objs = self._built.get(i)
+    if objs is None:
+      stmt, addr = self.statements[i], self.addrs[i]
+      try:
+        objs = self.parser._build(stmt, addr)
+        objs = objs if isinstance(objs, list) else [objs] if objs else []
+      except Exception as e:
+        message = f"Error parsing line {stmt.line_no} at PC=0x{addr:08X}: {e}"
+        end = self.addrs[i + 1] if i + 1 < len(self.addrs) else self.end
+        objs = [Unparsed(message, addr) for _ in range(max(1, (end - addr) >> 2))]
+      self._built[i] = objs
+    return objs
+
+  def _lookup(self, addr):
+    # The instruction parse_program would have placed at addr, or None.
+    if addr < self.base or addr >= self.end or (addr - self.base) & 3:
+      return None
+    i = bisect_right(self.addrs, addr) - 1
+    ins = None
+    if i >= 0:
+      objs = self._build(i)
+      k = (addr - self.addrs[i]) >> 2
+      if k < len(objs):
+        ins = objs[k]
+    before, after = self.hooks.get(addr), self.fallthrough_hooks.get(addr)
+    return Hooked(ins, before or (), after or ()) if before or after else ins
+
+  def __getitem__(self, addr):
+    entry = self._entries.get(addr)
+    if entry is None:
+      ins = self._lookup(addr)
+      if ins is None:
+        raise KeyError(addr)
+      entry = self._entries[addr] = [ins]
+    return entry
+
+  def __iter__(self):
+    # Decodes every statement.
+    return (addr for addr in range(self.base, self.end, 4) if addr in self)
+
+  def __len__(self):
+    return sum(1 for _ in self)
+
+  def with_hooks(self, hooks, fallthrough_hooks=None):
+    # View over the same statements whose lookups attach hooks, as
+    # hooks.attach() does. Built statements are shared.
+    view = copy.copy(self)
+    view.hooks = hooks
+    view.fallthrough_hooks = fallthrough_hooks or {}
+    view.end = max(self.end, max(hooks) + 4) if hooks else self.end
+    view._entries = {}
+    return view
+
+  @property
+  def decoded(self):
+    # Number of statements built so far.
+    return len(self._built)
+
+  def validate(self):
+    # Eagerly builds every statement. Returns the IllegalInstruction traps
+    # of the lines that fail, in source order.
+    errors = []
+    for i in range(len(self.statements)):
+      objs = self._build(i)
+      if objs and type(objs[0]) is Unparsed:
+        errors.append(IllegalInstruction(objs[0].message, pc=objs[0].pc))
+    return errors
+
+@contextmanager
+def _collector_paused():
+  # Parsing allocates many long-lived, acyclic objects; pausing the cyclic
+  # collector keeps the cost per line flat as programs grow.
+  enabled = gc.isenabled()
+  gc.disable()
+  try:
+    yield
+  finally:
+    if enabled:
+      gc.enable()
+
+# Fewest statements worth handing to a worker process.
+MIN_CHUNK = 2000
+
+# Parser of a pass-two worker process, holding the shared label table.
+_worker_parser = None
+
+def _init_worker(parser_cls, labels):
+  # Process pool initializer: the label table is sent once per worker.
+  global _worker_parser
+  _worker_parser = parser_cls()
+  _worker_parser.labels = labels
+
+def _parse_chunk(records):
+  # Pass two over (address, line number, text) records in a worker.
+  # Returns the chunk as a CompactProgram.
+  start = records[0][0]
+  program = CompactProgram.allocate(start, ((records[-1][0] - start) >> 2) + 1)
+  with _collector_paused():
+    _worker_parser._second_pass(
+      ((addr, Statement(line_no, text)) for addr, line_no, text in records), program.put)
+  return program
+
+def _family(handler, *mnemonics):
+  # Handler table entries for mnemonics named after their instruction class.
+  return {m: (handler, getattr(instr, m.capitalize())) for m in mnemonics}
 
 class Parser:
   """
@@ -22,45 +255,128 @@ class Parser:
     "t3": 28, "t4": 29, "t5": 30, "t6": 31
   })
 
-  def __init__(self):
+  def __init__(self, workers=None, lazy=False):
+    # With workers, parse_program runs pass two of large programs in that
+    # many processes and returns a CompactProgram. With lazy, it only runs
+    # pass one and returns a LazyProgram.
+    self.workers = workers
+    self.lazy = lazy
     self.labels = {}
     self.instructions = {} 
-    self.data_memory = {} # addr -> byte
+    self.segments = [] # [base, bytearray] chunks of the .data segment
     self.text_base = 0x0000
     self.data_base = 0x4000
+    self.text_end = self.text_base
+    self._anchors = {} # text label -> index of the statement it precedes
+    self._hook_anchors = [] # [index of the statement it precedes, meta instruction, fall-through]
+    self.hooks = {} # address -> [meta instruction] run before the instruction
+    self.fallthrough_hooks = {} # address -> [meta instruction] run after it falls through
+    self._sized = [] # [statement index, Statement or None if fixed, size] not of 4 bytes
 
   def parse_program(self, source):
+    with _collector_paused():
+      self._reset()
+      statements = list(self._first_pass(source.splitlines()))
+      statements = list(self._place(statements, self._layout(len(statements))))
+      if self.lazy:
+        return self._result(LazyProgram(self, statements, self.text_base, self.text_end))
+      if self.workers:
+        return self._result(self._parallel_second_pass(statements))
+      instructions = self.instructions
+      def put(addr, obj):
+        instructions[addr] = [obj]
+      self._second_pass(statements, put)
+      return self._result(instructions)
+
+  def parse_stream(self, lines):
+    # Parses a file object or any iterable of lines without holding the
+    # source or per-line objects in memory. Pass one keeps only the labels,
+    # the data and the pseudos that name a label, spilling each instruction
+    # line to a temporary file; pass two re-reads the spill and encodes
+    # straight into a CompactProgram, the 'instructions' entry.
+    with _collector_paused(), tempfile.TemporaryFile('w+', encoding='utf-8') as spill:
+      self._reset()
+      count = 0
+      for stmt in self._first_pass(lines):
+        spill.write(f"{stmt.line_no}\t{stmt.text}\n")
+        count += 1
+      sizes = self._layout(count)
+      spill.seek(0)
+      program = CompactProgram.allocate(self.text_base, (self.text_end - self.text_base) >> 2)
+      self._second_pass(self._place(self._respill(spill), sizes), program.put)
+      return self._result(program)
+
+  def line_table(self, lines):
+    # {address: source line number} for the first word of every instruction
+    # line of lines (a source string or an iterable of lines), under the
+    # layout a parse of the same source produces. Only runs pass one.
+    if isinstance(lines, str):
+      lines = lines.splitlines()
+    with _collector_paused():
+      self._reset()
+      statements = list(self._first_pass(lines))
+      sizes = self._layout(len(statements))
+      return {addr: stmt.line_no for addr, stmt in self._place(statements, sizes)}
+
+  def _reset(self):
+    # Clears the state of a previous parse.
     self.labels = {}
     self.instructions = {} 
-    self.data_memory = {}
-    
-    lines = source.splitlines()
-    text_addr = self.text_base
+    self.segments = []
+    self.text_end = self.text_base
+    self._anchors = {}
+    self._hook_anchors = []
+    self.hooks = {}
+    self.fallthrough_hooks = {}
+    self._sized = []
+
+  def _result(self, instructions):
+    # The parse result dictionary returned by both parse modes.
+    return {
+        'instructions': instructions,
+        'segments': [(base, bytes(chunk)) for base, chunk in self.segments],
+        'data': DataView(self.segments),
+        'labels': self.labels,
+        'hooks': self.hooks,
+        'fallthrough_hooks': self.fallthrough_hooks,
+        'start_addr': self.labels.get('main', self.text_base)
+    }
+
+  def _first_pass(self, lines):
+    # Identifies labels and stores data. Yields a Statement for every
+    # instruction line; text labels and meta lines are recorded against the
+    # index of the statement they precede and only get addresses from
+    # _layout().
+    count = 0
     data_addr = self.data_base
     current_segment = '.text'
-    
-    clean_lines = []
 
-    # First pass: identify labels, advance addresses, and store data
     for line_idx, line in enumerate(lines):
-      raw_line = line
       line = line.split('#')[0].strip()
       if not line: continue
 
       # 1. Handle labels (multiple labels possible on one line)
-      while True:
-        match = re.match(r'^([a-zA-Z_.]\w*):(.*)', line)
-        if match:
-          label = match.group(1)
-          self.labels[label] = text_addr if current_segment == '.text' else data_addr
-          line = match.group(2).strip()
-        else: break
+      while ':' in line:
+        match = _LABEL_RE.match(line)
+        if not match: break
+        name = match.group(1)
+        if current_segment == '.text':
+          self.labels[name] = None
+          self._anchors[name] = count
+          # Meta lines above the label are not reached by jumps to it
+          for entry in reversed(self._hook_anchors):
+            if entry[0] != count or entry[2]: break
+            entry[2] = count > 0
+        else:
+          self.labels[name] = data_addr
+          self._anchors.pop(name, None)
+        line = match.group(2).strip()
       
       if not line: continue
 
       # 2. Handle directives
-      if line.startswith('.'):
-        parts = re.split(r'\s+', line)
+      if line[0] == '.':
+        parts = _DIRECTIVE_SPLIT_RE.split(line)
         directive = parts[0].lower()
         if directive == '.text':
           current_segment = '.text'
@@ -71,188 +387,296 @@ class Parser:
         elif directive == '.word':
           if current_segment != '.data':
             raise ValueError(f"Line {line_idx+1}: .word outside .data segment")
-          for val_str in re.split(r'[\s,]+', " ".join(parts[1:])):
+          for val_str in _WORD_SPLIT_RE.split(" ".join(parts[1:])):
             if not val_str: continue
             val = int(val_str, 0)
-            for i in range(4):
-              self.data_memory[data_addr + i] = (val >> (i * 8)) & 0xFF
-            data_addr += 4
+            data_addr = self._emit(data_addr, (val & 0xFFFFFFFF).to_bytes(4, 'little'))
           continue
         elif directive == '.string':
           if current_segment != '.data':
             raise ValueError(f"Line {line_idx+1}: .string outside .data segment")
           # Handle quoted string
-          match = re.search(r'"(.*)"', line)
+          match = _STRING_RE.search(line)
           if match:
             s = match.group(1).encode().decode('unicode_escape')
-            for char in s:
-              self.data_memory[data_addr] = ord(char)
-              data_addr += 1
-            self.data_memory[data_addr] = 0 # Null terminator
-            data_addr += 1
+            # Null terminated
+            data_addr = self._emit(data_addr, bytes(ord(char) & 0xFF for char in s) + b'\0')
           continue
 
-      # 3. Handle instructions (only in .text segment)
-      if current_segment == '.text':
-          # Collision Safeguard
-          if text_addr >= self.data_base:
-            raise ValueError(f"Line {line_idx+1}: Segment collision! .text overflowed into .data at 0x{text_addr:08X}")
-            
-          clean_lines.append((text_addr, line))
-          
-          # Determine expansion size
-          parts = re.split(r'[\s,()]+', line)
-          parts = [p for p in parts if p]
-          mnemonic = parts[0].lower()
-          
-          expected = 4
-          if mnemonic == 'li' and len(parts) >= 3:
-            try:
-              imm = int(parts[-1], 0)
-              if not (-2048 <= imm <= 2047): expected = 8
-            except: expected = 8
-          elif mnemonic == 'la' and len(parts) >= 3:
-            expected = 8
-          elif mnemonic == 'call' and len(parts) >= 2:
-            expected = 8
-          elif mnemonic == 'lw' and len(parts) == 3 and parts[2] in self.labels:
-            # Check if it was a pseudo-lw (PC-relative)
-            expected = 8
-          
-          text_addr += expected
+      # 3. Handle meta lines and instructions (only in .text segment)
+      if current_segment == '.text' and line[0] == '@':
+        try:
+          meta = self.parse_meta(line)
+        except Exception as e:
+          raise ValueError(f"Line {line_idx+1}: {e}") from e
+        if meta is not None:
+          self._hook_anchors.append([count, meta, False])
+      elif current_segment == '.text':
+        stmt = Statement(line_idx + 1, line)
+        size = self._size(stmt)
+        if size != 4:
+          self._sized.append([count, stmt if size is None else None, size or 8])
+        yield stmt
+        count += 1
+      # Instructions in .data segment are ignored
+
+  def _layout(self, count):
+    # Linker-style relaxation over the first pass. Every statement whose
+    # size depends on labels starts at its longest form; addresses and
+    # labels are derived from the current sizes and the sizes recomputed
+    # from them until nothing changes. Each shorter form only becomes
+    # available as code moves closer, so the sizes never grow and the loop
+    # ends on an exact layout. Sets the text labels, the hook addresses and
+    # self.text_end and returns {statement index: size} for statements of
+    # other than 4 bytes.
+    indices = [index for index, _, _ in self._sized]
+    base = self.text_base
+    while True:
+      extra = list(accumulate((size - 4 for _, _, size in self._sized), initial=0))
+      def addr_of(index):
+        return base + 4 * index + extra[bisect_left(indices, index)]
+      for name, index in self._anchors.items():
+        self.labels[name] = addr_of(index)
+      changed = False
+      for entry in self._sized:
+        index, stmt, size = entry
+        if stmt is not None:
+          new = self._measure(stmt, addr_of(index))
+          if new != size:
+            entry[2] = new
+            changed = True
+      if not changed:
+        break
+    self.text_end = addr_of(count)
+    for index, meta, fallthrough in self._hook_anchors:
+      if fallthrough:
+        # On the last word of the previous statement
+        self.fallthrough_hooks.setdefault(addr_of(index) - 4, []).append(meta)
       else:
-          # Instructions in .data segment are ignored or could be an error
-          pass
-
-    # Second pass: parse instructions
-    current_addr = self.text_base
-    for addr, line in clean_lines:
-      # Pad any gaps from labels/pseudo logic
-      while current_addr < addr:
-        if current_addr not in self.instructions: 
-          self.instructions[current_addr] = [instr.Addi(0, 0, 0)]
-        current_addr += 4
-
-      objs = self.parse_line(line, addr)
+        self.hooks.setdefault(addr_of(index), []).append(meta)
+    return {index: size for index, _, size in self._sized if size != 4}
+
+  def _place(self, statements, sizes):
+    # (address, Statement) pairs for the statements under a layout.
+    addr = self.text_base
+    for index, stmt in enumerate(statements):
+      # Collision Safeguard
+      if addr >= self.data_base:
+        raise ValueError(f"Line {stmt.line_no}: Segment collision! .text overflowed into .data at 0x{addr:08X}")
+      yield addr, stmt
+      addr += sizes.get(index, 4)
+
+  def _respill(self, spill):
+    # Statements read back from a parse_stream() spill file.
+    for record in spill:
+      line_no, text = record[:-1].split('\t', 1)
+      yield Statement(int(line_no), text)
+
+  def _parallel_second_pass(self, statements):
+    # Runs pass two in chunks across a process pool and splices the
+    # encoded chunks, in address order, into one CompactProgram.
+    program = CompactProgram.allocate(self.text_base, (self.text_end - self.text_base) >> 2)
+    size = max(MIN_CHUNK, -(-len(statements) // (self.workers * 4)))
+    if self.workers < 2 or len(statements) < 2 * size:
+      self._second_pass(statements, program.put)
+      return program
+    chunks = [[(addr, stmt.line_no, stmt.text) for addr, stmt in statements[i:i + size]]
+              for i in range(0, len(statements), size)]
+    with ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                             initargs=(type(self), self.labels)) as pool:
+      for chunk in pool.map(_parse_chunk, chunks):
+        program.splice(chunk)
+    return program
+
+  def _second_pass(self, statements, put):
+    # Builds instructions from laid-out (address, Statement) pairs,
+    # storing each with put(address, instruction).
+    for addr, stmt in statements:
+      objs = self._build(stmt, addr)
       if objs:
         if not isinstance(objs, list): objs = [objs]
         for i, obj in enumerate(objs):
-            self.instructions[addr + i*4] = [obj]
-      
-      # Correctly advance current_addr based on what we actually produced
-      current_addr = addr + (4 * (len(objs) if isinstance(objs, list) else 1))
-    
-    return {
-        'instructions': self.instructions,
-        'data': self.data_memory,
-        'start_addr': self.labels.get('main', self.text_base)
-    }
+          put(addr + i*4, obj)
+
+  def _emit(self, addr, raw):
+    # Appends raw bytes to the data segment at addr, extending the last
+    # chunk when contiguous. Returns the address following the bytes.
+    if self.segments and self.segments[-1][0] + len(self.segments[-1][1]) == addr:
+      self.segments[-1][1] += raw
+    else:
+      self.segments.append([addr, bytearray(raw)])
+    return addr + len(raw)
 
-  def _parse_line_logic(self, line, addr):
-    line = line.strip()
-    if line.startswith('@'): return self.parse_meta(line)
-    
-    parts = re.split(r'[\s,()]+', line)
-    parts = [p for p in parts if p]
-    mnemonic = parts[0].lower()
-    args = parts[1:]
-
-    def get_reg(name):
-      if name.lower() not in self.REGISTER_MAP:
-        raise ValueError(f"Unknown register: {name}")
-      return self.REGISTER_MAP[name.lower()]
-
-    def get_imm(val):
+  def _size(self, stmt):
+    # Bytes the statement expands to, or None when that depends on where
+    # the labels end up.
+    mnemonic, args = stmt.mnemonic, stmt.args
+    if mnemonic == 'li' and len(args) >= 2:
       try:
-        return int(val, 0)
-      except:
-        if val in self.labels: return self.labels[val]
-        raise ValueError(f"Invalid immediate or label: {val}")
-
-    def get_rel(val):
-      if val in self.labels: return self.labels[val] - addr
-      return get_imm(val)
-
-    # --- Pseudos ---
-    if mnemonic == 'li':
-      rd, imm = get_reg(args[0]), get_imm(args[1])
-      if -2048 <= imm <= 2047: return instr.Addi(rd, 0, imm)
-      upper = (imm + 0x800) >> 12
-      lower = imm & 0xFFF
-      if lower & 0x800: lower -= 0x1000
-      return [instr.Lui(rd, upper), instr.Addi(rd, rd, lower)]
-    
-    if mnemonic == 'la':
-        rd = get_reg(args[0])
-        target = get_imm(args[1])
-        diff = target - addr
-        hi = (diff + 0x800) >> 12
-        lo = diff - (hi << 12)
-        return [instr.Auipc(rd, hi), instr.Addi(rd, rd, lo)]
-    
-    if mnemonic == 'lw' and len(args) == 2 and args[1] in self.labels:
-        rd = get_reg(args[0])
-        target = self.labels[args[1]]
-        diff = target - addr
-        hi = (diff + 0x800) >> 12
-        lo = diff - (hi << 12)
-        return [instr.Auipc(rd, hi), instr.Lw(rd, rd, lo)]
-    
-    if mnemonic == 'mv': return instr.Addi(get_reg(args[0]), get_reg(args[1]), 0)
-    if mnemonic == 'neg': return instr.Sub(get_reg(args[0]), 0, get_reg(args[1]))
-    if mnemonic == 'not': return instr.Xori(get_reg(args[0]), get_reg(args[1]), -1)
-    if mnemonic == 'nop': return instr.Addi(0, 0, 0)
-    if mnemonic == 'j': return instr.Jal(0, get_rel(args[0]))
-    if mnemonic == 'jr': return instr.Jalr(0, get_reg(args[0]), 0)
-    if mnemonic == 'ret': return instr.Jalr(0, 1, 0)
-    if mnemonic == 'call':
-        target = get_imm(args[0])
-        return [instr.Auipc(1, 0), instr.Jalr(1, 1, target - addr)]
-
-    # Zero-based branches/sets
-    if mnemonic == 'seqz': return instr.Sltiu(get_reg(args[0]), get_reg(args[1]), 1)
-    if mnemonic == 'snez': return instr.Sltu(get_reg(args[0]), 0, get_reg(args[1]))
-    if mnemonic == 'sltz': return instr.Slt(get_reg(args[0]), get_reg(args[1]), 0)
-    if mnemonic == 'sgtz': return instr.Slt(get_reg(args[0]), 0, get_reg(args[1]))
-    
-    if mnemonic == 'beqz': return instr.Beq(get_reg(args[0]), 0, get_rel(args[1]))
-    if mnemonic == 'bnez': return instr.Bne(get_reg(args[0]), 0, get_rel(args[1]))
-    if mnemonic == 'blez': return instr.Bge(0, get_reg(args[0]), get_rel(args[1]))
-    if mnemonic == 'bgez': return instr.Bge(get_reg(args[0]), 0, get_rel(args[1]))
-    if mnemonic == 'bltz': return instr.Blt(get_reg(args[0]), 0, get_rel(args[1]))
-    if mnemonic == 'bgtz': return instr.Blt(0, get_reg(args[0]), get_rel(args[1]))
-
-    if mnemonic == 'fence': return instr.Fence()
-    if mnemonic == 'ecall': return instr.Ecall()
-    if mnemonic == 'ebreak': return instr.Ebreak()
-
-    # --- Base ---
-    if mnemonic in ['add', 'sub', 'sll', 'slt', 'sltu', 'xor', 'srl', 'sra', 'or', 'and', 'mul']:
-      return getattr(instr, mnemonic.capitalize())(get_reg(args[0]), get_reg(args[1]), get_reg(args[2]))
-    if mnemonic in ['addi', 'slti', 'sltiu', 'xori', 'ori', 'andi', 'slli', 'srli', 'srai']:
-      return getattr(instr, mnemonic.capitalize())(get_reg(args[0]), get_reg(args[1]), get_imm(args[2]))
-    if mnemonic in ['lw', 'lh', 'lhu', 'lb', 'lbu']:
-      return getattr(instr, mnemonic.capitalize())(get_reg(args[0]), get_reg(args[2]), get_imm(args[1]))
-    if mnemonic in ['sw', 'sh', 'sb']:
-      return getattr(instr, mnemonic.capitalize())(get_reg(args[2]), get_reg(args[0]), get_imm(args[1]))
-    if mnemonic in ['beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu', 'bgt', 'ble', 'bgtu', 'bleu']:
-      m_base = mnemonic
-      if mnemonic == 'bgt': return instr.Blt(get_reg(args[1]), get_reg(args[0]), get_rel(args[2]))
-      if mnemonic == 'ble': return instr.Bge(get_reg(args[1]), get_reg(args[0]), get_rel(args[2]))
-      if mnemonic == 'bgtu': return instr.Bltu(get_reg(args[1]), get_reg(args[0]), get_rel(args[2]))
-      if mnemonic == 'bleu': return instr.Bgeu(get_reg(args[1]), get_reg(args[0]), get_rel(args[2]))
-      return getattr(instr, mnemonic.capitalize())(get_reg(args[0]), get_reg(args[1]), get_rel(args[2]))
-    if mnemonic in ['lui', 'auipc']:
-      return getattr(instr, mnemonic.capitalize())(get_reg(args[0]), get_imm(args[1]))
-    if mnemonic == 'jal':
-      if len(args) == 1: return instr.Jal(1, get_rel(args[0]))
-      return instr.Jal(get_reg(args[0]), get_rel(args[1]))
-    if mnemonic == 'jalr':
-      # Handle both formats: jalr rd, rs1, imm AND jalr rd, imm(rs1)
-      try: return instr.Jalr(get_reg(args[0]), get_reg(args[2]), get_imm(args[1]))
-      except: return instr.Jalr(get_reg(args[0]), get_reg(args[1]), get_imm(args[2]))
-    
-    raise ValueError(f"Unknown mnemonic: {mnemonic}")
+        imm = int(args[1], 0)
+      except ValueError:
+        return None
+      # The choice _li makes for a literal
+      return 4 if _fits12(imm) or not imm & 0xFFF else 8
+    if mnemonic in ('la', 'call') or (mnemonic == 'lw' and len(args) == 2):
+      # la/call/lw with a label
+      return None
+    return 4
+
+  def _measure(self, stmt, addr):
+    # Bytes the statement assembles to at addr with the current labels.
+    # A line that does not assemble keeps one slot.
+    try:
+      objs = self._build(stmt, addr)
+    except Exception:
+      return 4
+    return 4 * len(objs) if isinstance(objs, list) else 4
+
+  def _build(self, stmt, addr):
+    # Instruction object(s) for a statement; tagged when the line uses 'sp'.
+    if stmt.text[0] == '@':
+      objs = self.parse_meta(stmt.text)
+    else:
+      entry = self.HANDLERS.get(stmt.mnemonic)
+      if entry is None:
+        raise ValueError(f"Unknown mnemonic: {stmt.mnemonic}")
+      handler, cls = entry
+      objs = handler(self, cls, stmt.args, addr)
+    if objs and stmt.uses_sp:
+      for obj in (objs if isinstance(objs, list) else [objs]):
+        obj.tag("use_sp")
+    return objs
+
+  def parse_line(self, line, addr):
+    # Parses a single source line located at addr.
+    return self._build(Statement(0, line.strip()), addr)
+
+  # --- Operands ---
+
+  def _reg(self, name):
+    reg = self.REGISTER_MAP.get(name.lower())
+    if reg is None:
+      raise ValueError(f"Unknown register: {name}")
+    return reg
+
+  def _imm(self, val):
+    try:
+      return int(val, 0)
+    except ValueError:
+      if val in self.labels: return self.labels[val]
+      raise ValueError(f"Invalid immediate or label: {val}")
+
+  def _rel(self, val, addr):
+    # PC-relative offset for a label, or a literal offset.
+    if val in self.labels: return self.labels[val] - addr
+    return self._imm(val)
+
+  # --- Handlers: handler(self, cls, args, addr) -> instruction(s) ---
+
+  # Pseudos take their shortest form; the choice only depends on label
+  # addresses in ways that shrink as code moves closer (see _layout).
+
+  def _li(self, cls, args, addr):
+    rd, imm = self._reg(args[0]), self._imm(args[1])
+    if _fits12(imm): return instr.Addi(rd, 0, imm)
+    upper = (imm + 0x800) >> 12
+    lower = imm & 0xFFF
+    if lower & 0x800: lower -= 0x1000
+    # A lone lui only for literals: a moving label could flip in and out of it
+    if not lower and args[1] not in self.labels: return instr.Lui(rd, upper)
+    return [instr.Lui(rd, upper), instr.Addi(rd, rd, lower)]
+
+  def _pc_relative(self, cls, rd, target, addr):
+    # auipc + cls pair reaching target from addr.
+    diff = target - addr
+    hi = (diff + 0x800) >> 12
+    lo = diff - (hi << 12)
+    return [instr.Auipc(rd, hi), cls(rd, rd, lo)]
+
+  def _la(self, cls, args, addr):
+    rd, target = self._reg(args[0]), self._imm(args[1])
+    if _fits12(target): return instr.Addi(rd, 0, target)
+    return self._pc_relative(instr.Addi, rd, target, addr)
+
+  def _call(self, cls, args, addr):
+    offset = self._imm(args[0]) - addr
+    if -JAL_RANGE <= offset < JAL_RANGE: return instr.Jal(1, offset)
+    return self._pc_relative(instr.Jalr, 1, offset + addr, addr)
+
+  def _mv(self, cls, args, addr): return instr.Addi(self._reg(args[0]), self._reg(args[1]), 0)
+  def _neg(self, cls, args, addr): return instr.Sub(self._reg(args[0]), 0, self._reg(args[1]))
+  def _not(self, cls, args, addr): return instr.Xori(self._reg(args[0]), self._reg(args[1]), -1)
+  def _nop(self, cls, args, addr): return instr.Addi(0, 0, 0)
+  def _j(self, cls, args, addr): return instr.Jal(0, self._rel(args[0], addr))
+  def _jr(self, cls, args, addr): return instr.Jalr(0, self._reg(args[0]), 0)
+  def _ret(self, cls, args, addr): return instr.Jalr(0, 1, 0)
+
+  # Zero-based sets and branches: cls(rd/rs, 0) or cls(0, rd/rs)
+  def _seqz(self, cls, args, addr): return instr.Sltiu(self._reg(args[0]), self._reg(args[1]), 1)
+  def _set_zero_rhs(self, cls, args, addr): return cls(self._reg(args[0]), self._reg(args[1]), 0)
+  def _set_zero_lhs(self, cls, args, addr): return cls(self._reg(args[0]), 0, self._reg(args[1]))
+  def _branch_zero_rhs(self, cls, args, addr): return cls(self._reg(args[0]), 0, self._rel(args[1], addr))
+  def _branch_zero_lhs(self, cls, args, addr): return cls(0, self._reg(args[0]), self._rel(args[1], addr))
+
+  def _bare(self, cls, args, addr): return cls()
+
+  def _rtype(self, cls, args, addr):
+    return cls(self._reg(args[0]), self._reg(args[1]), self._reg(args[2]))
+
+  def _itype(self, cls, args, addr):
+    return cls(self._reg(args[0]), self._reg(args[1]), self._imm(args[2]))
+
+  def _load(self, cls, args, addr):
+    if cls is instr.Lw and len(args) == 2 and args[1] in self.labels:
+      # lw rd, label
+      rd, target = self._reg(args[0]), self.labels[args[1]]
+      if _fits12(target): return instr.Lw(rd, 0, target)
+      return self._pc_relative(instr.Lw, rd, target, addr)
+    return cls(self._reg(args[0]), self._reg(args[2]), self._imm(args[1]))
+
+  def _store(self, cls, args, addr):
+    return cls(self._reg(args[2]), self._reg(args[0]), self._imm(args[1]))
+
+  def _branch(self, cls, args, addr):
+    return cls(self._reg(args[0]), self._reg(args[1]), self._rel(args[2], addr))
+
+  def _branch_swapped(self, cls, args, addr):
+    # bgt/ble/bgtu/bleu: the base branch with its operands exchanged.
+    return cls(self._reg(args[1]), self._reg(args[0]), self._rel(args[2], addr))
+
+  def _utype(self, cls, args, addr):
+    return cls(self._reg(args[0]), self._imm(args[1]))
+
+  def _jal(self, cls, args, addr):
+    if len(args) == 1: return instr.Jal(1, self._rel(args[0], addr))
+    return instr.Jal(self._reg(args[0]), self._rel(args[1], addr))
+
+  def _jalr(self, cls, args, addr):
+    # Handle both formats: jalr rd, rs1, imm AND jalr rd, imm(rs1)
+    try: return instr.Jalr(self._reg(args[0]), self._reg(args[2]), self._imm(args[1]))
+    except: return instr.Jalr(self._reg(args[0]), self._reg(args[1]), self._imm(args[2]))
+
+  # Mnemonic -> (handler, instruction class)
+  HANDLERS = {
+    'li': (_li, None), 'la': (_la, None), 'call': (_call, None),
+    'mv': (_mv, None), 'neg': (_neg, None), 'not': (_not, None), 'nop': (_nop, None),
+    'j': (_j, None), 'jr': (_jr, None), 'ret': (_ret, None),
+    'seqz': (_seqz, None), 'snez': (_set_zero_lhs, instr.Sltu),
+    'sltz': (_set_zero_rhs, instr.Slt), 'sgtz': (_set_zero_lhs, instr.Slt),
+    'beqz': (_branch_zero_rhs, instr.Beq), 'bnez': (_branch_zero_rhs, instr.Bne),
+    'blez': (_branch_zero_lhs, instr.Bge), 'bgez': (_branch_zero_rhs, instr.Bge),
+    'bltz': (_branch_zero_rhs, instr.Blt), 'bgtz': (_branch_zero_lhs, instr.Blt),
+    'bgt': (_branch_swapped, instr.Blt), 'ble': (_branch_swapped, instr.Bge),
+    'bgtu': (_branch_swapped, instr.Bltu), 'bleu': (_branch_swapped, instr.Bgeu),
+    'fence': (_bare, instr.Fence), 'ecall': (_bare, instr.Ecall), 'ebreak': (_bare, instr.Ebreak),
+    'jal': (_jal, instr.Jal), 'jalr': (_jalr, instr.Jalr),
+    **_family(_rtype, 'add', 'sub', 'sll', 'slt', 'sltu', 'xor', 'srl', 'sra', 'or', 'and', 'mul'),
+    **_family(_itype, 'addi', 'slti', 'sltiu', 'xori', 'ori', 'andi', 'slli', 'srli', 'srai'),
+    **_family(_load, 'lw', 'lh', 'lhu', 'lb', 'lbu'),
+    **_family(_store, 'sw', 'sh', 'sb'),
+    **_family(_branch, 'beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu'),
+    **_family(_utype, 'lui', 'auipc'),
+  }
 
   def parse_meta(self, line):
     if line.startswith('@print '):
@@ -276,7 +700,7 @@ class Parser:
     return None
 
   def parse_expr(self, expr_str):
-    tokens = re.findall(r'[a-zA-Z_]\w*|0x[0-9a-fA-F]+|0b[01]+|-?\d+|[(),\[\]]', expr_str)
+    tokens = _EXPR_TOKEN_RE.findall(expr_str)
     self._expr_pos = 0
     def parse_next():
       token = tokens[self._expr_pos]
@@ -290,7 +714,7 @@ class Parser:
         return expr.MemAccess(a, t)
       if token.lower() == 'pc': return expr.PCAccess()
       if token.lower() in self.REGISTER_MAP: return expr.RegAccess(self.REGISTER_MAP[token.lower()])
-      if re.match(r'^-?\d+|0x[0-9a-fA-F]+', token): return expr.Literal(int(token, 0))
+      if _EXPR_INT_RE.match(token): return expr.Literal(int(token, 0))
       if self._expr_pos < len(tokens) and tokens[self._expr_pos] == '(':
         self._expr_pos += 1
         args = []
@@ -298,34 +722,10 @@ class Parser:
           args.append(parse_next())
           if tokens[self._expr_pos] == ',': self._expr_pos += 1
         self._expr_pos += 1
-        name = token.lower()
-        if name == 'eq': return expr.Eq(args[0], args[1])
-        if name == 'ne': return expr.Ne(args[0], args[1])
-        if name == 'lt': return expr.Lt(args[0], args[1])
-        if name == 'gt': return expr.Gt(args[0], args[1])
-        if name == 'le': return expr.Le(args[0], args[1])
-        if name == 'ge': return expr.Ge(args[0], args[1])
-        if name == 'and': return expr.AndExpr(args[0], args[1])
-        if name == 'or': return expr.OrExpr(args[0], args[1])
-        if name == 'and': return expr.AndExpr(args[0], args[1])
-        if name == 'or': return expr.OrExpr(args[0], args[1])
-        if name == 'not': return expr.NotExpr(args[0])
-        if name == 'add': return expr.Add(args[0], args[1])
-        if name == 'sub': return expr.Sub(args[0], args[1])
-        if name == 'mul': return expr.Mul(args[0], args[1])
-        if name == 'div': return expr.Div(args[0], args[1])
-        if name == 'mod': return expr.Mod(args[0], args[1])
+        op = _EXPR_OPS.get(token.lower())
+        if op is not None:
+          cls, arity = op
+          return cls(*args[:arity])
 
       raise ValueError(f"Unexpected token: {token}")
     return parse_next()
-
-  def parse_line(self, line, addr):
-    # Wrapper to auto-tag instructions that use 'sp'
-    objs = self._parse_line_logic(line, addr)
-    if objs:
-        parts = re.split(r'[\s,()]+', line)
-        if 'sp' in parts:
-            iterator = objs if isinstance(objs, list) else [objs]
-            for obj in iterator:
-                obj.tags.add("use_sp")
-    return objs
@@ -0,0 +1,132 @@
+"""
+This module provides the load-time peephole optimizer for the RISC-V
+emulator. optimize() collapses straight-line runs of instructions whose
+combined effect is known when the program is loaded: no-ops (writes to
+x0, self moves such as 'mv t0, t0', fence) and constant chains such as
+'li t0, 5; addi t0, t0, 3'. A run becomes one instruction that writes the
+final constants and jumps past it; a lone no-op becomes one that only
+skips itself, which is cheaper to dispatch than the original.
+Every address keeps an instruction, so the PC layout is unchanged and a
+branch into the middle of a run starts a run of its own from there. Runs
+stop at anything with other effects: memory accesses, control transfers,
+system instructions, addresses carrying meta hooks, and after any
+instruction that triggers the stack check.
+"""
+
+import instructions as instr
+from registers import MASK32, RegisterFile
+
+# Longest run folded into one instruction.
+MAX_RUN = 64
+
+# I-type operations that leave rd unchanged when rs1 == rd and imm is 0.
+_IDENTITY_IMM = (instr.Addi, instr.Ori, instr.Xori, instr.Slli, instr.Srli, instr.Srai)
+# R-type operations that leave rd unchanged when rs1 == rd and rs2 is x0.
+_IDENTITY_ZERO = (instr.Add, instr.Sub, instr.Or, instr.Xor, instr.Sll, instr.Srl, instr.Sra)
+
+class Collapsed(instr.Instruction):
+  """
+  A run of instructions replaced by the constant register writes it
+  performs. Keeps the original run for inspection.
+  """
+
+  __slots__ = ('writes', 'next_pc', 'run')
+
+  def __init__(self, writes, next_pc, run):
+    super().__init__()
+    self.writes = writes
+    self.next_pc = next_pc
+    self.run = run
+    # The stack check after the run is the one after its last instruction.
+    self.tags = run[-1].tags
+
+  def execute(self, cpu):
+    r = cpu.registers.regs
+    for rd, value in self.writes:
+      r[rd] = value
+    return self.next_pc
+
+class _Scratch:
+  # Stand-in CPU on which foldable instructions are evaluated.
+  def __init__(self):
+    self.registers = RegisterFile()
+    self.pc = 0
+
+def is_noop(ins):
+  # True for an instruction with no architectural effect.
+  cls = type(ins)
+  if cls is instr.Fence:
+    return True
+  if cls is instr.Lui or cls is instr.Auipc:
+    return ins.rd == 0
+  if not instr.is_alu(ins):
+    return False
+  if ins.rd == 0:
+    return True
+  if isinstance(ins, instr.IType):
+    if ins.rs1 != ins.rd:
+      return False
+    return (cls in _IDENTITY_IMM and ins.imm == 0) or (cls is instr.Andi and ins.imm == -1)
+  if cls in _IDENTITY_ZERO and ins.rs1 == ins.rd and ins.rs2 == 0:
+    return True
+  if cls in (instr.Add, instr.Or, instr.Xor) and ins.rs1 == 0 and ins.rs2 == ins.rd:
+    return True
+  return cls in (instr.And, instr.Or) and ins.rs1 == ins.rs2 == ins.rd
+
+def _sources(ins):
+  # Registers a foldable instruction reads, or None if it is not foldable.
+  if isinstance(ins, instr.RType):
+    return (ins.rs1, ins.rs2)
+  if instr.is_alu(ins):
+    return (ins.rs1,)
+  if type(ins) is instr.Lui or type(ins) is instr.Auipc:
+    return ()
+  return None
+
+def _run_at(program, addr, scratch):
+  # The longest foldable run starting at addr, as (instructions, writes).
+  run = []
+  known = {} # register -> value written by the run
+  regs = scratch.registers.regs
+  while len(run) < MAX_RUN:
+    entry = program.get(addr)
+    if entry is None or len(entry) != 1:
+      break
+    ins = entry[0]
+    if not is_noop(ins):
+      sources = _sources(ins)
+      if sources is None or any(reg and reg not in known for reg in sources):
+        break
+      scratch.pc = addr
+      ins.execute(scratch)
+      known[ins.rd] = regs[ins.rd]
+    run.append(ins)
+    addr = (addr + 4) & MASK32
+    if "use_sp" in ins.tags:
+      break
+  return run, tuple(known.items())
+
+def optimize(program):
+  # Returns (optimized, eliminated): a copy of program ({address:
+  # [instruction]}) in which every address starting a run of two or more
+  # foldable instructions, or a lone no-op, holds the Collapsed run, and
+  # the number of instructions removed from the path that runs straight
+  # through the program from its lowest address.
+  scratch = _Scratch()
+  optimized = {}
+  for addr, instructions in program.items():
+    run, writes = _run_at(program, addr, scratch)
+    if len(run) > 1 or (run and not writes):
+      optimized[addr] = [Collapsed(writes, (addr + 4 * len(run)) & MASK32, run)]
+    else:
+      optimized[addr] = instructions
+  eliminated = 0
+  resume = None
+  for addr in sorted(optimized):
+    if resume is not None and addr < resume:
+      continue
+    ins = optimized[addr][0]
+    if isinstance(ins, Collapsed):
+      eliminated += len(ins.run) - 1
+      resume = addr + 4 * len(ins.run)
+  return optimized, eliminated
@@ -0,0 +1,355 @@
+"""
+This module provides the per-PC execution profiler for the RISC-V emulator.
+CPU.run(program, profile=Profile()) counts every instruction it executes
+in a preallocated array('Q') indexed by instruction slot. The counts are
+reported by address, symbolized with the parser's label table as
+label+offset, as an annotated source listing, and as collapsed stacks
+('frame;frame count' lines) for flamegraph tools.
+A Profile given a CallGraph also keeps a shadow call stack from the calls
+(jal/jalr writing ra, as in 'call') and returns ('ret') of the run, for
+inclusive and exclusive counts per function, call counts per caller ->
+callee edge, real collapsed stacks and a callgrind file.
+"""
+
+from array import array
+from bisect import bisect_right
+import instructions as instr
+from version import __version__
+
+# Control transfer kinds, see transfer_kind().
+CALL, RETURN, JUMP = 1, 2, 3
+
+# Function name of code before the first label.
+UNLABELED = "<unlabeled>"
+
+class Profile:
+  """
+  Execution counts by instruction slot, (pc - base) >> 2. Counts add up
+  over every run the profile is passed to, as does the optional call graph.
+  """
+
+  def __init__(self, calls=None):
+    self.base = 0
+    self.counts = array('Q')
+    self.calls = calls
+
+  def cover(self, base, slots):
+    # The counts array, grown or rebased to cover slots instructions from
+    # base without losing the counts taken so far.
+    if base == self.base and slots <= len(self.counts):
+      return self.counts
+    if not any(self.counts):
+      self.base, self.counts = base, array('Q', [0]) * slots
+      return self.counts
+    start = min(base, self.base)
+    end = max(base + 4 * slots, self.base + 4 * len(self.counts))
+    counts = array('Q', [0]) * ((end - start) >> 2)
+    offset = (self.base - start) >> 2
+    counts[offset:offset + len(self.counts)] = self.counts
+    self.base, self.counts = start, counts
+    return counts
+
+  def items(self):
+    # (address, count) of every executed slot, in address order.
+    base = self.base
+    return [(base + (idx << 2), count) for idx, count in enumerate(self.counts) if count]
+
+  def count(self, addr):
+    # Executions of the instruction at addr.
+    idx = (addr - self.base) >> 2
+    return self.counts[idx] if 0 <= idx < len(self.counts) else 0
+
+  @property
+  def total(self):
+    # Instructions counted.
+    return sum(self.counts)
+
+class Symbols:
+  """
+  Address -> label+offset lookup over a parser label table. Where labels
+  share an address, a global label wins over a local '.label'.
+  """
+
+  def __init__(self, labels):
+    entries = sorted(labels.items(), key=lambda item: (item[1], item[0].startswith('.')))
+    self.addrs, self.names, self.functions = [], [], []
+    function = None
+    for name, addr in entries:
+      if not name.startswith('.') and (function is None or function[1] != addr):
+        function = (name, addr)
+      if self.addrs and self.addrs[-1] == addr:
+        continue
+      self.addrs.append(addr)
+      self.names.append(name)
+      self.functions.append(function)
+
+  def _nearest(self, addr):
+    # Index of the last label at or below addr, or None.
+    i = bisect_right(self.addrs, addr) - 1
+    return None if i < 0 else i
+
+  def name(self, addr):
+    # addr as 'label', 'label+0x8', or hex when no label precedes it.
+    i = self._nearest(addr)
+    if i is None:
+      return f"0x{addr:08X}"
+    offset = addr - self.addrs[i]
+    return f"{self.names[i]}+0x{offset:X}" if offset else self.names[i]
+
+  def function(self, addr):
+    # The global label addr belongs to, else the nearest label below it,
+    # or None.
+    i = self._nearest(addr)
+    if i is None:
+      return None
+    return self.functions[i][0] if self.functions[i] else self.names[i]
+
+  def entry(self, addr):
+    # Address of the label function() names for addr, or None.
+    i = self._nearest(addr)
+    if i is None:
+      return None
+    return self.functions[i][1] if self.functions[i] else self.addrs[i]
+
+def transfer_kind(ins):
+  # CALL, RETURN or JUMP for an unconditional control transfer, else None.
+  # Hooked and fused instructions are classified by the instruction they
+  # end with.
+  while True:
+    inner = getattr(ins, 'instruction', None) or getattr(ins, 'second', None)
+    if inner is None:
+      break
+    ins = inner
+  kind = type(ins)
+  if kind is instr.Jal:
+    return CALL if ins.rd == 1 else JUMP if ins.rd == 0 else None
+  if kind is instr.Jalr:
+    if ins.rd == 1:
+      return CALL
+    if ins.rd == 0:
+      return RETURN if ins.rs1 == 1 and ins.imm == 0 else JUMP
+  return None
+
+class Frame:
+  """An activation on the shadow call stack."""
+
+  __slots__ = ('function', 'return_addr', 'start', 'tail', 'path', 'edge')
+
+  def __init__(self, function, return_addr, start, tail, path, edge):
+    self.function = function
+    self.return_addr = return_addr
+    self.start = start
+    self.tail = tail
+    self.path = path
+    self.edge = edge
+
+class CallGraph:
+  """
+  Shadow call stack over the control transfers of a profiled run.
+  Functions are named by Symbols.function() of their entry address. A call
+  pushes a frame returning to the address after it; a ret pops the frames
+  down to the one returning to its target, so unmatched returns and
+  frames skipped by a longjmp-style jump do not derail the stack. A jump
+  from inside a called function to the entry of another function is a
+  tail call: the callee is pushed as a tail frame sharing the return
+  address, and returns along with it. Counts are instructions executed.
+  """
+
+  def __init__(self, symbols):
+    self.symbols = symbols
+    self.clock = 0
+    self.origin = 0
+    self.stack = []
+    self.exclusive = {}
+    self.inclusive = {}
+    self.entries = {}
+    # (caller, callee, call site) -> [calls, inclusive count, target]
+    self.edges = {}
+    # 'f;g;h' -> instructions executed with h on top of that stack
+    self.stacks = {}
+    self._active = {}
+    self._kinds = {}
+    self._entry_addrs = {}
+
+  def resume(self, pc):
+    # Starts a run at pc; the first run enters the function of pc.
+    self.origin = self.clock
+    if not self.stack:
+      function = self._function(pc)
+      self._push(function, None, False)
+      self.entries[function] = self.entries.get(function, 0) + 1
+
+  def pause(self, steps):
+    # Ends a run of steps instructions.
+    self._advance(self.origin + steps)
+
+  def transfer(self, cpu, pc, target, ins, steps):
+    # Notes that ins at pc, the steps-th instruction of the run, jumped to
+    # target.
+    kind = self._kinds.get(pc)
+    if kind is None:
+      kind = self._kinds[pc] = transfer_kind(ins) or 0
+    if not kind:
+      return
+    self._advance(self.origin + steps)
+    stack = self.stack
+    if kind == CALL:
+      # ra holds the return address, after a fused far call too
+      self._call(pc, target, cpu.registers.regs[1], False)
+    elif kind == RETURN:
+      for depth in range(len(stack) - 1, 0, -1):
+        if stack[depth].return_addr == target:
+          # A tail call returns for the frames it replaced as well
+          while stack[depth].tail:
+            depth -= 1
+          while len(stack) > depth:
+            self._pop()
+          break
+    elif len(stack) > 1 and self._is_entry(target):
+      callee = self._function(target)
+      if callee == stack[-1].function:
+        return
+      # Jumping back into a function of the same tail chain unwinds to it
+      depth = len(stack) - 1
+      while stack[depth].tail:
+        depth -= 1
+        if stack[depth].function == callee:
+          while len(stack) > depth + 1:
+            self._pop()
+          return
+      self._call(pc, target, stack[-1].return_addr, True)
+
+  def finish(self):
+    # Closes every open frame at the current clock; the counts then cover
+    # the whole run.
+    while self.stack:
+      self._pop()
+
+  def _function(self, addr):
+    return self.symbols.function(addr) or UNLABELED
+
+  def _is_entry(self, addr):
+    # True when addr starts the function it belongs to.
+    entry = self._entry_addrs.get(addr)
+    if entry is None:
+      entry = self._entry_addrs[addr] = self.symbols.entry(addr) == addr
+    return entry
+
+  def _advance(self, clock):
+    # Charges the instructions since the last event to the top frame.
+    elapsed = clock - self.clock
+    if elapsed and self.stack:
+      top = self.stack[-1]
+      self.exclusive[top.function] = self.exclusive.get(top.function, 0) + elapsed
+      self.stacks[top.path] = self.stacks.get(top.path, 0) + elapsed
+    self.clock = clock
+
+  def _call(self, site, target, return_addr, tail):
+    caller = self.stack[-1].function
+    callee = self._function(target)
+    edge = self.edges.get((caller, callee, site))
+    if edge is None:
+      edge = self.edges[(caller, callee, site)] = [0, 0, target]
+    edge[0] += 1
+    self.entries[callee] = self.entries.get(callee, 0) + 1
+    self._push(callee, return_addr, tail, (caller, callee, site))
+
+  def _push(self, function, return_addr, tail, edge=None):
+    path = f"{self.stack[-1].path};{function}" if self.stack else function
+    self.stack.append(Frame(function, return_addr, self.clock, tail, path, edge))
+    self._active[function] = self._active.get(function, 0) + 1
+
+  def _pop(self):
+    frame = self.stack.pop()
+    elapsed = self.clock - frame.start
+    active = self._active[frame.function] - 1
+    self._active[frame.function] = active
+    if not active:
+      # Only the outermost activation of a recursive function counts
+      self.inclusive[frame.function] = self.inclusive.get(frame.function, 0) + elapsed
+    if frame.edge is not None:
+      self.edges[frame.edge][1] += elapsed
+
+def hot_spots(profile, symbols, limit=None):
+  # [(address, count, symbol)] by descending count.
+  items = sorted(profile.items(), key=lambda item: (-item[1], item[0]))[:limit]
+  return [(addr, count, symbols.name(addr)) for addr, count in items]
+
+def write_report(profile, symbols, out, limit=20):
+  # Writes the hottest instructions, sorted by count, to a text stream.
+  total = profile.total or 1
+  out.write(f"[Profile] {profile.total} instructions, {len(profile.items())} distinct addresses\n")
+  out.write(f"{'count':>12} {'share':>7}  {'address':<10}  symbol\n")
+  for addr, count, name in hot_spots(profile, symbols, limit):
+    out.write(f"{count:>12} {count / total:>7.2%}  0x{addr:08X}  {name}\n")
+
+def write_listing(profile, lines, line_table, out):
+  # Writes the source lines (an iterable of text lines) to a text stream,
+  # each prefixed with the executions of the instruction it assembles to.
+  # line_table maps addresses to line numbers, as Parser.line_table().
+  counts = {}
+  for addr, line_no in line_table.items():
+    counts[line_no] = profile.count(addr)
+  for line_no, text in enumerate(lines, 1):
+    count = counts.get(line_no)
+    prefix = f"{count:>12}" if count is not None else " " * 12
+    out.write(f"{prefix} {line_no:>6}  {text.rstrip()}\n")
+
+def write_collapsed(profile, symbols, out):
+  # Writes collapsed stacks for flamegraph tools: the call graph's
+  # 'caller;callee count' lines when the profile has one, else
+  # 'function;label+offset count' lines.
+  if profile.calls is not None:
+    for stack, count in profile.calls.stacks.items():
+      out.write(f"{stack} {count}\n")
+    return
+  stacks = {}
+  for addr, count in profile.items():
+    name = symbols.name(addr)
+    function = symbols.function(addr)
+    stack = f"{function};{name}" if function and function != name else name
+    stacks[stack] = stacks.get(stack, 0) + count
+  for stack, count in stacks.items():
+    out.write(f"{stack} {count}\n")
+
+def write_call_report(calls, out, limit=20):
+  # Writes the functions with the most inclusive instructions, and their
+  # calls and exclusive instructions, to a text stream.
+  total = sum(calls.exclusive.values()) or 1
+  functions = sorted(calls.inclusive, key=lambda name: (-calls.inclusive[name], name))[:limit]
+  out.write(f"[Calls] {len(calls.inclusive)} functions, {sum(edge[0] for edge in calls.edges.values())} calls\n")
+  out.write(f"{'calls':>8} {'inclusive':>12} {'share':>7} {'exclusive':>12} {'share':>7}  function\n")
+  for name in functions:
+    inclusive, exclusive = calls.inclusive[name], calls.exclusive.get(name, 0)
+    out.write(f"{calls.entries.get(name, 0):>8} {inclusive:>12} {inclusive / total:>7.2%} "
+              f"{exclusive:>12} {exclusive / total:>7.2%}  {name}\n")
+
+def write_callgrind(profile, out, command=None):
+  # Writes the profile and its call graph in the callgrind format read by
+  # KCachegrind and other callgrind viewers, with instruction addresses as
+  # positions and one event, Ir (instructions executed). Instructions are
+  # charged to the function of their address, calls to the caller frame.
+  calls = profile.calls
+  symbols = calls.symbols
+  costs = {}
+  for addr, count in profile.items():
+    costs.setdefault(symbols.function(addr) or UNLABELED, []).append((addr, count))
+  callees = {}
+  for (caller, callee, site), (count, inclusive, target) in sorted(calls.edges.items(), key=lambda item: item[0][2]):
+    callees.setdefault(caller, []).append((callee, site, count, inclusive, target))
+  out.write("# callgrind format\n")
+  out.write("version: 1\n")
+  out.write(f"creator: vm-rv32 {__version__}\n")
+  if command:
+    out.write(f"cmd: {command}\n")
+  out.write("positions: instr\n")
+  out.write("events: Ir\n")
+  out.write(f"summary: {profile.total}\n")
+  for function in sorted(costs.keys() | callees.keys()):
+    out.write(f"\nfn={function}\n")
+    for addr, count in costs.get(function, ()):
+      out.write(f"0x{addr:08X} {count}\n")
+    for callee, site, count, inclusive, target in callees.get(function, ()):
+      out.write(f"cfn={callee}\n")
+      out.write(f"calls={count} 0x{target:08X}\n")
+      out.write(f"0x{site:08X} {inclusive}\n")
@@ -0,0 +1,326 @@
+"""
+This module provides CompactProgram, a struct-of-arrays form of a parsed
+program for the RISC-V emulator.
+Instead of one Python object per instruction, the program is held as
+parallel array('i') columns (opcode, rd, rs1, rs2, imm) indexed by
+(pc - base) >> 2, and executed through a table of handler functions
+indexed by opcode id. It also behaves as a read-only {address: [instruction]}
+mapping, so tooling that expects instruction objects keeps working.
+"""
+
+from array import array
+from collections.abc import Mapping
+
+import instructions as instr
+from cpu import RunResult, StopReason
+from registers import MASK32, WRITE_MASK
+from traps import Trap
+
+# Opcode stored for addresses without an instruction.
+EMPTY = -1
+
+# --- Handlers: handler(cpu, r, rd, rs1, rs2, imm) -> next pc or None ---
+
+def _h_add(cpu, r, rd, a, b, imm): r[rd] = (r[a] + r[b]) & WRITE_MASK[rd]
+def _h_sub(cpu, r, rd, a, b, imm): r[rd] = (r[a] - r[b]) & WRITE_MASK[rd]
+def _h_sll(cpu, r, rd, a, b, imm): r[rd] = (r[a] << (r[b] & 0x1F)) & WRITE_MASK[rd]
+def _h_slt(cpu, r, rd, a, b, imm): r[rd] = ((r[a] ^ 0x80000000) < (r[b] ^ 0x80000000)) & WRITE_MASK[rd]
+def _h_sltu(cpu, r, rd, a, b, imm): r[rd] = (r[a] < r[b]) & WRITE_MASK[rd]
+def _h_xor(cpu, r, rd, a, b, imm): r[rd] = (r[a] ^ r[b]) & WRITE_MASK[rd]
+def _h_srl(cpu, r, rd, a, b, imm): r[rd] = (r[a] >> (r[b] & 0x1F)) & WRITE_MASK[rd]
+def _h_sra(cpu, r, rd, a, b, imm): r[rd] = (((r[a] ^ 0x80000000) - 0x80000000) >> (r[b] & 0x1F)) & WRITE_MASK[rd]
+def _h_or(cpu, r, rd, a, b, imm): r[rd] = (r[a] | r[b]) & WRITE_MASK[rd]
+def _h_and(cpu, r, rd, a, b, imm): r[rd] = (r[a] & r[b]) & WRITE_MASK[rd]
+def _h_mul(cpu, r, rd, a, b, imm): r[rd] = (r[a] * r[b]) & WRITE_MASK[rd]
+
+def _h_addi(cpu, r, rd, a, b, imm): r[rd] = (r[a] + imm) & WRITE_MASK[rd]
+def _h_slti(cpu, r, rd, a, b, imm): r[rd] = (((r[a] ^ 0x80000000) - 0x80000000) < imm) & WRITE_MASK[rd]
+def _h_sltiu(cpu, r, rd, a, b, imm): r[rd] = (r[a] < (imm & MASK32)) & WRITE_MASK[rd]
+def _h_xori(cpu, r, rd, a, b, imm): r[rd] = (r[a] ^ imm) & WRITE_MASK[rd]
+def _h_ori(cpu, r, rd, a, b, imm): r[rd] = (r[a] | imm) & WRITE_MASK[rd]
+def _h_andi(cpu, r, rd, a, b, imm): r[rd] = (r[a] & imm) & WRITE_MASK[rd]
+def _h_slli(cpu, r, rd, a, b, imm): r[rd] = (r[a] << imm) & WRITE_MASK[rd]
+def _h_srli(cpu, r, rd, a, b, imm): r[rd] = (r[a] >> imm) & WRITE_MASK[rd]
+def _h_srai(cpu, r, rd, a, b, imm): r[rd] = (((r[a] ^ 0x80000000) - 0x80000000) >> imm) & WRITE_MASK[rd]
+
+def _h_load(size, signed):
+  def handler(cpu, r, rd, a, b, imm):
+    r[rd] = cpu.memory.read((r[a] + imm) & MASK32, size, signed) & WRITE_MASK[rd]
+  return handler
+
+def _h_store(size):
+  def handler(cpu, r, rd, a, b, imm):
+    cpu.memory.write((r[a] + imm) & MASK32, size, r[b])
+  return handler
+
+def _h_beq(cpu, r, rd, a, b, imm):
+  if r[a] == r[b]: return (cpu.pc + imm) & MASK32
+def _h_bne(cpu, r, rd, a, b, imm):
+  if r[a] != r[b]: return (cpu.pc + imm) & MASK32
+def _h_blt(cpu, r, rd, a, b, imm):
+  if (r[a] ^ 0x80000000) < (r[b] ^ 0x80000000): return (cpu.pc + imm) & MASK32
+def _h_bge(cpu, r, rd, a, b, imm):
+  if (r[a] ^ 0x80000000) >= (r[b] ^ 0x80000000): return (cpu.pc + imm) & MASK32
+def _h_bltu(cpu, r, rd, a, b, imm):
+  if r[a] < r[b]: return (cpu.pc + imm) & MASK32
+def _h_bgeu(cpu, r, rd, a, b, imm):
+  if r[a] >= r[b]: return (cpu.pc + imm) & MASK32
+
+def _h_lui(cpu, r, rd, a, b, imm): r[rd] = (imm << 12) & WRITE_MASK[rd]
+def _h_auipc(cpu, r, rd, a, b, imm): r[rd] = (cpu.pc + (imm << 12)) & WRITE_MASK[rd]
+
+def _h_jal(cpu, r, rd, a, b, imm):
+  pc = cpu.pc
+  r[rd] = (pc + 4) & WRITE_MASK[rd]
+  return (pc + imm) & MASK32
+
+def _h_jalr(cpu, r, rd, a, b, imm):
+  target = (r[a] + imm) & 0xFFFFFFFE
+  r[rd] = (cpu.pc + 4) & WRITE_MASK[rd]
+  return target
+
+# Opcode table: (class, handler, constructor fields). An instruction's
+# opcode id is its position here.
+OPCODES = [
+  (instr.Add, _h_add, ('rd', 'rs1', 'rs2')),
+  (instr.Sub, _h_sub, ('rd', 'rs1', 'rs2')),
+  (instr.Sll, _h_sll, ('rd', 'rs1', 'rs2')),
+  (instr.Slt, _h_slt, ('rd', 'rs1', 'rs2')),
+  (instr.Sltu, _h_sltu, ('rd', 'rs1', 'rs2')),
+  (instr.Xor, _h_xor, ('rd', 'rs1', 'rs2')),
+  (instr.Srl, _h_srl, ('rd', 'rs1', 'rs2')),
+  (instr.Sra, _h_sra, ('rd', 'rs1', 'rs2')),
+  (instr.Or, _h_or, ('rd', 'rs1', 'rs2')),
+  (instr.And, _h_and, ('rd', 'rs1', 'rs2')),
+  (instr.Mul, _h_mul, ('rd', 'rs1', 'rs2')),
+  (instr.Addi, _h_addi, ('rd', 'rs1', 'imm')),
+  (instr.Slti, _h_slti, ('rd', 'rs1', 'imm')),
+  (instr.Sltiu, _h_sltiu, ('rd', 'rs1', 'imm')),
+  (instr.Xori, _h_xori, ('rd', 'rs1', 'imm')),
+  (instr.Ori, _h_ori, ('rd', 'rs1', 'imm')),
+  (instr.Andi, _h_andi, ('rd', 'rs1', 'imm')),
+  (instr.Slli, _h_slli, ('rd', 'rs1', 'imm')),
+  (instr.Srli, _h_srli, ('rd', 'rs1', 'imm')),
+  (instr.Srai, _h_srai, ('rd', 'rs1', 'imm')),
+  (instr.Lw, _h_load(4, True), ('rd', 'rs1', 'imm')),
+  (instr.Lh, _h_load(2, True), ('rd', 'rs1', 'imm')),
+  (instr.Lhu, _h_load(2, False), ('rd', 'rs1', 'imm')),
+  (instr.Lb, _h_load(1, True), ('rd', 'rs1', 'imm')),
+  (instr.Lbu, _h_load(1, False), ('rd', 'rs1', 'imm')),
+  (instr.Sw, _h_store(4), ('rs1', 'rs2', 'imm')),
+  (instr.Sh, _h_store(2), ('rs1', 'rs2', 'imm')),
+  (instr.Sb, _h_store(1), ('rs1', 'rs2', 'imm')),
+  (instr.Beq, _h_beq, ('rs1', 'rs2', 'imm')),
+  (instr.Bne, _h_bne, ('rs1', 'rs2', 'imm')),
+  (instr.Blt, _h_blt, ('rs1', 'rs2', 'imm')),
+  (instr.Bge, _h_bge, ('rs1', 'rs2', 'imm')),
+  (instr.Bltu, _h_bltu, ('rs1', 'rs2', 'imm')),
+  (instr.Bgeu, _h_bgeu, ('rs1', 'rs2', 'imm')),
+  (instr.Lui, _h_lui, ('rd', 'imm')),
+  (instr.Auipc, _h_auipc, ('rd', 'imm')),
+  (instr.Jal, _h_jal, ('rd', 'imm')),
+  (instr.Jalr, _h_jalr, ('rd', 'rs1', 'imm')),
+]
+
+# Opcode for instructions kept as objects (system and meta instructions);
+# their imm column holds an index into CompactProgram.objects.
+OBJECT = len(OPCODES)
+
+OPCODE_IDS = {cls: op for op, (cls, _, _) in enumerate(OPCODES)}
+
+class CompactProgram(Mapping):
+  """
+  A program stored as parallel arrays with table-driven dispatch.
+  Built from a parsed {address: [instruction]} map; indexing it by address
+  returns an equivalent [instruction] list rebuilt from the columns.
+  """
+
+  def __init__(self, program=None):
+    if program:
+      base = min(program)
+      length = ((max(program) - base) >> 2) + 1
+    else:
+      base, length = 0, 0
+    self._allocate(base, length)
+    for addr, instructions in (program or {}).items():
+      if len(instructions) != 1:
+        raise ValueError(f"Cannot encode address 0x{addr:08X}: expected one word-aligned instruction")
+      self.put(addr, instructions[0])
+
+  @classmethod
+  def allocate(cls, base, length):
+    # Empty program with room for length instructions from base, to be
+    # filled in with put().
+    self = cls.__new__(cls)
+    self._allocate(base, length)
+    return self
+
+  def _allocate(self, base, length):
+    self.base = base
+    self.opcode = array('i', [EMPTY]) * length
+    self.rd = array('i', [0]) * length
+    self.rs1 = array('i', [0]) * length
+    self.rs2 = array('i', [0]) * length
+    self.imm = array('i', [0]) * length
+    # 1 where the instruction used the 'sp' alias and needs a stack check.
+    self.flags = array('b', [0]) * length
+    # Instructions that do not fit the columns, referenced by imm.
+    self.objects = []
+    self._count = 0
+    # Dispatch table indexed by opcode id.
+    self.handlers = [handler for _, handler, _ in OPCODES] + [self._execute_object]
+
+  @classmethod
+  def from_columns(cls, base, opcode, rd, rs1, rs2, imm, flags, objects, count=None):
+    # Wraps existing columns without copying them. The columns may be any
+    # integer sequences, e.g. memoryview casts over a mapped object file;
+    # those have no count(), so pass count, the number of non-empty slots.
+    self = cls.__new__(cls)
+    self.base = base
+    self.opcode, self.rd, self.rs1, self.rs2, self.imm, self.flags = opcode, rd, rs1, rs2, imm, flags
+    self.objects = list(objects)
+    self._count = len(opcode) - opcode.count(EMPTY) if count is None else count
+    self.handlers = [handler for _, handler, _ in OPCODES] + [self._execute_object]
+    return self
+
+  def __reduce__(self):
+    # Pickles as the raw columns; the handler table is rebuilt on load.
+    return (CompactProgram.from_columns,
+            (self.base, array('i', self.opcode), array('i', self.rd), array('i', self.rs1),
+             array('i', self.rs2), array('i', self.imm), array('b', self.flags), self.objects,
+             self._count))
+
+  def copy(self):
+    # Copy with writable columns of its own, e.g. of a mapped object file.
+    return CompactProgram.from_columns(*self.__reduce__()[1])
+
+  def _grow(self, length):
+    # Extends the columns with empty slots up to length.
+    missing = length - len(self.opcode)
+    if missing > 0:
+      self.opcode.extend(array('i', [EMPTY]) * missing)
+      for column in (self.rd, self.rs1, self.rs2, self.imm):
+        column.extend(array('i', [0]) * missing)
+      self.flags.extend(array('b', [0]) * missing)
+
+  def splice(self, other):
+    # Copies the slots of other, a program over a later address range, into
+    # this one, replacing what was there. Leading empty slots of other are
+    # skipped so they do not erase instructions already stored.
+    offset = other.base - self.base
+    if offset < 0 or offset & 3:
+      raise ValueError(f"Cannot splice a program based at 0x{other.base:08X}")
+    n = len(other.opcode)
+    lead = 0
+    while lead < n and other.opcode[lead] == EMPTY:
+      lead += 1
+    start = (offset >> 2) + lead
+    self._grow(start + n - lead)
+    for name in ('opcode', 'rd', 'rs1', 'rs2', 'imm', 'flags'):
+      getattr(self, name)[start:start + n - lead] = getattr(other, name)[lead:]
+    # Rebase object references onto this program's side table.
+    base, imm = len(self.objects), self.imm
+    for i in range(lead, n):
+      if other.opcode[i] == OBJECT:
+        imm[start + i - lead] += base
+    self.objects.extend(other.objects)
+    self._count = len(self.opcode) - self.opcode.count(EMPTY)
+
+  def put(self, addr, ins):
+    # Stores ins at addr, replacing any instruction there and growing the
+    # columns when addr lies past the end.
+    offset = addr - self.base
+    if offset < 0 or offset & 3:
+      raise ValueError(f"Cannot encode address 0x{addr:08X}: expected one word-aligned instruction")
+    idx = offset >> 2
+    self._grow(idx + 1)
+    if self.opcode[idx] == EMPTY:
+      self._count += 1
+    op = OPCODE_IDS.get(type(ins))
+    if op is None:
+      self.opcode[idx] = OBJECT
+      self.rd[idx] = self.rs1[idx] = self.rs2[idx] = 0
+      self.imm[idx] = len(self.objects)
+      self.objects.append(ins)
+    else:
+      self.opcode[idx] = op
+      self.rd[idx] = getattr(ins, 'rd', 0)
+      self.rs1[idx] = getattr(ins, 'rs1', 0)
+      self.rs2[idx] = getattr(ins, 'rs2', 0)
+      self.imm[idx] = ins.imm if hasattr(ins, 'imm') else 0
+    self.flags[idx] = "use_sp" in ins.tags
+
+  def _execute_object(self, cpu, r, rd, rs1, rs2, imm):
+    return self.objects[imm].execute(cpu)
+
+  @property
+  def nbytes(self):
+    # Bytes held by the columns.
+    return sum(col.itemsize * len(col) for col in
+               (self.opcode, self.rd, self.rs1, self.rs2, self.imm, self.flags))
+
+  def _index(self, addr):
+    # Slot index for addr, or None if no instruction lives there.
+    offset = addr - self.base
+    if offset < 0 or offset & 3 or (offset >> 2) >= len(self.opcode):
+      return None
+    idx = offset >> 2
+    return idx if self.opcode[idx] != EMPTY else None
+
+  def instruction(self, idx):
+    # Rebuilds the instruction object stored in slot idx.
+    op = self.opcode[idx]
+    if op == OBJECT:
+      return self.objects[self.imm[idx]]
+    cls, _, fields = OPCODES[op]
+    ins = cls(*(getattr(self, name)[idx] for name in fields))
+    if self.flags[idx]:
+      ins.tag("use_sp")
+    return ins
+
+  def __getitem__(self, addr):
+    idx = self._index(addr)
+    if idx is None:
+      raise KeyError(addr)
+    return [self.instruction(idx)]
+
+  def __iter__(self):
+    base, opcode = self.base, self.opcode
+    return (base + (idx << 2) for idx in range(len(opcode)) if opcode[idx] != EMPTY)
+
+  def __len__(self):
+    return self._count
+
+  def run(self, cpu, max_steps=None):
+    # Runs from cpu.pc with the same stop rules as CPU.run(), dispatching
+    # straight from the columns. Returns a RunResult.
+    opcode, rd, rs1, rs2, imm, flags = self.opcode, self.rd, self.rs1, self.rs2, self.imm, self.flags
+    handlers = self.handlers
+    r = cpu.registers.regs
+    base, span = self.base, len(opcode) << 2
+    budget = -1 if max_steps is None else max_steps
+    check_stack = cpu._check_stack
+    steps = 0
+    pc = cpu.pc
+    try:
+      while steps != budget:
+        pc = cpu.pc
+        offset = pc - base
+        if offset < 0 or offset >= span or offset & 3:
+          return cpu._end(pc, steps)
+        idx = offset >> 2
+        op = opcode[idx]
+        if op == EMPTY:
+          return cpu._end(pc, steps)
+        target = handlers[op](cpu, r, rd[idx], rs1[idx], rs2[idx], imm[idx])
+        steps += 1
+        cpu.pc = pc + 4 if target is None else target
+        if flags[idx]:
+          check_stack()
+        if cpu.halted:
+          reason = StopReason.HALT if cpu.exit_code is None else StopReason.EXIT
+          return RunResult(reason, steps, cpu.pc)
+    except Trap as trap:
+      cpu._take_trap(trap, pc)
+      return RunResult(StopReason.TRAP, steps, cpu.pc)
+    return RunResult(StopReason.STEP_LIMIT, steps, cpu.pc)
@@ -3,12 +3,23 @@ This module provides the RegisterFile class for the RISC-V emulator.
 It manages 32 general-purpose 32-bit registers.
 """
 
+# Truncates a value to 32 bits.
+MASK32 = 0xFFFFFFFF
+
+# Per-register write masks: writes to x0 are masked to zero instead of
+# being branched around, and every other write is truncated to 32 bits.
+WRITE_MASK = (0,) + (MASK32,) * 31
+
 class RegisterFile:
   """
   Manages the 32 general-purpose registers (x0-x31).
   Register x0 is hardwired to zero.
+  Hot paths use get()/set() or the raw regs list with integer indices;
+  read()/write() and item access also accept alias strings such as 'sp'.
   """
 
+  __slots__ = ('regs',)
+
   ALIAS_MAP = {
     "zero": 0, "ra": 1, "sp": 2, "gp": 3, "tp": 4,
     "t0": 5, "t1": 6, "t2": 7, "s0": 8, "fp": 8, "s1": 9,
@@ -18,8 +29,9 @@ class RegisterFile:
   }
 
   def __init__(self):
-    # Initialize 32 registers to 0.
-    self._regs = [0] * 32
+    # Initialize 32 registers to 0. Values are always kept as unsigned
+    # 32-bit ints and regs[0] is always 0, so the list can be read directly.
+    self.regs = [0] * 32
 
   def _resolve(self, key):
     # Resolves a key (index or alias) to a valid register index (0-31).
@@ -33,24 +45,35 @@ class RegisterFile:
         raise ValueError(f"Unknown register alias: {key}")
     else:
       idx = key
-    
+
     if not (0 <= idx < 32):
       raise IndexError(f"Register index out of range: {idx}")
     return idx
 
+  def get(self, idx):
+    # Fast read by integer index 0-31.
+    return self.regs[idx]
+
+  def set(self, idx, value):
+    # Fast write by integer index 0-31; writes to x0 are discarded.
+    self.regs[idx] = value & WRITE_MASK[idx]
+
   def read(self, key):
-    # Reads the value of a register. x0 always returns 0.
-    idx = self._resolve(key)
-    if idx == 0:
-      return 0
-    return self._regs[idx] & 0xFFFFFFFF
+    # Reads the value of a register by index or alias. x0 always returns 0.
+    return self.regs[self._resolve(key)]
 
   def write(self, key, value):
-    # Writes a value to a register. x0 remains 0.
+    # Writes a value to a register by index or alias. x0 remains 0.
     idx = self._resolve(key)
-    if idx == 0:
-      return
-    self._regs[idx] = value & 0xFFFFFFFF
+    self.regs[idx] = value & WRITE_MASK[idx]
+
+  def snapshot(self):
+    # Returns an immutable copy of all register values.
+    return tuple(self.regs)
+
+  def restore(self, values):
+    # Loads register values previously returned by snapshot().
+    self.regs[:] = values
 
   def __getitem__(self, key):
     # Allows array-style access: rf[0].
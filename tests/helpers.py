@@ -0,0 +1,22 @@
+"""
+Shared fixtures for the unit tests.
+"""
+
+import io
+from contextlib import redirect_stdout
+from cpu import CPU
+
+def load_parsed(cpu, parsed):
+  # Resets cpu to the start of a parse result and loads its data segments.
+  cpu.reset(start_pc=parsed['start_addr'])
+  for base, chunk in parsed['segments']:
+    cpu.memory.load_segment(base, chunk)
+  return cpu
+
+def run_parsed(parsed, run):
+  # Calls run(cpu) on a fresh CPU loaded with a parse result, capturing
+  # what it prints. Returns (cpu, run's result, output).
+  cpu = load_parsed(CPU(), parsed)
+  with redirect_stdout(io.StringIO()) as out:
+    result = run(cpu)
+  return cpu, result, out.getvalue()
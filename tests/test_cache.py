@@ -0,0 +1,141 @@
+"""
+Unit tests for the persistent parse cache.
+A cached program must run exactly like a freshly parsed one, and the
+cache must miss on any change to the source and stay within its budget.
+"""
+
+import unittest
+import os
+import tempfile
+from unittest import mock
+from parser import Parser
+from hooks import attach
+import program
+from cache import ParseCache, SUFFIX
+from tests.helpers import run_parsed
+
+TUTORIAL_DIR = os.path.join(os.path.dirname(__file__), '..', 'tutorial')
+
+SOURCE = """
+.data
+table: .word 1, 2, 3
+msg: .string "ok"
+.text
+main:
+  la x5, table
+  lw x6, 4(x5)
+  @assert eq(x6, 2)
+"""
+
+class TestParseCache(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.cache = ParseCache(self.tmp.name)
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def entries(self):
+    return sorted(name for name in os.listdir(self.tmp.name) if name.endswith(SUFFIX))
+
+  def test_round_trip(self):
+    fresh = Parser().parse_program(SOURCE)
+    self.assertIsNone(self.cache.load(SOURCE))
+    self.cache.parse(SOURCE)
+    cached = self.cache.load(SOURCE)
+    self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+    self.assertEqual(cached['segments'], fresh['segments'])
+    self.assertEqual(cached['labels'], fresh['labels'])
+    self.assertEqual(cached['start_addr'], fresh['start_addr'])
+    self.assertEqual(cached['data'][fresh['labels']['msg']], ord('o'))
+    self.assertEqual(sorted(cached['instructions']), sorted(fresh['instructions']))
+    self.assertEqual(cached['instructions'][4][0].tags, fresh['instructions'][4][0].tags)
+
+  def test_tutorials_run_from_cache(self):
+    for name in sorted(os.listdir(TUTORIAL_DIR)):
+      if not name.endswith('.s'): continue
+      with open(os.path.join(TUTORIAL_DIR, name)) as f:
+        source = f.read()
+      self.cache.parse(source)
+      cpus = []
+      for result in (Parser().parse_program(source), self.cache.load(source)):
+        program = attach(result['instructions'], result['hooks'], result['fallthrough_hooks'])
+        cpu, _, out = run_parsed(result, lambda cpu: cpu.run(program))
+        cpus.append((cpu.pc, cpu.registers.snapshot(), out))
+      with self.subTest(tutorial=name):
+        self.assertEqual(cpus[0], cpus[1])
+
+  def test_key_changes_with_source(self):
+    self.cache.parse(SOURCE)
+    self.assertIsNone(self.cache.load(SOURCE + "\naddi x1, x0, 1"))
+    self.assertNotEqual(self.cache.key(SOURCE), self.cache.key(SOURCE.replace("2)", "3)")))
+    self.assertEqual(self.cache.key(SOURCE), ParseCache(self.tmp.name).key(SOURCE))
+
+  def test_key_changes_with_parser(self):
+    # Parallel and lazy parses return other program types than a plain one
+    keys = {self.cache.key(SOURCE, asm_parser) for asm_parser in
+            (None, Parser(workers=2), Parser(lazy=True), Parser(workers=2, lazy=True))}
+    self.assertEqual(len(keys), 4)
+    self.assertEqual(self.cache.key(SOURCE, Parser()), self.cache.key(SOURCE))
+    self.cache.parse(SOURCE, Parser(workers=2))
+    self.assertIsNone(self.cache.load(SOURCE))
+    self.assertIsNotNone(self.cache.load(SOURCE, Parser(workers=2)))
+
+    # So does a change to the program module, which cached programs pickle
+    with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as f:
+      f.write("# changed\n")
+    self.addCleanup(os.unlink, f.name)
+    with mock.patch.object(program, '__file__', f.name):
+      self.assertNotEqual(ParseCache(self.tmp.name).key(SOURCE), self.cache.key(SOURCE))
+
+  def test_corrupt_entry_is_a_miss(self):
+    self.cache.parse(SOURCE)
+    path = os.path.join(self.tmp.name, self.entries()[0])
+    with open(path, 'wb') as f:
+      f.write(b'not a pickle')
+    self.assertIsNone(self.cache.load(SOURCE))
+    self.assertEqual(self.entries(), [])
+
+  def test_eviction(self):
+    sources = [f"addi x1, x0, {i}\n" * 50 for i in range(4)]
+    for i, source in enumerate(sources):
+      self.cache.parse(source)
+      # Spread the modification times one hour apart, oldest first
+      os.utime(os.path.join(self.tmp.name, self.cache.key(source) + SUFFIX), (i * 3600, i * 3600))
+    size = os.path.getsize(os.path.join(self.tmp.name, self.entries()[0]))
+
+    # Too old
+    self.cache.max_age = 2.5 * 3600
+    self.cache.evict(now=4 * 3600)
+    self.assertIsNone(self.cache.load(sources[0]))
+    self.assertIsNone(self.cache.load(sources[1]))
+
+    # Over budget: the least recently used entry goes first
+    self.cache.max_age = float('inf')
+    self.cache.max_bytes = size
+    self.cache.evict()
+    self.assertEqual(len(self.entries()), 1)
+    self.assertIsNotNone(self.cache.load(sources[3]))
+
+    self.cache.clear()
+    self.assertEqual(self.entries(), [])
+
+  def test_unwritable_directory(self):
+    path = os.path.join(self.tmp.name, 'file')
+    open(path, 'w').close()
+    cache = ParseCache(os.path.join(path, 'sub'))
+    result = cache.parse(SOURCE)
+    self.assertIn(0, result['instructions'])
+    self.assertIsNone(cache.load(SOURCE))
+
+  def test_failed_store_leaves_no_temp_file(self):
+    result = Parser().parse_program(SOURCE)
+    # An unpicklable result and a failing rename are both skipped
+    self.cache.store(SOURCE, dict(result, labels=lambda: None))
+    with mock.patch('os.replace', side_effect=OSError("disk full")):
+      self.cache.store(SOURCE, result)
+    self.assertEqual(os.listdir(self.tmp.name), [])
+    self.assertIsNone(self.cache.load(SOURCE))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -4,11 +4,14 @@ Aims for 100% code coverage.
 """
 
 import unittest
-from cpu import CPU
+from cpu import CPU, StopReason
 from registers import RegisterFile
 from memory import Memory
 import instructions as instr
 import expressions as expr
+import io
+from contextlib import redirect_stdout
+from traps import Trap, LoadAccessFault, StoreAccessFault, MisalignedAccess, IllegalInstruction, Breakpoint, AssertionFailure
 
 class TestCore(unittest.TestCase):
   def setUp(self):
@@ -33,6 +36,19 @@ class TestCore(unittest.TestCase):
     self.cpu.registers['sp'] = 0x456
     self.assertEqual(self.cpu.registers[2], 0x456)
 
+  def test_register_fast_path(self):
+    rf = RegisterFile()
+    rf.set(5, -1)
+    self.assertEqual(rf.get(5), 0xFFFFFFFF)
+    self.assertEqual(rf.regs[5], 0xFFFFFFFF)
+    # Writes to x0 are masked away
+    rf.set(0, 123)
+    self.assertEqual(rf.regs[0], 0)
+    instr.Addi(0, 5, 1).execute(self.cpu)
+    instr.Lui(0, 0x12345).execute(self.cpu)
+    self.assertEqual(self.cpu.registers.regs[0], 0)
+    self.assertFalse(hasattr(rf, '__dict__'))
+
   def test_cpu_reset(self):
     self.cpu.registers[1] = 100
     self.cpu.pc = 200
@@ -42,11 +58,140 @@ class TestCore(unittest.TestCase):
     self.assertEqual(self.cpu.pc, 0)
     self.assertFalse(self.cpu.halted)
 
+  def test_cpu_paged_memory(self):
+    cpu = CPU(paged=True)
+    self.assertEqual(cpu.registers['sp'], 65536)
+    cpu.registers[1] = 0x80000000
+    cpu.registers[2] = 0xCAFEBABE
+    instr.Sw(1, 2, 16).execute(cpu)
+    instr.Lw(3, 1, 16).execute(cpu)
+    self.assertEqual(cpu.registers[3], 0xCAFEBABE)
+    self.assertFalse(cpu.halted)
+
+    # Reset keeps the paged configuration but clears the contents
+    cpu.reset()
+    self.assertEqual(cpu.memory.resident_pages, 0)
+    self.assertEqual(cpu.memory.read(0x80000010, 4), 0)
+
+  def test_cpu_snapshot_restore(self):
+    for cpu in (CPU(mem_size=1024), CPU(paged=True)):
+      cpu.pc = 0x40
+      cpu.registers[5] = 7
+      cpu.memory.write(0x100, 4, 0x12345678)
+      snap = cpu.snapshot()
+
+      cpu.registers[5] = 99
+      cpu.pc = 0x80
+      cpu.halted = True
+      cpu.memory.write(0x100, 4, 0)
+      cpu.restore(snap)
+      self.assertEqual(cpu.registers[5], 7)
+      self.assertEqual(cpu.pc, 0x40)
+      self.assertFalse(cpu.halted)
+      self.assertEqual(cpu.memory.read(0x100, 4), 0x12345678)
+
+      # A snapshot can also be restored after a full reset
+      cpu.reset()
+      cpu.restore(snap)
+      self.assertEqual(cpu.memory.read(0x100, 4), 0x12345678)
+      self.assertEqual(cpu.registers['sp'], snap.registers[2])
+
   def test_cpu_step_error(self):
     # No instruction at PC
     self.cpu.pc = 0x1234
-    self.cpu.step({})
+    with redirect_stdout(io.StringIO()):
+      self.cpu.step({})
+    self.assertTrue(self.cpu.halted)
+    self.assertIsInstance(self.cpu.trap, IllegalInstruction)
+    self.assertEqual(self.cpu.trap.pc, 0x1234)
+
+  def test_cpu_run_stop_reasons(self):
+    # Loop: x1 += 1 until x1 == 3, then fall off the end
+    program = {
+      0: [instr.Addi(2, 0, 3)],
+      4: [instr.Addi(1, 1, 1)],
+      8: [instr.Bne(1, 2, -4)],
+    }
+    result = self.cpu.run(program)
+    self.assertEqual(result.reason, StopReason.END)
+    self.assertEqual(result.steps, 7)
+    self.assertEqual(result.pc, 12)
+    self.assertEqual(self.cpu.registers[1], 3)
+
+    # Step budget, then resume where it stopped
+    self.cpu.reset()
+    result = self.cpu.run(program, max_steps=2)
+    self.assertEqual(result.reason, StopReason.STEP_LIMIT)
+    self.assertEqual(self.cpu.pc, 8)
+    self.assertEqual(self.cpu.run(program).steps, 5)
+
+    # Exit syscall
+    self.cpu.reset()
+    self.cpu.registers[10] = 7
+    result = self.cpu.run({0: [instr.Addi(17, 0, 10)], 4: [instr.Ecall()], 8: [instr.Addi(1, 0, 1)]})
+    self.assertEqual(result.reason, StopReason.EXIT)
+    self.assertEqual(self.cpu.exit_code, 7)
+    self.assertEqual(self.cpu.registers[1], 0)
+
+    # Breakpoint trap
+    self.cpu.reset()
+    with redirect_stdout(io.StringIO()) as out:
+      result = self.cpu.run({0: [instr.Ebreak()]})
+    self.assertEqual(result.reason, StopReason.TRAP)
+    self.assertEqual(result.steps, 0)
+    self.assertIsInstance(self.cpu.trap, Breakpoint)
+    self.assertIn("EBREAK triggered at PC=0x00000000", out.getvalue())
+
+  def test_cpu_run_traps(self):
+    # The faulting load does not retire; the PC stays on it
+    program = {
+      0: [instr.Addi(1, 0, 2000)],
+      4: [instr.Lw(3, 1, 0)],
+      8: [instr.Addi(4, 0, 1)],
+    }
+    with redirect_stdout(io.StringIO()) as out:
+      result = self.cpu.run(program)
+    self.assertEqual(result.reason, StopReason.TRAP)
+    self.assertEqual((result.steps, result.pc), (1, 4))
     self.assertTrue(self.cpu.halted)
+    self.assertEqual(self.cpu.registers[4], 0)
+    self.assertIsInstance(self.cpu.trap, LoadAccessFault)
+    self.assertEqual(self.cpu.trap.report(), {
+      "cause": "load_access_fault", "code": 5, "pc": 4, "addr": 2000,
+      "message": "Memory Error: Read out of bounds at 0x000007D0 (size 4)"})
+    self.assertIn("Memory Error: Read out of bounds", out.getvalue())
+
+    # Stores, misaligned jumps and failed assertions trap the same way
+    self.cpu.reset()
+    with redirect_stdout(io.StringIO()):
+      self.cpu.run({0: [instr.Sw(0, 0, -4)]})
+    self.assertIsInstance(self.cpu.trap, StoreAccessFault)
+
+    self.cpu.reset()
+    with redirect_stdout(io.StringIO()):
+      result = self.cpu.run({0: [instr.Jal(0, 6)], 4: [instr.Addi(1, 0, 1)]})
+    self.assertEqual(result.reason, StopReason.TRAP)
+    self.assertIsInstance(self.cpu.trap, MisalignedAccess)
+    self.assertEqual(self.cpu.trap.addr, 6)
+
+    self.cpu.reset()
+    failing = instr.Assert(expr.Eq(expr.RegAccess(1), expr.Literal(1)), "eq(x1, 1)")
+    with redirect_stdout(io.StringIO()) as out:
+      result = self.cpu.run({0: [instr.Addi(2, 0, 1)], 4: [failing]})
+    self.assertIsInstance(self.cpu.trap, AssertionFailure)
+    self.assertEqual((result.steps, self.cpu.trap.pc), (1, 4))
+    self.assertEqual(out.getvalue(), "[ASSERTION FAILED] eq(x1, 1)\n")
+
+    # reset() clears the recorded trap
+    self.cpu.reset()
+    self.assertIsNone(self.cpu.trap)
+
+  def test_cpu_run_stack_check(self):
+    nop_sp = instr.Addi(2, 2, -1024)
+    nop_sp.tag("use_sp")
+    result = self.cpu.run({0: [instr.Addi(2, 2, -1024)], 4: [nop_sp]})
+    self.assertEqual(result.reason, StopReason.HALT)
+    self.assertEqual(result.steps, 2)
 
   def test_arithmetic(self):
     # ADD
@@ -122,6 +267,24 @@ class TestCore(unittest.TestCase):
     instr.Sltiu(3, 1, -1).execute(self.cpu) # 10 < 0xFFFFFFFF -> 1
     self.assertEqual(self.cpu.registers[3], 1)
 
+  def test_immediate_normalization(self):
+    # Immediates are sign-extended or masked once, at construction
+    self.assertEqual(instr.Addi(1, 0, 0xFFF).imm, -1)
+    self.assertEqual(instr.Sw(1, 2, 0x800).imm, -2048)
+    self.assertEqual(instr.Beq(1, 2, -4).imm, -4)
+    self.assertEqual(instr.Jal(0, 0xFFFFC).imm, -4)
+    self.assertEqual(instr.Slli(1, 1, 33).imm, 1)
+    self.assertEqual(instr.Lui(1, -1).imm, 0xFFFFF)
+
+    # Instructions carry no per-instance dict and share one empty tag set
+    a, b = instr.Add(1, 2, 3), instr.Lw(1, 2, 0)
+    self.assertFalse(hasattr(a, '__dict__'))
+    self.assertFalse(hasattr(b, '__dict__'))
+    self.assertIs(a.tags, b.tags)
+    a.tag("use_sp")
+    self.assertIn("use_sp", a.tags)
+    self.assertEqual(b.tags, frozenset())
+
   def test_control_flow(self):
     # BEQ (taken)
     self.cpu.pc = 100
@@ -171,10 +334,11 @@ class TestCore(unittest.TestCase):
     assertion = instr.Assert(expr.Eq(expr.RegAccess(1), expr.Literal(5)), "eq(x1, 5)")
     assertion.execute(self.cpu)
     
-    # Failed assertion
-    with self.assertRaises(AssertionError):
+    # Failed assertion raises a trap that is also an AssertionError
+    with self.assertRaises(AssertionError) as ctx:
       instr.Assert(expr.Eq(expr.RegAccess(1), expr.Literal(10)), "eq(x1, 10)").execute(self.cpu)
-    self.assertTrue(self.cpu.halted)
+    self.assertIsInstance(ctx.exception, Trap)
+    self.assertEqual(ctx.exception.message, "[ASSERTION FAILED] eq(x1, 10)")
 
   def test_complex_expressions(self):
     # and(eq(x1, 5), not(eq(x2, 0)))
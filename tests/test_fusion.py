@@ -0,0 +1,133 @@
+"""
+Unit tests for macro-op fusion.
+Every tutorial is run fused and unfused and the resulting architectural
+state must match; the pair kinds, mid-pair entry and traps are checked
+individually.
+"""
+
+import unittest
+import os
+import io
+from contextlib import redirect_stdout
+from cpu import CPU, StopReason
+from parser import Parser
+from hooks import attach
+from program import CompactProgram
+from fusion import fuse, fused_count, FusedConstant, FusedPcLoad, FusedFarCall, FusedBranch
+from traps import LoadAccessFault
+import instructions as instr
+from tests.helpers import run_parsed
+
+TUTORIAL_DIR = os.path.join(os.path.dirname(__file__), '..', 'tutorial')
+
+def run(parse_result, program, engine=CPU.run):
+  # Runs program on a fresh CPU with the parsed data loaded.
+  return run_parsed(parse_result, lambda cpu: engine(cpu, program))
+
+class TestFusion(unittest.TestCase):
+  def test_matches_unfused_on_tutorials(self):
+    for name in sorted(os.listdir(TUTORIAL_DIR)):
+      if not name.endswith('.s'): continue
+      with open(os.path.join(TUTORIAL_DIR, name)) as f:
+        parsed = Parser().parse_program(f.read())
+      program = attach(parsed['instructions'], parsed['hooks'], parsed['fallthrough_hooks'])
+      fused = fuse(program)
+      reference, expected, out_ref = run(parsed, program)
+      for engine in (CPU.run, lambda cpu, p: CompactProgram(p).run(cpu)):
+        cpu, result, out = run(parsed, fused, engine)
+        with self.subTest(tutorial=name):
+          self.assertEqual(result.reason, expected.reason)
+          # A fused pair is a single dispatch
+          self.assertLessEqual(result.steps, expected.steps)
+          self.assertEqual(cpu.pc, reference.pc)
+          self.assertEqual(cpu.registers.snapshot(), reference.registers.snapshot())
+          self.assertEqual(cpu.memory.snapshot().contents, reference.memory.snapshot().contents)
+          self.assertEqual(out, out_ref)
+
+  def test_pair_kinds(self):
+    source = """
+    .data
+    v: .word 0x55
+    .text
+    main:
+      li t0, 0x12345678
+      la t1, v
+      lw t2, v
+      slt t3, t0, t2
+      bnez t3, skip
+      addi a0, a0, 1
+    skip:
+      call 0x200000
+    """
+    parsed = Parser().parse_program(source)
+    program = fuse(parsed['instructions'])
+    kinds = {addr: type(program[addr][0]) for addr in (0, 8, 16, 24, 36)}
+    self.assertEqual(kinds, {0: FusedConstant, 8: FusedConstant, 16: FusedPcLoad,
+                             24: FusedBranch, 36: FusedFarCall})
+    # The second halves keep their own slots
+    self.assertIsInstance(program[4][0], instr.Addi)
+    self.assertIsInstance(program[28][0], instr.Bne)
+    self.assertEqual(fused_count(program), 5)
+
+    cpu, result, _ = run(parsed, program)
+    reference, expected, _ = run(parsed, parsed['instructions'])
+    self.assertEqual(cpu.registers.snapshot(), reference.registers.snapshot())
+    self.assertEqual(cpu.registers['t1'], 0x4000)
+    self.assertEqual(cpu.registers['t2'], 0x55)
+    self.assertEqual(cpu.registers['ra'], 44)
+    self.assertEqual((result.reason, result.pc), (StopReason.END, 0x200000))
+    # li, la, lw, slt + bnez and the call each take one dispatch
+    self.assertEqual(result.steps, expected.steps - 5)
+
+  def test_jump_into_second_half(self):
+    # x5 = lui 0x12 + addi 0x34; jumping to the addi skips the lui
+    program = fuse({
+      0: [instr.Jal(0, 8)],
+      4: [instr.Lui(5, 0x12)],
+      8: [instr.Addi(5, 5, 0x34)],
+    })
+    self.assertIsInstance(program[4][0], FusedConstant)
+    cpu = CPU()
+    result = cpu.run(program)
+    self.assertEqual(cpu.registers[5], 0x34)
+    self.assertEqual(result.steps, 2)
+
+    cpu = CPU()
+    cpu.reset(start_pc=4)
+    cpu.run(program)
+    self.assertEqual(cpu.registers[5], 0x12034)
+
+  def test_trap_in_second_half(self):
+    # auipc x5 far away, then a load that faults: the auipc has retired
+    program = fuse({0: [instr.Auipc(5, 0x10000)], 4: [instr.Lw(6, 5, 0)]})
+    self.assertIsInstance(program[0][0], FusedPcLoad)
+    cpu = CPU()
+    with redirect_stdout(io.StringIO()):
+      result = cpu.run(program)
+    self.assertEqual(result.reason, StopReason.TRAP)
+    self.assertIsInstance(cpu.trap, LoadAccessFault)
+    self.assertEqual((cpu.pc, cpu.trap.pc), (4, 4))
+    self.assertEqual(cpu.registers[5], 0x10000000)
+    self.assertEqual(cpu.registers[6], 0)
+
+  def test_not_fused(self):
+    push = instr.Addi(2, 2, -16)
+    push.tag("use_sp")
+    program = {
+      # The stack check would run between the halves
+      0: [push], 4: [instr.Bne(2, 0, 8)],
+      # Loads can trap, and the addi does not continue the lui
+      8: [instr.Lw(1, 0, 0)], 12: [instr.Beq(1, 0, 8)],
+      16: [instr.Lui(3, 1)], 20: [instr.Addi(4, 3, 1)],
+    }
+    self.assertEqual(fused_count(fuse(program)), 0)
+
+    # The tag of the second half is kept for the check after the pair
+    branch = instr.Bne(2, 0, 8)
+    branch.tag("use_sp")
+    fused = fuse({0: [instr.Addi(5, 0, 1)], 4: [branch]})
+    self.assertIsInstance(fused[0][0], FusedBranch)
+    self.assertIn("use_sp", fused[0][0].tags)
+
+if __name__ == '__main__':
+  unittest.main()
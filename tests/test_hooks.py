@@ -0,0 +1,90 @@
+"""
+Unit tests for meta-instruction hooks.
+Meta lines take no address space; their hooks run around the instruction
+they are attached to, and are never consulted when not attached.
+"""
+
+import unittest
+import io
+from contextlib import redirect_stdout
+from cpu import CPU, StopReason
+from parser import Parser
+from program import CompactProgram
+from hooks import attach, Hooked
+from traps import AssertionFailure
+import instructions as instr
+
+SOURCE = """
+main:
+  li t0, 1
+  @print t0
+  beq t0, zero, .skip
+  @assert eq(t0, 1)
+.skip:
+  addi t1, t0, 1
+  bne t1, zero, .done
+  @assert eq(x0, 1)
+.done:
+  @print t1
+"""
+
+def run(program, engine=CPU.run):
+  # Runs program on a fresh CPU, returning the CPU, result and output.
+  cpu = CPU()
+  with redirect_stdout(io.StringIO()) as out:
+    result = engine(cpu, program)
+  return cpu, result, out.getvalue()
+
+class TestHooks(unittest.TestCase):
+  def test_layout(self):
+    parsed = Parser().parse_program(SOURCE)
+    self.assertEqual(list(parsed['instructions']), [0, 4, 8, 12])
+    self.assertEqual(parsed['labels'], {'main': 0, '.skip': 8, '.done': 16})
+    # Before the beq; after the beq and bne when they fall through; at the end
+    self.assertEqual(sorted(parsed['hooks']), [4, 16])
+    self.assertEqual(sorted(parsed['fallthrough_hooks']), [4, 12])
+
+  def test_fallthrough_and_jumps(self):
+    parsed = Parser().parse_program(SOURCE)
+    program = attach(parsed['instructions'], parsed['hooks'], parsed['fallthrough_hooks'])
+    self.assertIsInstance(program[4][0], Hooked)
+    for engine in (CPU.run, lambda cpu, p: CompactProgram(p).run(cpu)):
+      cpu, result, out = run(program, engine)
+      # The beq falls through into its assert, the bne jumps over its own
+      self.assertEqual(result.reason, StopReason.END)
+      self.assertIsNone(cpu.trap)
+      self.assertEqual(out, "[DEBUG] t0 = 1 (0x00000001)\n[DEBUG] t1 = 2 (0x00000002)\n")
+      # The end marker runs the trailing hooks and falls off the program
+      self.assertEqual((result.steps, result.pc), (5, 20))
+
+    # A failing fall-through hook traps at the following address
+    failing = Parser().parse_program("addi t0, x0, 1\n@assert eq(t0, 2)\nlabel: addi t1, x0, 1")
+    cpu, result, out = run(attach(failing['instructions'], failing['hooks'], failing['fallthrough_hooks']))
+    self.assertIsInstance(cpu.trap, AssertionFailure)
+    self.assertEqual((result.reason, cpu.pc, cpu.registers['t0'], cpu.registers['t1']),
+                     (StopReason.TRAP, 4, 1, 0))
+
+  def test_meta_off(self):
+    parsed = Parser().parse_program(SOURCE + "@assert eq(t1, 5)\n")
+    program = parsed['instructions']
+    # Nothing to attach leaves the program as it is
+    self.assertIs(attach(program, {}, {}), program)
+    cpu, result, out = run(program)
+    self.assertEqual((result.reason, out, cpu.registers['t1']), (StopReason.END, "", 2))
+    cpu, result, _ = run(attach(program, parsed['hooks'], parsed['fallthrough_hooks']))
+    self.assertEqual(result.reason, StopReason.TRAP)
+    self.assertIsInstance(cpu.trap, AssertionFailure)
+
+  def test_lazy_and_compact(self):
+    expected = Parser().parse_program(SOURCE)
+    reference = run(attach(expected['instructions'], expected['hooks'], expected['fallthrough_hooks']))
+    for parsed in (Parser(lazy=True).parse_program(SOURCE), Parser().parse_stream(io.StringIO(SOURCE))):
+      program = attach(parsed['instructions'], parsed['hooks'], parsed['fallthrough_hooks'])
+      cpu, result, out = run(program)
+      self.assertEqual((result.steps, result.pc, out), (reference[1].steps, reference[1].pc, reference[2]))
+      self.assertEqual(cpu.registers.snapshot(), reference[0].registers.snapshot())
+    # A compact program is copied, not changed
+    self.assertIsInstance(parsed['instructions'][4][0], instr.Beq)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,134 @@
+"""
+Unit tests for the tiered JIT.
+Every tutorial is run with an eager threshold and check mode on, so each
+compiled superblock is replayed on the interpreter, and the final state
+must match a plain interpreter run.
+"""
+
+import unittest
+import os
+import io
+from contextlib import redirect_stdout
+from cpu import CPU, StopReason
+from parser import Parser
+from hooks import attach
+from jit import JIT, JITMismatch
+import instructions as instr
+
+TUTORIAL_DIR = os.path.join(os.path.dirname(__file__), '..', 'tutorial')
+
+def counting_loop(limit):
+  # x1 counts to limit in a two-instruction loop.
+  return {
+    0: [instr.Addi(2, 0, limit)],
+    4: [instr.Addi(1, 1, 1)],
+    8: [instr.Bne(1, 2, -4)],
+  }
+
+class TestJIT(unittest.TestCase):
+  def setUp(self):
+    self.cpu = CPU(mem_size=1024)
+
+  def test_matches_interpreter_on_tutorials(self):
+    for name in sorted(os.listdir(TUTORIAL_DIR)):
+      if not name.endswith('.s'): continue
+      with open(os.path.join(TUTORIAL_DIR, name)) as f:
+        parsed = Parser().parse_program(f.read())
+        program = attach(parsed['instructions'], parsed['hooks'], parsed['fallthrough_hooks'])
+      reference, jitted = CPU(), CPU()
+      with redirect_stdout(io.StringIO()) as out_ref:
+        expected = reference.run(program)
+      with redirect_stdout(io.StringIO()) as out_jit:
+        result = JIT(program, threshold=1, check=True).run(jitted)
+      with self.subTest(tutorial=name):
+        self.assertEqual(result.reason, expected.reason)
+        self.assertEqual(result.steps, expected.steps)
+        self.assertEqual(jitted.pc, reference.pc)
+        self.assertEqual(jitted.registers.snapshot(), reference.registers.snapshot())
+        self.assertEqual(jitted.memory.snapshot().contents, reference.memory.snapshot().contents)
+        self.assertEqual(out_jit.getvalue(), out_ref.getvalue())
+
+  def test_hot_loop_is_compiled(self):
+    dump = io.StringIO()
+    jit = JIT(counting_loop(1000), threshold=10, dump=dump)
+    result = jit.run(self.cpu)
+    self.assertEqual(result.reason, StopReason.END)
+    self.assertEqual(result.steps, 2001)
+    self.assertEqual(self.cpu.registers[1], 1000)
+    # The loop body is compiled once and runs almost every iteration
+    self.assertIn(4, jit.superblocks)
+    self.assertGreater(jit.jit_steps, 1900)
+    self.assertIn("superblock at 0x00000004", dump.getvalue())
+    self.assertIn("while True:", jit.superblocks[4].source)
+
+  def test_cold_code_is_interpreted(self):
+    jit = JIT(counting_loop(5), threshold=50)
+    self.assertEqual(jit.run(self.cpu).steps, 11)
+    self.assertEqual(jit.superblocks, {})
+    self.assertEqual(jit.jit_steps, 0)
+
+  def test_step_budget(self):
+    jit = JIT(counting_loop(1000), threshold=1)
+    result = jit.run(self.cpu, max_steps=501)
+    self.assertEqual(result.reason, StopReason.STEP_LIMIT)
+    self.assertEqual(result.steps, 501)
+    self.assertEqual(self.cpu.registers[1], 250)
+    self.assertEqual(self.cpu.pc, 4)
+    self.assertEqual(jit.run(self.cpu).steps, 1500)
+    self.assertEqual(self.cpu.registers[1], 1000)
+
+  def test_fault_inside_superblock(self):
+    program = {
+      0: [instr.Addi(1, 0, 2000)],
+      4: [instr.Sw(1, 1, 0)],
+      8: [instr.Addi(3, 0, 1)],
+    }
+    with redirect_stdout(io.StringIO()):
+      result = JIT(program, threshold=1).run(self.cpu)
+    # The faulting store does not retire
+    self.assertEqual(result.reason, StopReason.TRAP)
+    self.assertEqual(result.steps, 1)
+    self.assertEqual(self.cpu.pc, 4)
+    self.assertEqual(self.cpu.trap.addr, 2000)
+    self.assertEqual(self.cpu.registers[1], 2000)
+    self.assertEqual(self.cpu.registers[3], 0)
+
+  def test_check_mode_with_trapping_superblock(self):
+    # A loop runs hot, then a store faults inside the compiled superblock
+    program = dict(counting_loop(20))
+    program[12] = [instr.Addi(3, 0, 2000)]
+    program[16] = [instr.Sw(3, 1, 0)]
+    with redirect_stdout(io.StringIO()) as out:
+      result = JIT(program, threshold=1, check=True).run(self.cpu)
+    self.assertEqual(result.reason, StopReason.TRAP)
+    self.assertEqual(self.cpu.pc, 16)
+    self.assertEqual(self.cpu.trap.addr, 2000)
+    self.assertEqual(out.getvalue().count("Memory Error"), 1)
+
+  def test_stack_check_inside_superblock(self):
+    push = instr.Addi(2, 2, -1024)
+    push.tag("use_sp")
+    program = {0: [instr.Addi(1, 0, 1)], 4: [push], 8: [instr.Addi(3, 0, 1)]}
+    with redirect_stdout(io.StringIO()) as out:
+      result = JIT(program, threshold=1).run(self.cpu)
+    self.assertEqual(result.reason, StopReason.HALT)
+    self.assertEqual(result.steps, 2)
+    self.assertEqual(self.cpu.registers[3], 0)
+    self.assertIn("Stack Overflow", out.getvalue())
+
+  def test_check_mode_detects_mismatch(self):
+    jit = JIT(counting_loop(100), threshold=1, check=True)
+    jit.run(self.cpu, max_steps=10)
+    # Corrupt the compiled loop so it disagrees with the interpreter
+    sb = jit.superblocks[4]
+    fn = sb.fn
+    def broken(r, mem, budget):
+      result = fn(r, mem, budget)
+      r[1] += 1
+      return result
+    sb.fn = broken
+    with self.assertRaises(JITMismatch):
+      jit.run(self.cpu)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -4,7 +4,8 @@ Focuses on soundness, little-endianness, and bounds checking.
 """
 
 import unittest
-from memory import Memory
+from memory import Memory, PagedMemory, PAGE_SIZE
+from traps import LoadAccessFault, StoreAccessFault
 
 class TestMemory(unittest.TestCase):
   def setUp(self):
@@ -12,14 +13,14 @@ class TestMemory(unittest.TestCase):
 
   def test_basic_byte_rw(self):
     # Test writing and reading individual bytes
-    self.assertTrue(self.mem.write_byte(10, 0xAB))
+    self.mem.write_byte(10, 0xAB)
     self.assertEqual(self.mem.read_byte(10), 0xAB)
     self.assertEqual(self.mem.read_byte(11), 0x00)
 
   def test_little_endian_32bit(self):
     # Test 32-bit word write (0x12345678)
     # Byte 0: 0x78, Byte 1: 0x56, Byte 2: 0x34, Byte 3: 0x12
-    self.assertTrue(self.mem.write(100, 4, 0x12345678))
+    self.mem.write(100, 4, 0x12345678)
     self.assertEqual(self.mem.read_byte(100), 0x78)
     self.assertEqual(self.mem.read_byte(101), 0x56)
     self.assertEqual(self.mem.read_byte(102), 0x34)
@@ -29,7 +30,7 @@ class TestMemory(unittest.TestCase):
   def test_little_endian_16bit(self):
     # Test 16-bit word write (0xABCD)
     # Byte 0: 0xCD, Byte 1: 0xAB
-    self.assertTrue(self.mem.write(200, 2, 0xABCD))
+    self.mem.write(200, 2, 0xABCD)
     self.assertEqual(self.mem.read_byte(200), 0xCD)
     self.assertEqual(self.mem.read_byte(201), 0xAB)
     self.assertEqual(self.mem.read(200, 2), 0xABCD)
@@ -50,14 +51,24 @@ class TestMemory(unittest.TestCase):
 
   def test_bounds_checking(self):
     # Test writing out of bounds
-    self.assertFalse(self.mem.write_byte(-1, 0x00))
-    self.assertFalse(self.mem.write_byte(1024, 0x00))
-    self.assertFalse(self.mem.write(1021, 4, 0x00)) # Crosses boundary
-    
+    with self.assertRaises(StoreAccessFault):
+      self.mem.write_byte(-1, 0x00)
+    with self.assertRaises(StoreAccessFault):
+      self.mem.write_byte(1024, 0x00)
+    with self.assertRaises(StoreAccessFault) as ctx:
+      self.mem.write(1021, 4, 0x00) # Crosses boundary
+    self.assertEqual(ctx.exception.addr, 1021)
+    self.assertEqual(ctx.exception.cause, "store_access_fault")
+
     # Test reading out of bounds
-    self.assertEqual(self.mem.read_byte(-1), 0)
-    self.assertEqual(self.mem.read_byte(1024), 0)
-    self.assertIsNone(self.mem.read(1021, 4))
+    with self.assertRaises(LoadAccessFault):
+      self.mem.read_byte(-1)
+    with self.assertRaises(LoadAccessFault):
+      self.mem.read_byte(1024)
+    with self.assertRaises(LoadAccessFault) as ctx:
+      self.mem.read(1021, 4)
+    self.assertEqual(ctx.exception.addr, 1021)
+    self.assertIn("Read out of bounds at 0x000003FD", ctx.exception.message)
 
   def test_typed_access(self):
     # Test read_typed and write_typed
@@ -92,5 +103,138 @@ class TestMemory(unittest.TestCase):
     self.mem.write(11, 2, 0xAAAA)
     self.assertEqual(self.mem.read(10, 4), 0x11AAAA44)
 
+  def test_unaligned_access(self):
+    # Misaligned words and halfwords bypass the aligned views
+    self.mem.write(501, 4, 0x89ABCDEF)
+    self.assertEqual(self.mem.read(501, 4), 0x89ABCDEF)
+    self.assertEqual(self.mem.read(501, 4, signed=True), 0x89ABCDEF - 0x100000000)
+    self.assertEqual(self.mem.read_byte(501), 0xEF)
+    self.mem.write(511, 2, -2)
+    self.assertEqual(self.mem.read(511, 2), 0xFFFE)
+    self.assertEqual(self.mem.read(511, 2, signed=True), -2)
+
+    # Widths without a precompiled accessor still work
+    self.mem.write(600, 3, 0x123456)
+    self.assertEqual(self.mem.read(600, 3), 0x123456)
+    self.assertEqual(self.mem.read(600, 3, signed=True), 0x123456)
+
+  def test_snapshot_restore(self):
+    self.mem.write(0, 4, 0x11111111)
+    snap = self.mem.snapshot()
+    self.mem.write(0, 4, 0x22222222)
+    self.mem.write_byte(1023, 0x7F)
+    self.mem.restore(snap)
+    self.assertEqual(self.mem.read(0, 4), 0x11111111)
+    self.assertEqual(self.mem.read_byte(1023), 0)
+
+    # The snapshot stays valid for repeated restores
+    self.mem.write(0, 2, 0xBEEF)
+    self.mem.restore(snap)
+    self.assertEqual(self.mem.read(0, 4), 0x11111111)
+
+    # Restoring into another memory copies the full contents
+    other = Memory(size=1024)
+    other.restore(snap)
+    self.assertEqual(other.read(0, 4), 0x11111111)
+    with self.assertRaises(ValueError):
+      Memory(size=2048).restore(snap)
+
+  def test_load_segment(self):
+    self.mem.load_segment(100, b'\x78\x56\x34\x12ABC')
+    self.assertEqual(self.mem.read(100, 4), 0x12345678)
+    self.assertEqual(self.mem.read_byte(106), ord('C'))
+    self.mem.load_segment(1024, b'')
+    # A segment that does not fit is rejected without writing anything
+    with self.assertRaises(StoreAccessFault) as ctx:
+      self.mem.load_segment(1020, b'\xFF' * 8)
+    self.assertEqual(ctx.exception.addr, 1020)
+    self.assertEqual(self.mem.read(1020, 4), 0)
+
+    # Loaded pages are tracked for snapshot restore
+    snap = self.mem.snapshot()
+    self.mem.load_segment(0, bytes(range(200)))
+    self.mem.restore(snap)
+    self.assertEqual(self.mem.read(0, 4), 0)
+
+class TestPagedMemory(unittest.TestCase):
+  def setUp(self):
+    self.mem = PagedMemory()
+
+  def test_sparse_allocation(self):
+    # Reads of untouched pages return zero without allocating
+    self.assertEqual(self.mem.read(0x80000000, 4), 0)
+    self.assertEqual(self.mem.read_byte(0xFFFFFFFF), 0)
+    self.assertEqual(self.mem.resident_pages, 0)
+
+    # The first write allocates exactly one page
+    self.mem.write(0xDEAD0000, 4, 0x12345678)
+    self.assertEqual(self.mem.resident_pages, 1)
+    self.assertEqual(self.mem.read(0xDEAD0000, 4), 0x12345678)
+    self.assertEqual(self.mem.read_typed(0xDEAD0000, "i8"), 0x78)
+
+  def test_full_address_space(self):
+    self.mem.write_byte(0xFFFFFFFF, 0xAB)
+    self.assertEqual(self.mem.read_byte(0xFFFFFFFF), 0xAB)
+    self.mem.write_typed(0x10, "i16", -2)
+    self.assertEqual(self.mem.read_typed(0x10, "i16"), -2)
+    self.assertEqual(self.mem.resident_pages, 2)
+
+  def test_page_straddling_access(self):
+    addr = PAGE_SIZE - 2
+    self.mem.write(addr, 4, 0x11223344)
+    self.assertEqual(self.mem.resident_pages, 2)
+    self.assertEqual(self.mem.read(addr, 4), 0x11223344)
+    self.assertEqual(self.mem.read(addr + 1, 2), 0x2233)
+    self.mem.write(addr, 4, 0x80000000)
+    self.assertEqual(self.mem.read(addr, 4, signed=True), -0x80000000)
+
+  def test_copy_on_write_snapshot(self):
+    self.mem.write(0x1000, 4, 0xAAAAAAAA)
+    self.mem.write(0x5000, 4, 0xBBBBBBBB)
+    snap = self.mem.snapshot()
+    shared = snap.contents[0x1]
+
+    # Writing after the snapshot copies only the touched page
+    self.mem.write(0x1000, 4, 0xCCCCCCCC)
+    self.mem.write(0x9000, 4, 0xDDDDDDDD)
+    self.assertEqual(shared[0], 0xAA)
+    self.assertIs(self.mem._pages[0x5], snap.contents[0x5])
+    self.assertEqual(set(self.mem._writable), {0x1, 0x9})
+
+    self.mem.restore(snap)
+    self.assertEqual(self.mem.read(0x1000, 4), 0xAAAAAAAA)
+    self.assertEqual(self.mem.read(0x9000, 4), 0)
+    self.assertEqual(self.mem.resident_pages, 2)
+
+    # A different memory restored from the snapshot shares its pages
+    other = PagedMemory()
+    other.restore(snap)
+    other.write(0x5000, 4, 0)
+    self.assertEqual(self.mem.read(0x5000, 4), 0xBBBBBBBB)
+    with self.assertRaises(ValueError):
+      other.restore(Memory(size=1024).snapshot())
+
+  def test_bounds_checking(self):
+    with self.assertRaises(StoreAccessFault):
+      self.mem.write_byte(1 << 32, 0)
+    with self.assertRaises(StoreAccessFault):
+      self.mem.write(0xFFFFFFFE, 4, 0)
+    with self.assertRaises(LoadAccessFault):
+      self.mem.read(0xFFFFFFFE, 4)
+    with self.assertRaises(LoadAccessFault):
+      self.mem.read_byte(-1)
+    with self.assertRaises(StoreAccessFault):
+      self.mem.load_segment(0xFFFFFFFC, b'12345678')
+
+  def test_load_segment(self):
+    # The buffer straddles three pages
+    raw = bytes(i & 0xFF for i in range(2 * PAGE_SIZE))
+    self.mem.load_segment(0x10000 - 16, raw)
+    self.assertEqual(self.mem.resident_pages, 3)
+    self.assertEqual(self.mem.read_byte(0x10000 - 16), 0)
+    self.assertEqual(self.mem.read(0x10000 - 2, 4), int.from_bytes(raw[14:18], 'little'))
+    self.assertEqual(self.mem.read_byte(0x10000 - 17 + len(raw)), raw[-1])
+    self.assertEqual(self.mem.read_byte(0x10000 - 16 + len(raw)), 0)
+
 if __name__ == '__main__':
   unittest.main()
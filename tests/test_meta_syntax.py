@@ -8,8 +8,12 @@ from cpu import CPU
 import instructions as instr
 import expressions as expr
 from parser import Parser
+from hooks import attach
 import io
+import itertools
+import pickle
 from contextlib import redirect_stdout
+from traps import AssertionFailure
 
 class TestMetaSyntax(unittest.TestCase):
   def setUp(self):
@@ -82,7 +86,12 @@ class TestMetaSyntax(unittest.TestCase):
     a_fail = instr.Assert(expr.Eq(expr.RegAccess(1), expr.Literal(10)), "eq(x1, 10)")
     with self.assertRaises(AssertionError):
       a_fail.execute(self.cpu)
+
+    # Run through the CPU, the failure halts it
+    with redirect_stdout(io.StringIO()) as out:
+      self.cpu.run({0: [a_fail]})
     self.assertTrue(self.cpu.halted)
+    self.assertIn("[ASSERTION FAILED] eq(x1, 10)", out.getvalue())
 
   def test_print_instructions(self):
     # Print register
@@ -116,13 +125,14 @@ class TestMetaSyntax(unittest.TestCase):
 
 
   def test_parser_meta(self):
-    # Deep check of parser's meta instruction generation
+    # Deep check of parser's meta instruction generation; meta lines
+    # become hooks, {addr: [meta instruction]}, on the next address
     parser = Parser()
     
     # Assert parsing
     prog = "@assert and(eq(x1, 5), ne(x2, 0))"
     parse_result = parser.parse_program(prog)
-    instrs = parse_result['instructions']
+    instrs = parse_result['hooks']
     assert_instr = instrs[0][0]
     self.assertIsInstance(assert_instr, instr.Assert)
     self.assertEqual(assert_instr.line_text, "and(eq(x1, 5), ne(x2, 0))")
@@ -130,7 +140,7 @@ class TestMetaSyntax(unittest.TestCase):
     # Print parsing
     prog_print = "@print x5"
     parse_result = parser.parse_program(prog_print)
-    instrs = parse_result['instructions']
+    instrs = parse_result['hooks']
     print_instr = instrs[0][0]
     self.assertIsInstance(print_instr, instr.Print)
     self.assertEqual(print_instr.reg_name, "x5")
@@ -138,7 +148,7 @@ class TestMetaSyntax(unittest.TestCase):
     # Print_mem parsing
     prog_pmem = "@print_mem 0x100 u16 8"
     parse_result = parser.parse_program(prog_pmem)
-    instrs = parse_result['instructions']
+    instrs = parse_result['hooks']
     pm_instr = instrs[0][0]
     self.assertIsInstance(pm_instr, instr.PrintMem)
     self.assertEqual(pm_instr.addr_expr, 0x100)
@@ -148,7 +158,7 @@ class TestMetaSyntax(unittest.TestCase):
     # Print expression parsing
     prog_pexpr = "@print add(x1, 5)"
     parse_result = parser.parse_program(prog_pexpr)
-    instrs = parse_result['instructions']
+    instrs = parse_result['hooks']
     pexpr_instr = instrs[0][0]
     self.assertIsInstance(pexpr_instr, instr.PrintExpression)
     self.assertEqual(pexpr_instr.expr_str, "add(x1, 5)")
@@ -159,21 +169,19 @@ class TestMetaSyntax(unittest.TestCase):
     
     # Whitespace handling
     parse_result = parser.parse_program("@print add(  x1  ,   10  )")
-    instrs = parse_result['instructions']
-    # The instruction is wrapped in a list of instructions for that address
-    # structure: {addr: [instr, ...]}
-    # Since we don't have addresses in the string, addr starts at 0
-    # But wait, parse_program returns a dict {addr: [inst]}
-    # Let's check the first instruction of the first address
+    instrs = parse_result['hooks']
+    # Meta lines are hooks, not instructions: {addr: [hook, ...]}
+    # With no instruction after it, the hook sits at the end of the text
+    self.assertEqual(parse_result['instructions'], {})
     first_addr = list(instrs.keys())[0]
     self.assertIsInstance(instrs[first_addr][0], instr.PrintExpression)
     
     # Nested whitespace
     parse_result = parser.parse_program("@print add( sub( x1, 1 ), 5 )")
-    instrs = parse_result['instructions']
+    instrs = parse_result['hooks']
     # Case insensitivity for operators
     parse_result = parser.parse_program("@print ADD(x1, 5)")
-    instrs = parse_result['instructions']
+    instrs = parse_result['hooks']
     self.assertIsInstance(instrs[0][0], instr.PrintExpression)
 
   def test_functional_runtime_validation(self):
@@ -212,7 +220,7 @@ class TestMetaSyntax(unittest.TestCase):
     
     parser = Parser()
     parse_result = parser.parse_program(program)
-    instructions = parse_result['instructions']
+    instructions = attach(parse_result['instructions'], parse_result['hooks'], parse_result['fallthrough_hooks'])
     
     # Execute
     # We need to flatten the instruction dictionary to a list for sequential execution test
@@ -258,6 +266,42 @@ class TestMetaSyntax(unittest.TestCase):
     val = self.cpu.memory.read(0x1004, 4)
     self.assertEqual(val, 30)
 
+  def test_compiled_expressions(self):
+    # Compiled expressions agree with walking the tree
+    parser = Parser()
+    self.cpu.registers[1] = 7
+    self.cpu.registers[2] = 0x100
+    self.cpu.registers[3] = 0
+    self.cpu.pc = 8
+    self.cpu.memory.write(0x104, 4, 0xFFFFFFFE)
+    for text in ["add(x1, 5)", "sub(x3, 1)", "mul(x1, x2)", "div(x2, x1)", "mod(x2, x3)",
+                 "div(div(x2, x1), mod(x1, 4))", "and(eq(x1, 7), not(lt(m[add(x2, 4), u32], 100)))",
+                 "or(x3, x1)", "and(x3, x1)", "m[add(x2, 4), i32]", "m[add(x2, 4), 16]", "eq(pc, 8)",
+                 "ge(x0, x3)", "add(eq(x1, 7), 1)"]:
+      tree = parser.parse_expr(text)
+      with self.subTest(expression=text):
+        self.assertEqual(expr.compile_expression(tree)(self.cpu), tree.evaluate(self.cpu))
+
+    # Constant subtrees are folded
+    for text, folded in [("add(0x4000, 16)", "16400"), ("eq(add(1, 1), 2)", "True"),
+                         ("and(1, x5)", "r[5]"), ("or(0, ne(x0, 0))", "False"),
+                         ("mod(x5, sub(3, 3))", str(0xFFFFFFFF)),
+                         ("eq(x5, add(0x4000, 16))", "(r[5] == 16400)")]:
+      with self.subTest(expression=text):
+        self.assertEqual(parser.parse_expr(text).source(itertools.count()), folded)
+
+    # Identical expressions share one compiled function
+    first = parser.parse_meta("@assert eq(x1, 7)")
+    second = parser.parse_meta("@assert eq( x1 , 7 )")
+    self.assertIs(first.compiled, second.compiled)
+    self.assertIsNot(first.expression_tree, second.expression_tree)
+    # and are rebuilt when unpickled
+    copy = pickle.loads(pickle.dumps(first))
+    self.assertIs(copy.compiled, first.compiled)
+    copy.execute(self.cpu)
+    self.cpu.registers[1] = 8
+    with self.assertRaises(AssertionFailure):
+      copy.execute(self.cpu)
 
 
 if __name__ == '__main__':
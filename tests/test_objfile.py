@@ -0,0 +1,146 @@
+"""
+Unit tests for the .rvo object file format.
+Every tutorial is assembled, mapped back and run on the compact engine,
+and must behave exactly like the parsed source on the interpreter.
+"""
+
+import unittest
+import os
+import tempfile
+import pickle
+from unittest import mock
+from parser import Parser
+from program import CompactProgram
+from hooks import attach, Hooked
+import objfile
+from objfile import write_object, load_object, is_object, _HEADER
+from tests.helpers import run_parsed
+
+TUTORIAL_DIR = os.path.join(os.path.dirname(__file__), '..', 'tutorial')
+
+def execute(result, compact=False):
+  # Runs a parse result on a fresh CPU and returns its observable state.
+  program = attach(result['instructions'], result['hooks'], result['fallthrough_hooks'])
+  cpu, run, out = run_parsed(result, lambda cpu: program.run(cpu) if compact else cpu.run(program))
+  return run.reason, run.steps, cpu.pc, cpu.registers.snapshot(), out
+
+class TestObjectFile(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmp.name, 'prog.rvo')
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_tutorials_round_trip(self):
+    for name in sorted(os.listdir(TUTORIAL_DIR)):
+      if not name.endswith('.s'): continue
+      with open(os.path.join(TUTORIAL_DIR, name)) as f:
+        parsed = Parser().parse_program(f.read())
+      write_object(self.path, parsed)
+      loaded = load_object(self.path)
+      with self.subTest(tutorial=name):
+        self.assertEqual(loaded['labels'], parsed['labels'])
+        self.assertEqual(loaded['start_addr'], parsed['start_addr'])
+        self.assertEqual(list(loaded['instructions']), sorted(parsed['instructions']))
+        self.assertEqual(execute(loaded, compact=True), execute(parsed))
+      del loaded
+
+  def test_mapped_columns(self):
+    source = """
+    .data
+    vec: .word 1, -2, 3
+    .text
+    main:
+      la x5, vec
+      lw x6, 4(x5)
+      @assert eq(x6, -2)
+      ecall
+    """
+    parsed = Parser().parse_program(source)
+    write_object(self.path, parsed)
+    self.assertTrue(is_object(self.path))
+    loaded = load_object(self.path)
+    program = loaded['instructions']
+    self.assertIsInstance(program, CompactProgram)
+    # Columns and segments are views over the mapping, not copies
+    self.assertIsInstance(program.opcode, memoryview)
+    self.assertIsInstance(program.imm, memoryview)
+    self.assertEqual(bytes(loaded['segments'][0][1]), parsed['segments'][0][1])
+    self.assertEqual(loaded['data'][0x4004], 0xFE)
+    self.assertEqual(len(program), len(parsed['instructions']))
+    # System instructions come back from the side table, meta hooks from theirs
+    self.assertEqual(type(program[12][0]).__name__, 'Ecall')
+    self.assertEqual(type(loaded['hooks'][12][0]).__name__, 'Assert')
+    # Attaching copies the mapped columns rather than writing to them
+    hooked = attach(program, loaded['hooks'], loaded['fallthrough_hooks'])
+    self.assertIsInstance(hooked[12][0], Hooked)
+    self.assertEqual(type(program[12][0]).__name__, 'Ecall')
+
+    # A CompactProgram can be written directly
+    other = os.path.join(self.tmp.name, 'copy.rvo')
+    write_object(other, dict(loaded, instructions=program))
+    with open(self.path, 'rb') as a, open(other, 'rb') as b:
+      self.assertEqual(a.read(), b.read())
+    del program, loaded
+
+  def test_side_tables_are_data(self):
+    source = """
+    main:
+      @print a0
+      @print pc
+      @print add(a0, m[sp, u8])
+      @print_mem 0x4000 i16 3
+      @assert or(ne(a0, 1), lt(sp, 0x100))
+      ecall
+      fence
+      addi sp, sp, -4
+    """
+    parsed = Parser().parse_program(source)
+    write_object(self.path, parsed)
+    loaded = load_object(self.path)
+    # Rebuilt instructions match the parsed ones down to their expression trees
+    self.assertEqual(pickle.dumps(loaded['hooks']), pickle.dumps(parsed['hooks']))
+    self.assertEqual(pickle.dumps(loaded['instructions'].objects),
+                     pickle.dumps(CompactProgram(parsed['instructions']).objects))
+    self.assertEqual(loaded['hooks'][0][2].compiled, parsed['hooks'][0][2].compiled)
+
+    # Crafted entries are rejected instead of being built
+    cases = {
+      'not an instruction': {'class': 'Literal', 'fields': {'value': 1}},
+      'missing field': {'class': 'Addi', 'fields': {'rd': 1, 'rs1': 0}},
+      'non-int field': {'class': 'Addi', 'fields': {'rd': 1, 'rs1': 0, 'imm': "__import__('os')"}},
+      'bad tags': {'class': 'Ecall', 'fields': {}, 'tags': [1]},
+      'unknown meta': {'meta': '@run os.system'},
+      'bad expression': {'meta': "@assert eq(a0, __import__('os'))"},
+    }
+    for case, entry in cases.items():
+      with mock.patch.object(objfile, '_encode', return_value=entry):
+        write_object(self.path, parsed)
+      with self.subTest(case=case), self.assertRaises(ValueError):
+        load_object(self.path)
+
+  def test_rejects_bad_files(self):
+    source_path = os.path.join(self.tmp.name, 'prog.s')
+    with open(source_path, 'w') as f:
+      f.write("addi x1, x0, 1\n")
+    self.assertFalse(is_object(source_path))
+    self.assertFalse(is_object(os.path.join(self.tmp.name, 'missing.rvo')))
+
+    write_object(self.path, Parser().parse_program("addi x1, x0, 1\n"))
+    with open(self.path, 'rb') as f:
+      raw = f.read()
+    cases = {
+      'truncated': raw[:-3],
+      'version': raw[:4] + b'\x09\x00' + raw[6:],
+      'opcode table': raw[:8] + b'\x00\x00\x00\x00' + raw[12:],
+      'short header': raw[:_HEADER.size - 1],
+    }
+    for case, data in cases.items():
+      with open(self.path, 'wb') as f:
+        f.write(data)
+      with self.subTest(case=case), self.assertRaises(ValueError):
+        load_object(self.path)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -3,8 +3,33 @@ Unit tests for the Parser of the RISC-V emulator.
 """
 
 import unittest
-from parser import Parser
+import gc
+import io
+import os
+from contextlib import redirect_stdout
+import pickle
+from unittest import mock
+import parser
+from parser import Parser, Statement
+from program import CompactProgram
+from hooks import attach
+from cpu import CPU, StopReason
+from translator import BlockTranslator
+from jit import JIT
+from traps import IllegalInstruction
 import instructions as instr
+from tests.helpers import load_parsed
+
+TUTORIAL_DIR = os.path.join(os.path.dirname(__file__), '..', 'tutorial')
+
+def describe(program):
+  # Comparable form of an {address: [instruction]} mapping, down to the
+  # expression trees of meta instructions.
+  return {addr: pickle.dumps(instructions) for addr, instructions in program.items()}
+
+def fields(ins):
+  # (class, rd, rs1, imm) of an instruction.
+  return (type(ins), ins.rd, getattr(ins, 'rs1', None), ins.imm)
 
 class TestParser(unittest.TestCase):
   def setUp(self):
@@ -29,10 +54,68 @@ class TestParser(unittest.TestCase):
     self.assertIsInstance(instrs[8][0], instr.Addi) # mv
     self.assertIsInstance(instrs[12][0], instr.Addi) # nop
 
+  def test_relaxation(self):
+    source = "\n".join([
+      "main: la t0, end", "call func", "lw t1, value", "li t2, func", "li t3, 0x7000",
+      "la t4, value", "call 0x200000", "func: ret",
+    ] + ["call func"] * 400 + ["end: ecall", ".data", "value: .word 9"])
+    result = self.parser.parse_program(source)
+    instrs, labels = result['instructions'], result['labels']
+    # Every address holds exactly one instruction, none of them filler
+    self.assertEqual(list(instrs), list(range(0, self.parser.text_end, 4)))
+    self.assertEqual(labels['func'], 40)
+    # At its longest la would put end past 2047; relaxing the calls after
+    # it brings end close enough for a single addi from x0
+    self.assertEqual(labels['end'], 44 + 400 * 4)
+    self.assertEqual(fields(instrs[0][0]), (instr.Addi, 5, 0, labels['end']))
+    self.assertEqual(fields(instrs[4][0]), (instr.Jal, 1, None, 36))
+    # Data beyond 12 bits stays PC-relative, forward reference or not
+    self.assertIsInstance(instrs[8][0], instr.Auipc)
+    self.assertIsInstance(instrs[12][0], instr.Lw)
+    self.assertEqual(fields(instrs[16][0]), (instr.Addi, 7, 0, 40))
+    self.assertEqual(fields(instrs[20][0]), (instr.Lui, 28, None, 7))
+    self.assertIsInstance(instrs[24][0], instr.Auipc)
+    # A call out of jal range keeps auipc + jalr
+    self.assertEqual(fields(instrs[32][0]), (instr.Auipc, 1, None, 0x200))
+    self.assertEqual(fields(instrs[36][0]), (instr.Jalr, 1, 1, -32))
+
+    cpu = load_parsed(CPU(), result)
+    result = cpu.run(instrs)
+    self.assertEqual(result.pc, 0x200000)
+    self.assertEqual(cpu.registers['t1'], 9)
+    self.assertEqual(cpu.registers['t4'], 0x4000)
+
+    # Stream and lazy parses share the layout
+    stream = Parser().parse_stream(io.StringIO(source))
+    lazy = Parser(lazy=True).parse_program(source)
+    self.assertEqual(describe(stream['instructions']), describe(instrs))
+    self.assertEqual(describe(lazy['instructions']), describe(instrs))
+    self.assertEqual(lazy['labels'], labels)
+
+  def test_call_reach(self):
+    # jal holds a 20-bit byte offset, so a call reaches [-512 KiB, 512 KiB)
+    reach = parser.JAL_RANGE
+    self.assertEqual(reach, 1 << 19)
+    result = self.parser.parse_program("\n".join([
+      f"call {reach - 4}", f"call {reach + 4}", f"call {12 - reach}", f"call {16 - reach - 4}",
+    ]))
+    instrs = result['instructions']
+    self.assertEqual(fields(instrs[0][0]), (instr.Jal, 1, None, reach - 4))
+    self.assertEqual(fields(instrs[4][0]), (instr.Auipc, 1, None, 0x80))
+    self.assertEqual(fields(instrs[12][0]), (instr.Jal, 1, None, -reach))
+    self.assertIsInstance(instrs[16][0], instr.Auipc)
+
+    # Both forms land on their target
+    for target in (reach - 4, reach, 800012):
+      with self.subTest(target=target):
+        parsed = Parser().parse_program(f"call {target}")
+        cpu = load_parsed(CPU(), parsed)
+        self.assertEqual(cpu.run(parsed['instructions']).pc, target)
+
   def test_complex_expressions(self):
     program = "@assert and(eq(x1, 5), not(lt(m[0, u32], 100)))"
     parse_result = self.parser.parse_program(program)
-    instrs = parse_result['instructions']
+    instrs = parse_result['hooks']
     self.assertIsInstance(instrs[0][0], instr.Assert)
     expr = instrs[0][0].expression_tree
     self.assertEqual(expr.__class__.__name__, "AndExpr")
@@ -41,8 +124,8 @@ class TestParser(unittest.TestCase):
     program = "  add  x1,x2,  x3  # comment\n\n  @print   x1  "
     parse_result = self.parser.parse_program(program)
     instrs = parse_result['instructions']
-    self.assertIn(0, instrs)
-    self.assertIn(4, instrs)
+    self.assertEqual(list(instrs), [0])
+    self.assertEqual(parse_result['hooks'][4][0].reg_name, "x1")
 
   def test_labels(self):
     program = """
@@ -73,12 +156,15 @@ class TestParser(unittest.TestCase):
     self.assertIsInstance(instrs[0][0], instr.Jalr)
 
   def test_meta_syntax(self):
-    program = "@assert eq(x1, 5)\n@print x1\n@print_mem 0x100 u32 4"
+    program = "@assert eq(x1, 5)\n@print x1\n@print_mem 0x100 u32 4\naddi x1, x0, 5\n@print x1"
     parse_result = self.parser.parse_program(program)
-    instrs = parse_result['instructions']
-    self.assertIsInstance(instrs[0][0], instr.Assert)
-    self.assertIsInstance(instrs[4][0], instr.Print)
-    self.assertIsInstance(instrs[8][0], instr.PrintMem)
+    # Meta lines take no address space: they are hooks on the next
+    # instruction, in source order
+    self.assertEqual(list(parse_result['instructions']), [0])
+    hooks = parse_result['hooks']
+    self.assertEqual([type(h) for h in hooks[0]], [instr.Assert, instr.Print, instr.PrintMem])
+    self.assertEqual([type(h) for h in hooks[4]], [instr.Print])
+    self.assertEqual(self.parser.text_end, 4)
 
   def test_invalid_syntax(self):
     with self.assertRaises(Exception):
@@ -86,5 +172,167 @@ class TestParser(unittest.TestCase):
     with self.assertRaises(Exception):
       self.parser.parse_program("add x1, x2") # Missing arg
 
+  def test_statement_tokens(self):
+    stmt = Statement(3, "SW t0,  -8( sp )")
+    self.assertEqual((stmt.line_no, stmt.mnemonic, stmt.args), (3, 'sw', ['t0', '-8', 'sp']))
+    self.assertTrue(stmt.uses_sp)
+    self.assertFalse(Statement(1, "addi x2, x2, -8").uses_sp)
+
+  def test_handler_table(self):
+    # Every mnemonic in the table builds instructions from one of these forms
+    forms = ["", "8", "x1", "x1, 8", "x1, x2", "x1, 8(x2)", "x1, x2, 8", "x1, x2, x3"]
+    for mnemonic, (handler, cls) in Parser.HANDLERS.items():
+      with self.subTest(mnemonic=mnemonic):
+        for form in forms:
+          try:
+            objs = self.parser.parse_line(f"{mnemonic} {form}", 0x100)
+            break
+          except (IndexError, ValueError):
+            continue
+        else:
+          self.fail(f"{mnemonic} did not parse")
+        objs = objs if isinstance(objs, list) else [objs]
+        if cls is not None:
+          self.assertIsInstance(objs[-1], cls)
+
+    # Pseudo branches swap or zero their operands
+    bgt = self.parser.parse_line("bgt x1, x2, 8", 0)
+    self.assertEqual((type(bgt), bgt.rs1, bgt.rs2), (instr.Blt, 2, 1))
+    blez = self.parser.parse_line("blez x5, 8", 0)
+    self.assertEqual((type(blez), blez.rs1, blez.rs2), (instr.Bge, 0, 5))
+
+  def test_collector_restored(self):
+    self.assertTrue(gc.isenabled())
+    self.parser.parse_program("addi x1, x0, 1")
+    self.assertTrue(gc.isenabled())
+    with self.assertRaises(ValueError):
+      self.parser.parse_program("bogus x1")
+    self.assertTrue(gc.isenabled())
+
+  def test_parse_stream(self):
+    # Streaming gives the same program as parsing the whole string
+    for name in sorted(os.listdir(TUTORIAL_DIR)):
+      if not name.endswith('.s'): continue
+      with open(os.path.join(TUTORIAL_DIR, name)) as f:
+        source = f.read()
+      expected = Parser().parse_program(source)
+      with open(os.path.join(TUTORIAL_DIR, name)) as f:
+        result = Parser().parse_stream(f)
+      with self.subTest(tutorial=name):
+        self.assertIsInstance(result['instructions'], CompactProgram)
+        self.assertEqual(describe(result['instructions']), describe(expected['instructions']))
+        self.assertEqual(result['labels'], expected['labels'])
+        self.assertEqual(result['segments'], expected['segments'])
+        self.assertEqual(result['start_addr'], expected['start_addr'])
+
+  def test_parse_stream_iterator(self):
+    lines = iter(["main:  li t0, 0x12345  # two words\n", "\tsw t0, -4(sp)\n", "@print t0\n",
+                  ".data\n", "v: .word 7\n", ".text\n", "la a0, v\n"])
+    result = self.parser.parse_stream(lines)
+    program = result['instructions']
+    self.assertEqual(list(program), [0, 4, 8, 12, 16])
+    self.assertIsInstance(program[0][0], instr.Lui)
+    self.assertIn("use_sp", program[8][0].tags)
+    self.assertIsInstance(program[12][0], instr.Auipc)
+    self.assertIsInstance(result['hooks'][12][0], instr.Print)
+    self.assertEqual(self.parser.text_end, 20)
+    self.assertEqual(result['segments'], [(0x4000, b'\x07\x00\x00\x00')])
+
+    # Errors surface as they do for parse_program
+    with self.assertRaises(ValueError):
+      self.parser.parse_stream(io.StringIO("addi x1, x0, 1\nbogus x2\n"))
+    self.assertTrue(gc.isenabled())
+
+  def test_parallel_second_pass(self):
+    # Tiny chunks so every kind of chunk boundary is crossed: pseudos
+    # relaxed against forward labels, two-word pseudos, and meta lines
+    # that take no space
+    source = "\n".join([
+      "main: li t0, 0x12345", "li t1, later", "@print t1", "lw t2, later", "@unknown",
+      "addi sp, sp, -8", "sw t0, 4(sp)", "@assert eq(t0, 0x12345)", "ecall", "j main",
+      "later: add t3, t1, t2",
+    ] * 3).replace("main:", "", 1).replace("later:", "", 2)
+    expected = Parser().parse_program("main: " + source)
+    with mock.patch.object(parser, 'MIN_CHUNK', 2):
+      result = Parser(workers=3).parse_program("main: " + source)
+    program = result['instructions']
+    self.assertIsInstance(program, CompactProgram)
+    self.assertEqual(describe(program), describe(expected['instructions']))
+    self.assertEqual(result['labels'], expected['labels'])
+    self.assertEqual(describe(result['hooks']), describe(expected['hooks']))
+
+    # A CompactProgram survives pickling, as it does between processes
+    self.assertEqual(describe(pickle.loads(pickle.dumps(program))), describe(program))
+
+    # One worker, or a small program, stays in process
+    self.assertEqual(describe(Parser(workers=1).parse_program("main: " + source)['instructions']),
+                     describe(program))
+
+  def test_lazy_layout(self):
+    # The lazy view has exactly the layout of a full parse, including
+    # pseudos relaxed against forward labels next to meta lines
+    sources = [
+      "main: li t1, later\nlw t2, later\n@unknown\naddi sp, sp, -4\nlater: ecall\n@print t1",
+      "lw x6, fwd\n@unknown\nfwd: addi x1, x0, 1",
+    ]
+    for name in sorted(os.listdir(TUTORIAL_DIR)):
+      if name.endswith('.s'):
+        with open(os.path.join(TUTORIAL_DIR, name)) as f:
+          sources.append(f.read())
+    for source in sources:
+      with self.subTest(source=source[:40]):
+        lazy = Parser(lazy=True).parse_program(source)
+        self.assertEqual(lazy['instructions'].decoded, 0)
+        eager = Parser().parse_program(source)
+        self.assertEqual(describe(lazy['instructions']), describe(eager['instructions']))
+        self.assertEqual(describe(attach(lazy['instructions'], lazy['hooks'], lazy['fallthrough_hooks'])),
+                         describe(attach(eager['instructions'], eager['hooks'], eager['fallthrough_hooks'])))
+
+  def test_lazy_decoding(self):
+    source = "main: addi x1, x0, 1\nbeq x0, x0, done\nbogus x1\naddi x2, x3\ndone: addi sp, sp, -4\n"
+    program = Parser(lazy=True).parse_program(source)['instructions']
+    cpu = CPU()
+    result = cpu.run(program)
+    # Only the executed lines were built; the broken ones never ran
+    self.assertEqual(result.reason, StopReason.END)
+    self.assertEqual(result.steps, 3)
+    self.assertEqual(program.decoded, 3)
+    self.assertEqual(cpu.registers[2], CPU().registers[2] - 4)
+
+    # Validation reports every broken line
+    errors = program.validate()
+    self.assertEqual([trap.pc for trap in errors], [8, 12])
+    self.assertIn("line 3", errors[0].message)
+    self.assertIn("Unknown mnemonic: bogus", errors[0].message)
+
+    # Reaching a broken line traps as an illegal instruction
+    cpu = CPU()
+    with redirect_stdout(io.StringIO()):
+      result = cpu.run(Parser(lazy=True).parse_program("addi x1, x0, 1\nbogus x1\n")['instructions'])
+    self.assertEqual(result.reason, StopReason.TRAP)
+    self.assertIsInstance(cpu.trap, IllegalInstruction)
+    self.assertEqual((result.steps, cpu.trap.pc), (1, 4))
+
+    # The block translator and the JIT trap at the same instruction
+    source = "addi x1, x0, 1\nloop: addi x1, x1, 1\nblt x1, x0, loop\nbogus x1\n"
+    for engine in (lambda program: BlockTranslator(program), lambda program: JIT(program, threshold=1)):
+      cpu = CPU()
+      with redirect_stdout(io.StringIO()):
+        result = engine(Parser(lazy=True).parse_program(source)['instructions']).run(cpu)
+      self.assertEqual(result.reason, StopReason.TRAP)
+      self.assertIsInstance(cpu.trap, IllegalInstruction)
+      self.assertIn("line 4", cpu.trap.message)
+      self.assertEqual((result.steps, cpu.pc, cpu.registers[1]), (3, 12, 2))
+
+  def test_lazy_parser_reuse(self):
+    # A lazy program keeps decoding as parsed after its parser moves on
+    asm_parser = Parser(lazy=True)
+    result = asm_parser.parse_program("main: call func\nli t0, value\nfunc: ret\n.data\nvalue: .word 1")
+    asm_parser.parse_program("nop\nnop\nnop\nfunc: ret\nvalue: nop")
+    result['labels']['func'] = 0x100
+    eager = Parser().parse_program("main: call func\nli t0, value\nfunc: ret\n.data\nvalue: .word 1")
+    self.assertEqual(result['instructions'].decoded, 0)
+    self.assertEqual(describe(result['instructions']), describe(eager['instructions']))
+
 if __name__ == '__main__':
   unittest.main()
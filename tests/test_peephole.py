@@ -0,0 +1,104 @@
+"""
+Unit tests for the load-time peephole optimizer.
+Every tutorial is run optimized and unoptimized and the resulting
+architectural state must match; run boundaries are checked individually.
+"""
+
+import unittest
+import os
+import io
+from contextlib import redirect_stdout
+from cpu import CPU, StopReason
+from parser import Parser
+from program import CompactProgram
+from hooks import attach, Hooked
+from peephole import optimize, is_noop, Collapsed
+import instructions as instr
+from tests.helpers import run_parsed
+
+TUTORIAL_DIR = os.path.join(os.path.dirname(__file__), '..', 'tutorial')
+
+class TestPeephole(unittest.TestCase):
+  def test_matches_unoptimized_on_tutorials(self):
+    for name in sorted(os.listdir(TUTORIAL_DIR)):
+      if not name.endswith('.s'): continue
+      with open(os.path.join(TUTORIAL_DIR, name)) as f:
+        parsed = Parser().parse_program(f.read())
+      program = attach(parsed['instructions'], parsed['hooks'], parsed['fallthrough_hooks'])
+      optimized, _ = optimize(program)
+      states = []
+      for engine in (lambda cpu: cpu.run(program), lambda cpu: cpu.run(optimized),
+                     lambda cpu: CompactProgram(optimized).run(cpu)):
+        cpu, result, out = run_parsed(parsed, engine)
+        states.append((result.reason, cpu.pc, cpu.registers.snapshot(),
+                       cpu.memory.snapshot().contents, out))
+      with self.subTest(tutorial=name):
+        self.assertEqual(states[1], states[0])
+        self.assertEqual(states[2], states[0])
+
+  def test_noops(self):
+    noops = [instr.Addi(0, 0, 0), instr.Addi(5, 5, 0), instr.Add(0, 1, 2), instr.Lui(0, 5),
+             instr.Or(6, 6, 6), instr.Add(7, 0, 7), instr.Andi(8, 8, -1), instr.Fence(), instr.Slli(9, 9, 0)]
+    effects = [instr.Addi(5, 6, 0), instr.Addi(5, 5, 1), instr.Lw(0, 0, 0), instr.Sub(7, 0, 7),
+               instr.And(6, 6, 7), instr.Jal(0, 4), instr.Ecall()]
+    self.assertEqual([is_noop(ins) for ins in noops], [True] * len(noops))
+    self.assertEqual([is_noop(ins) for ins in effects], [False] * len(effects))
+
+  def test_constant_chain_and_branch_targets(self):
+    source = """
+    main:
+      nop
+      li t3, 2
+      li t0, 5
+    entry:
+      addi t0, t0, 3
+      mv t1, t0
+      nop
+      addi t2, t2, 1
+      @print t0
+      bne t2, t3, entry
+    """
+    parsed = Parser().parse_program(source)
+    program = attach(parsed['instructions'], parsed['hooks'], parsed['fallthrough_hooks'])
+    optimized, eliminated = optimize(program)
+    # The layout is unchanged
+    self.assertEqual(list(optimized), list(program))
+    run = optimized[0][0]
+    self.assertIsInstance(run, Collapsed)
+    self.assertEqual(run.writes, ((28, 2), (5, 8), (6, 8)))
+    self.assertEqual(run.next_pc, 24)
+    self.assertEqual(eliminated, 5)
+    # Entered at the branch target, t0 is not known: the original
+    # instructions run from there, as do hooked instructions and branches
+    self.assertIsInstance(optimized[28][0], Hooked)
+    for addr in (12, 16, 24, 28):
+      self.assertIs(optimized[addr][0], program[addr][0])
+    # except for the lone nop, which only skips itself
+    skip = optimized[20][0]
+    self.assertEqual((skip.writes, skip.next_pc, skip.run), ((), 24, [program[20][0]]))
+
+    cpu = CPU()
+    with redirect_stdout(io.StringIO()) as out:
+      result = cpu.run(optimized)
+    self.assertEqual(result.reason, StopReason.END)
+    self.assertEqual((cpu.registers['t0'], cpu.registers['t1'], cpu.registers['t2']), (11, 11, 2))
+    self.assertEqual(out.getvalue(), "[DEBUG] t0 = 8 (0x00000008)\n[DEBUG] t0 = 11 (0x0000000B)\n")
+
+  def test_stack_check_ends_run(self):
+    push = instr.Addi(2, 0, 100)
+    push.tag("use_sp")
+    program = {0: [instr.Addi(5, 0, 1)], 4: [push], 8: [instr.Addi(6, 0, 2)]}
+    optimized, eliminated = optimize(program)
+    self.assertEqual(eliminated, 1)
+    self.assertIn("use_sp", optimized[0][0].tags)
+    self.assertEqual(optimized[0][0].next_pc, 8)
+    cpu = CPU()
+    with redirect_stdout(io.StringIO()) as out:
+      result = cpu.run(optimized)
+    # The check after the tagged write still halts before the last addi
+    self.assertEqual(result.reason, StopReason.HALT)
+    self.assertIn("Stack Overflow", out.getvalue())
+    self.assertEqual(cpu.registers[6], 0)
+
+if __name__ == '__main__':
+  unittest.main()
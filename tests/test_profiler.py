@@ -0,0 +1,201 @@
+"""
+Unit tests for the per-PC execution profiler.
+"""
+
+import unittest
+import io
+from cpu import CPU
+from parser import Parser
+from fusion import fuse
+from hooks import attach
+import instructions as instr
+from profiler import (Profile, CallGraph, Symbols, hot_spots, write_report, write_listing, write_collapsed,
+                      write_call_report, write_callgrind, transfer_kind, CALL, RETURN, JUMP)
+from tests.helpers import run_parsed
+
+SOURCE = """main:
+  li t0, 0
+  li t1, 3
+loop:
+  call work
+  addi t0, t0, 1
+  blt t0, t1, loop
+  j end
+work:
+  addi a0, a0, 3
+.inner:
+  ret
+end:
+  @print a0
+"""
+
+RECURSIVE = """main:
+  li a0, 4
+  call fact
+  li a0, 2
+  call far
+  j end
+fact:
+  addi sp, sp, -8
+  sw ra, 4(sp)
+  sw a0, 0(sp)
+  li t0, 1
+  ble a0, t0, .base
+  addi a0, a0, -1
+  call fact
+  lw t1, 0(sp)
+  mul a0, a0, t1
+  j .out
+.base:
+  li a0, 1
+.out:
+  lw ra, 4(sp)
+  addi sp, sp, 8
+  ret
+far:
+  j fact
+end:
+  nop
+"""
+
+def profiled(source, call_graph=False, transform=None):
+  # Runs source with a profile; returns (parse result, profile, RunResult).
+  parsed = Parser().parse_program(source)
+  program = parsed['instructions']
+  if transform:
+    program = transform(parsed)
+  profile = Profile(CallGraph(Symbols(parsed['labels'])) if call_graph else None)
+  _, result, _ = run_parsed(parsed, lambda cpu: cpu.run(program, profile=profile))
+  if call_graph:
+    profile.calls.finish()
+  return parsed, profile, result
+
+class TestProfiler(unittest.TestCase):
+  def test_counts(self):
+    parsed, profile, result = profiled(SOURCE)
+    reference = CPU()
+    expected = reference.run(parsed['instructions'])
+    self.assertEqual((result.reason, result.steps, result.pc), (expected.reason, expected.steps, expected.pc))
+    self.assertEqual(profile.total, result.steps)
+    self.assertEqual(profile.items(), [(0, 1), (4, 1), (8, 3), (12, 3), (16, 3), (20, 1), (24, 3), (28, 3)])
+    self.assertIsInstance(profile.counts[0], int)
+    self.assertEqual(profile.counts.typecode, 'Q')
+
+    # Counts add up across runs, here one step at a time
+    stepped = Profile()
+    cpu = CPU()
+    while cpu.run(parsed['instructions'], max_steps=1, profile=stepped).steps:
+      pass
+    self.assertEqual(stepped.items(), profile.items())
+
+  def test_cover_keeps_counts(self):
+    profile = Profile()
+    profile.cover(16, 2)[1] = 5
+    counts = profile.cover(8, 4)
+    self.assertEqual((profile.base, len(counts)), (8, 4))
+    self.assertEqual(profile.count(20), 5)
+    self.assertEqual(profile.count(100), 0)
+
+  def test_symbols(self):
+    symbols = Symbols({'main': 0, '.top': 0, '.loop': 8, 'helper': 16, 'buf': 0x4000})
+    self.assertEqual([symbols.name(addr) for addr in (0, 4, 8, 12, 16, 20)],
+                     ['main', 'main+0x4', '.loop', '.loop+0x4', 'helper', 'helper+0x4'])
+    self.assertEqual([symbols.function(addr) for addr in (4, 12, 20)], ['main', 'main', 'helper'])
+    self.assertEqual(Symbols({'f': 8}).name(4), "0x00000004")
+    # Without a global label, code is grouped by its local label
+    self.assertEqual(Symbols({'.a': 0}).function(4), '.a')
+
+  def test_reports(self):
+    parsed, profile, _ = profiled(SOURCE)
+    symbols = Symbols(parsed['labels'])
+    self.assertEqual(hot_spots(profile, symbols, 2), [(8, 3, 'loop'), (12, 3, 'loop+0x4')])
+    out = io.StringIO()
+    write_report(profile, symbols, out, limit=3)
+    lines = out.getvalue().splitlines()
+    self.assertEqual(lines[0], "[Profile] 18 instructions, 8 distinct addresses")
+    self.assertEqual(lines[2].split(), ['3', '16.67%', '0x00000008', 'loop'])
+
+    out = io.StringIO()
+    write_listing(profile, io.StringIO(SOURCE), Parser().line_table(SOURCE), out)
+    listing = out.getvalue().splitlines()
+    self.assertEqual(listing[0].split(), ['1', 'main:'])
+    self.assertEqual(listing[4].split(), ['3', '5', 'call', 'work'])
+    self.assertEqual(listing[13].split(), ['14', '@print', 'a0'])
+
+    out = io.StringIO()
+    write_collapsed(profile, symbols, out)
+    stacks = dict(line.rsplit(' ', 1) for line in out.getvalue().splitlines())
+    self.assertEqual(stacks['loop'], '3')
+    self.assertEqual(stacks['work;.inner'], '3')
+    self.assertEqual(sum(map(int, stacks.values())), profile.total)
+
+class TestCallGraph(unittest.TestCase):
+  def test_transfer_kinds(self):
+    self.assertEqual(transfer_kind(instr.Jal(1, 8)), CALL)
+    self.assertEqual(transfer_kind(instr.Jalr(1, 5, 0)), CALL)
+    self.assertEqual(transfer_kind(instr.Jalr(0, 1, 0)), RETURN)
+    self.assertEqual(transfer_kind(instr.Jal(0, 8)), JUMP)
+    self.assertEqual(transfer_kind(instr.Jalr(0, 5, 0)), JUMP)
+    self.assertIsNone(transfer_kind(instr.Jal(5, 8)))
+    self.assertIsNone(transfer_kind(instr.Beq(0, 0, 8)))
+
+  def test_recursion_and_tail_calls(self):
+    _, profile, result = profiled(RECURSIVE, call_graph=True)
+    calls = profile.calls
+    self.assertEqual(sum(calls.exclusive.values()), result.steps)
+    self.assertEqual(calls.inclusive['main'], result.steps)
+    # fact(4) recurses three times; far tail calls fact(2), which recurses once
+    self.assertEqual(calls.entries, {'main': 1, 'fact': 6, 'far': 1})
+    edges = {(caller, callee): edge[0] for (caller, callee, site), edge in calls.edges.items()}
+    self.assertEqual(edges, {('main', 'fact'): 1, ('fact', 'fact'): 4, ('main', 'far'): 1, ('far', 'fact'): 1})
+    # Recursive activations count once towards inclusive
+    self.assertEqual(calls.inclusive['fact'], calls.exclusive['fact'])
+    self.assertEqual(calls.inclusive['far'], calls.exclusive['far'] + calls.edges[('far', 'fact', 76)][1])
+    self.assertEqual(calls.stack, [])
+    self.assertEqual(sum(calls.stacks.values()), result.steps)
+    self.assertIn('main;far;fact;fact', calls.stacks)
+
+    # A tail call returns straight to the original caller
+    with open('tutorial/54_tail_calls.s') as f:
+      _, profile, result = profiled(f.read(), call_graph=True)
+    calls = profile.calls
+    self.assertEqual(calls.stacks, {'<unlabeled>': 2, '<unlabeled>;.func_a': 2, '<unlabeled>;.func_a;.func_b': 2})
+    self.assertEqual(calls.inclusive, {'<unlabeled>': 6, '.func_a': 4, '.func_b': 2})
+
+  def test_fused_and_hooked_calls(self):
+    _, expected, _ = profiled(RECURSIVE, call_graph=True)
+    source = RECURSIVE.replace("  ret", "  @print a0\n  ret")
+    for transform in (lambda parsed: fuse(parsed['instructions']),
+                      lambda parsed: attach(parsed['instructions'], parsed['hooks'], parsed['fallthrough_hooks'])):
+      _, profile, _ = profiled(source, call_graph=True, transform=transform)
+      self.assertEqual(profile.calls.entries, expected.calls.entries)
+      self.assertEqual(profile.calls.stacks.keys(), expected.calls.stacks.keys())
+
+  def test_reports(self):
+    _, profile, result = profiled(RECURSIVE, call_graph=True)
+    out = io.StringIO()
+    write_call_report(profile.calls, out)
+    lines = out.getvalue().splitlines()
+    self.assertEqual(lines[0], "[Calls] 3 functions, 7 calls")
+    self.assertEqual(lines[2].split()[:2], ['1', str(result.steps)])
+    self.assertEqual(lines[2].split()[-1], 'main')
+
+    out = io.StringIO()
+    write_callgrind(profile, out, command="fact.s")
+    text = out.getvalue()
+    self.assertTrue(text.startswith("# callgrind format\nversion: 1\n"))
+    self.assertIn(f"summary: {profile.total}\n", text)
+    self.assertIn("\nfn=main\n0x00000000 1\n", text)
+    self.assertIn("cfn=far\ncalls=1 0x0000004C\n0x0000000C ", text)
+    # Self cost lines add up to the summary; the line after calls= is a call cost
+    lines = text.splitlines()
+    own = [int(line.split()[1]) for prev, line in zip(lines, lines[1:])
+           if line.startswith("0x") and not prev.startswith("calls=")]
+    self.assertEqual(sum(own), profile.total)
+
+    out = io.StringIO()
+    write_collapsed(profile, None, out)
+    self.assertIn("main;fact;fact 13\n", out.getvalue())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,134 @@
+"""
+Unit tests for the compact struct-of-arrays program form.
+Every tutorial is run from the columns and compared with the interpreter,
+and the mapping view must rebuild equivalent instruction objects.
+"""
+
+import unittest
+import os
+import io
+from contextlib import redirect_stdout
+from cpu import CPU, StopReason
+from parser import Parser
+from hooks import attach
+from program import CompactProgram, OBJECT, OPCODE_IDS
+import instructions as instr
+
+TUTORIAL_DIR = os.path.join(os.path.dirname(__file__), '..', 'tutorial')
+
+def fields(ins):
+  # Comparable description of an instruction object.
+  return (type(ins), {name: getattr(ins, name) for name in ('rd', 'rs1', 'rs2', 'imm') if hasattr(ins, name)},
+          ins.tags)
+
+class TestCompactProgram(unittest.TestCase):
+  def setUp(self):
+    self.cpu = CPU(mem_size=1024)
+
+  def test_matches_interpreter_on_tutorials(self):
+    for name in sorted(os.listdir(TUTORIAL_DIR)):
+      if not name.endswith('.s'): continue
+      with open(os.path.join(TUTORIAL_DIR, name)) as f:
+        parsed = Parser().parse_program(f.read())
+        program = attach(parsed['instructions'], parsed['hooks'], parsed['fallthrough_hooks'])
+      reference, compact = CPU(), CPU()
+      with redirect_stdout(io.StringIO()) as out_ref:
+        expected = reference.run(program)
+      with redirect_stdout(io.StringIO()) as out_compact:
+        result = CompactProgram(program).run(compact)
+      with self.subTest(tutorial=name):
+        self.assertEqual(result.reason, expected.reason)
+        self.assertEqual(result.steps, expected.steps)
+        self.assertEqual(compact.pc, reference.pc)
+        self.assertEqual(compact.registers.snapshot(), reference.registers.snapshot())
+        self.assertEqual(compact.memory.snapshot().contents, reference.memory.snapshot().contents)
+        self.assertEqual(out_compact.getvalue(), out_ref.getvalue())
+
+  def test_mapping_view(self):
+    push = instr.Addi(2, 2, -16)
+    push.tag("use_sp")
+    ecall = instr.Ecall()
+    program = {
+      0x100: [instr.Add(1, 2, 3)],
+      0x104: [push],
+      0x108: [instr.Sw(2, 1, -4)],
+      0x10C: [instr.Bne(1, 0, -12)],
+      0x114: [instr.Lui(5, 0xABCDE)],
+      0x118: [ecall],
+    }
+    compact = CompactProgram(program)
+    self.assertEqual(len(compact), 6)
+    self.assertEqual(list(compact), sorted(program))
+    self.assertNotIn(0x110, compact)
+    self.assertIsNone(compact.get(0x110))
+    for addr, instructions in program.items():
+      self.assertEqual([fields(ins) for ins in compact[addr]], [fields(ins) for ins in instructions])
+
+    # System and meta instructions are kept as objects
+    self.assertEqual(compact.opcode[6], OBJECT)
+    self.assertIs(compact[0x118][0], ecall)
+    self.assertEqual(compact.opcode[0], OPCODE_IDS[instr.Add])
+
+  def test_interpreter_runs_from_view(self):
+    program = {0: [instr.Addi(2, 0, 5)], 4: [instr.Addi(1, 1, 1)], 8: [instr.Bne(1, 2, -4)]}
+    result = self.cpu.run(CompactProgram(program))
+    self.assertEqual(result.steps, 11)
+    self.assertEqual(self.cpu.registers[1], 5)
+
+  def test_footprint(self):
+    program = {addr: [instr.Addi(5, 5, 1)] for addr in range(0, 4000, 4)}
+    compact = CompactProgram(program)
+    # Five int columns plus one byte of flags per slot
+    self.assertEqual(compact.nbytes, 1000 * 21)
+
+  def test_stop_reasons(self):
+    program = {0: [instr.Addi(1, 0, 1)], 8: [instr.Addi(2, 0, 1)]}
+    compact = CompactProgram(program)
+    # The gap at 4 ends the run
+    result = compact.run(self.cpu)
+    self.assertEqual(result.reason, StopReason.END)
+    self.assertEqual((result.steps, result.pc), (1, 4))
+
+    self.cpu.reset()
+    result = CompactProgram({0: [instr.Jal(0, 0)]}).run(self.cpu, max_steps=10)
+    self.assertEqual(result.reason, StopReason.STEP_LIMIT)
+    self.assertEqual(result.steps, 10)
+
+  def test_fault_and_stack_check(self):
+    program = {0: [instr.Addi(1, 0, 2000)], 4: [instr.Sw(1, 1, 0)], 8: [instr.Addi(3, 0, 1)]}
+    with redirect_stdout(io.StringIO()):
+      result = CompactProgram(program).run(self.cpu)
+    self.assertEqual(result.reason, StopReason.TRAP)
+    self.assertEqual((result.steps, self.cpu.pc), (1, 4))
+
+    self.cpu.reset()
+    push = instr.Addi(2, 2, -1024)
+    push.tag("use_sp")
+    with redirect_stdout(io.StringIO()) as out:
+      result = CompactProgram({0: [push], 4: [instr.Addi(3, 0, 1)]}).run(self.cpu)
+    self.assertEqual(result.reason, StopReason.HALT)
+    self.assertIn("Stack Overflow", out.getvalue())
+
+  def test_incremental_build(self):
+    compact = CompactProgram.allocate(0x100, 2)
+    compact.put(0x100, instr.Addi(1, 0, 1))
+    compact.put(0x104, instr.Ecall())
+    # Past the allocated slots the columns grow
+    compact.put(0x10C, instr.Addi(2, 0, 2))
+    self.assertEqual(list(compact), [0x100, 0x104, 0x10C])
+    self.assertEqual(len(compact.opcode), 4)
+    # Replacing a slot keeps the count
+    compact.put(0x104, instr.Addi(3, 0, 3))
+    self.assertEqual(len(compact), 3)
+    self.assertEqual(compact[0x104][0].imm, 3)
+    with self.assertRaises(ValueError):
+      compact.put(0xFC, instr.Addi(1, 0, 1))
+    with self.assertRaises(ValueError):
+      compact.put(0x102, instr.Addi(1, 0, 1))
+
+  def test_rejects_bundled_addresses(self):
+    with self.assertRaises(ValueError):
+      CompactProgram({0: [instr.Addi(1, 0, 1), instr.Addi(2, 0, 1)]})
+
+if __name__ == '__main__':
+  unittest.main()
@@ -39,6 +39,25 @@ class TestSegments(unittest.TestCase):
         self.assertEqual(result['data'][0x4002], 67)
         self.assertEqual(result['data'][0x4003], 0)
 
+    def test_contiguous_segments(self):
+        source = """
+        .data
+        a: .word 1, -1
+        s: .string "hi"
+        .text
+        addi x1, x0, 1
+        .data
+        b: .word 0x12345678
+        """
+        result = self.parser.parse_program(source)
+        # Consecutive directives are merged into a single bytes chunk
+        self.assertEqual(result['segments'], [
+            (0x4000, b'\x01\x00\x00\x00\xff\xff\xff\xffhi\x00\x78\x56\x34\x12'),
+        ])
+        self.assertEqual(len(result['data']), 15)
+        self.assertEqual(list(result['data'])[:2], [0x4000, 0x4001])
+        self.assertNotIn(0x400F, result['data'])
+
     def test_segment_collision(self):
         # Create a very long .text segment to trigger collision
         # data_base is at 0x4000 (16384 bytes)
@@ -24,7 +24,7 @@ class TestStack(unittest.TestCase):
         
         # 2. Instruction with 'use_sp' tag SHOULD trigger halt
         nop_sp = instr.Add(0, 0, 0)
-        nop_sp.tags.add("use_sp")
+        nop_sp.tag("use_sp")
         self.cpu.step({4: [nop_sp]})
         self.assertTrue(self.cpu.halted)
 
@@ -39,7 +39,7 @@ class TestStack(unittest.TestCase):
         
         # 2. Instruction with 'use_sp' tag SHOULD trigger halt
         nop_sp = instr.Add(0, 0, 0)
-        nop_sp.tags.add("use_sp")
+        nop_sp.tag("use_sp")
         self.cpu.step({4: [nop_sp]})
         self.assertTrue(self.cpu.halted)
 
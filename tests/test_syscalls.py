@@ -3,6 +3,7 @@ import sys
 from io import StringIO
 from cpu import CPU
 import instructions as instr
+from traps import EnvironmentCall
 
 class TestSyscalls(unittest.TestCase):
     def setUp(self):
@@ -52,8 +53,11 @@ class TestSyscalls(unittest.TestCase):
     def test_unknown_syscall(self):
         # Unknown Syscall
         self.cpu.registers[17] = 99 # a7
-        instr.Ecall().execute(self.cpu)
+        with self.assertRaises(EnvironmentCall):
+            instr.Ecall().execute(self.cpu)
+        self.cpu.run({0: [instr.Ecall()]})
         self.assertTrue(self.cpu.halted)
+        self.assertEqual(self.cpu.trap.cause, "environment_call")
         self.assertIn("Unknown syscall: 99", self.held_output.getvalue())
 
 if __name__ == '__main__':
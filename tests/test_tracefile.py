@@ -0,0 +1,120 @@
+"""
+Unit tests for the binary execution trace.
+"""
+
+import unittest
+import io
+import types
+from cpu import StopReason
+from parser import Parser
+from fusion import fuse
+from hooks import attach
+from tracefile import TraceWriter, Record, read_trace
+from tests.helpers import run_parsed
+
+SOURCE = """main:
+  li t0, 5
+  la t1, buf
+  sw t0, 4(t1)
+  lw t1, 4(t1)
+  sb t1, 0(zero)
+  beq t0, t1, .skip
+  addi t2, t2, 1
+.skip:
+  lbu t2, 0(zero)
+.data
+buf: .word 1, 2
+"""
+
+def traced(source, transform=None, max_steps=None, **options):
+  # Runs source with a trace; returns (RunResult, trace file bytes).
+  parsed = Parser().parse_program(source)
+  program = transform(parsed) if transform else parsed['instructions']
+  out = io.BytesIO()
+  trace = TraceWriter(out, **options)
+  _, result, _ = run_parsed(parsed, lambda cpu: cpu.run(program, max_steps=max_steps, trace=trace))
+  trace.close()
+  return result, out.getvalue()
+
+def records(data):
+  return list(read_trace(io.BytesIO(data)))
+
+class TestTrace(unittest.TestCase):
+  def test_records(self):
+    result, data = traced(SOURCE)
+    trace = records(data)
+    self.assertEqual(len(trace), result.steps)
+    self.assertEqual(trace[0], Record(0, 'Addi', 5, 5, None, None, None, False))
+    self.assertEqual([r.instruction for r in trace],
+                     ['Addi', 'Auipc', 'Addi', 'Sw', 'Lw', 'Sb', 'Beq', 'Lbu'])
+    # A store has no rd; a load overwriting its base records the old address
+    self.assertEqual(trace[3][2:], (None, None, 'store', 0x4004, 5, False))
+    self.assertEqual(trace[4][2:], (6, 5, 'load', 0x4004, 5, False))
+    self.assertEqual(trace[5][4:7], ('store', 0, 5))
+    self.assertEqual((trace[6].pc, trace[6].rd, trace[7].pc), (24, None, 32))
+    self.assertEqual(trace[7][2:], (7, 5, 'load', 0, 5, False))
+
+  def test_buffering_and_compression(self):
+    _, expected = traced(SOURCE)
+    # A buffer smaller than the run is written several times
+    self.assertEqual(traced(SOURCE, buffer_records=3)[1], expected)
+    _, compressed = traced(SOURCE, compress=True)
+    self.assertNotEqual(compressed, expected)
+    self.assertEqual(records(compressed), records(expected))
+    # Records are decoded lazily, a chunk at a time
+    stream = read_trace(io.BytesIO(compressed), chunk_size=7)
+    self.assertIsInstance(stream, types.GeneratorType)
+    self.assertEqual(next(stream).instruction, 'Addi')
+
+  def test_ring(self):
+    # A program that exits, or a run that only uses up its budget, writes no records
+    result, data = traced(SOURCE.replace(".data", "  li a7, 10\n  ecall\n.data"), ring=3)
+    self.assertEqual((result.reason, records(data)), (StopReason.EXIT, []))
+    result, data = traced(SOURCE, ring=3, max_steps=4)
+    self.assertEqual((result.reason, records(data)), (StopReason.STEP_LIMIT, []))
+    # Leaving the program does
+    result, data = traced(SOURCE, ring=3)
+    self.assertEqual(result.reason, StopReason.END)
+    self.assertEqual(records(data), records(traced(SOURCE)[1])[-3:])
+
+    faulting = SOURCE.replace("lbu t2, 0(zero)", "lbu t2, 0(zero)\n  li t3, 0x7FFFFFF0\n  lw t4, 0(t3)")
+    result, full = traced(faulting)
+    self.assertEqual(result.reason, StopReason.TRAP)
+    self.assertTrue(records(full)[-1].fault)
+    for options in ({'ring': 4}, {'ring': 4, 'compress': True}, {'ring': 100}):
+      _, data = traced(faulting, **options)
+      self.assertEqual(records(data), records(full)[-options['ring']:])
+    last = records(full)[-1]
+    self.assertEqual((last.pc, last.instruction, last.rd, last.mem_op), (44, 'Lw', None, None))
+
+  def test_ring_on_stack_overflow(self):
+    source = "main:\n  li t0, 0\n.push:\n  addi sp, sp, -1024\n  addi t0, t0, 1\n  j .push\n"
+    result, full = traced(source)
+    self.assertEqual(result.reason, StopReason.HALT)
+    result, data = traced(source, ring=4)
+    self.assertEqual(result.reason, StopReason.HALT)
+    self.assertEqual(records(data), records(full)[-4:])
+    # The last record is the push that crossed the stack limit
+    last = records(data)[-1]
+    self.assertEqual((last.pc, last.instruction, last.rd, last.value), (4, 'Addi', 2, 65536 - 33 * 1024))
+
+  def test_fused_and_hooked(self):
+    _, plain = traced(SOURCE)
+    _, fused = traced(SOURCE, lambda parsed: fuse(parsed['instructions']))
+    trace = records(fused)
+    # la is one FusedConstant record; the fused pair ends in t1
+    self.assertEqual(trace[1][:4], (4, 'FusedConstant', 6, 0x4000))
+    self.assertEqual(records(plain)[3:], trace[2:])
+
+    source = SOURCE.replace("  lw t1", "  @assert eq(t0, 5)\n  lw t1")
+    _, hooked = traced(source, lambda parsed: attach(parsed['instructions'], parsed['hooks'], parsed['fallthrough_hooks']))
+    self.assertEqual(records(hooked), records(plain))
+
+  def test_bad_files(self):
+    _, data = traced(SOURCE)
+    for bad in (b"", b"RVO\x01" + data[4:], data[:-1]):
+      with self.assertRaises(ValueError):
+        records(bad)
+
+if __name__ == '__main__':
+  unittest.main()
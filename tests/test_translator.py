@@ -0,0 +1,113 @@
+"""
+Unit tests for the basic-block translator.
+Every tutorial is run on both the interpreter and the translator and the
+resulting architectural state must match.
+"""
+
+import unittest
+import os
+import io
+from contextlib import redirect_stdout
+from cpu import CPU, StopReason
+from parser import Parser
+from hooks import attach
+from translator import BlockTranslator
+import instructions as instr
+
+TUTORIAL_DIR = os.path.join(os.path.dirname(__file__), '..', 'tutorial')
+
+class TestTranslator(unittest.TestCase):
+  def setUp(self):
+    self.cpu = CPU(mem_size=1024)
+
+  def test_matches_interpreter_on_tutorials(self):
+    for name in sorted(os.listdir(TUTORIAL_DIR)):
+      if not name.endswith('.s'): continue
+      with open(os.path.join(TUTORIAL_DIR, name)) as f:
+        parsed = Parser().parse_program(f.read())
+        program = attach(parsed['instructions'], parsed['hooks'], parsed['fallthrough_hooks'])
+      reference, translated = CPU(), CPU()
+      with redirect_stdout(io.StringIO()) as out_ref:
+        expected = reference.run(program)
+      with redirect_stdout(io.StringIO()) as out_tr:
+        result = BlockTranslator(program).run(translated)
+      with self.subTest(tutorial=name):
+        self.assertEqual(result.reason, expected.reason)
+        self.assertEqual(result.steps, expected.steps)
+        self.assertEqual(translated.pc, reference.pc)
+        self.assertEqual(translated.registers.snapshot(), reference.registers.snapshot())
+        self.assertEqual(translated.memory.snapshot().contents, reference.memory.snapshot().contents)
+        self.assertEqual(out_tr.getvalue(), out_ref.getvalue())
+
+  def test_block_cache_hit_rate(self):
+    # x1 counts to 100 in a two-instruction loop
+    program = {
+      0: [instr.Addi(2, 0, 100)],
+      4: [instr.Addi(1, 1, 1)],
+      8: [instr.Bne(1, 2, -4)],
+    }
+    translator = BlockTranslator(program)
+    result = translator.run(self.cpu)
+    self.assertEqual(result.reason, StopReason.END)
+    self.assertEqual(result.steps, 201)
+    self.assertEqual(self.cpu.registers[1], 100)
+    # Blocks at 0, 4 and the end address 12 are translated once each
+    self.assertEqual(translator.misses, 3)
+    self.assertEqual(translator.hits, 98)
+    self.assertGreater(translator.hit_rate, 0.95)
+    self.assertEqual(translator.blocks[0].length, 3)
+    self.assertEqual(translator.blocks[4].length, 2)
+
+  def test_invalidation(self):
+    program = {0: [instr.Addi(1, 0, 1)]}
+    translator = BlockTranslator(program)
+    translator.run(self.cpu)
+    self.assertIn(0, translator.blocks)
+
+    # Running a different program drops the cached blocks
+    self.cpu.reset()
+    translator.run(self.cpu, {0: [instr.Addi(1, 0, 2)]})
+    self.assertEqual(self.cpu.registers[1], 2)
+
+    translator.invalidate()
+    self.assertEqual(translator.blocks, {})
+
+  def test_fault_inside_block(self):
+    # The store at 4 is out of bounds; the instruction after it must not run
+    program = {
+      0: [instr.Addi(1, 0, 2000)],
+      4: [instr.Sw(1, 1, 0)],
+      8: [instr.Addi(3, 0, 1)],
+    }
+    with redirect_stdout(io.StringIO()):
+      result = BlockTranslator(program).run(self.cpu)
+    # The faulting store does not retire
+    self.assertEqual(result.reason, StopReason.TRAP)
+    self.assertEqual(result.steps, 1)
+    self.assertEqual(self.cpu.pc, 4)
+    self.assertEqual(self.cpu.trap.addr, 2000)
+    self.assertEqual(self.cpu.registers[3], 0)
+
+  def test_stack_check_inside_block(self):
+    push = instr.Addi(2, 2, -1024)
+    push.tag("use_sp")
+    program = {0: [instr.Addi(1, 0, 1)], 4: [push], 8: [instr.Addi(3, 0, 1)]}
+    with redirect_stdout(io.StringIO()) as out:
+      result = BlockTranslator(program).run(self.cpu)
+    self.assertEqual(result.reason, StopReason.HALT)
+    self.assertEqual(result.steps, 2)
+    self.assertEqual(self.cpu.registers[3], 0)
+    self.assertIn("Stack Overflow", out.getvalue())
+
+  def test_step_budget(self):
+    program = {addr: [instr.Addi(1, 1, 1)] for addr in range(0, 40, 4)}
+    translator = BlockTranslator(program)
+    result = translator.run(self.cpu, max_steps=4)
+    self.assertEqual(result.reason, StopReason.STEP_LIMIT)
+    self.assertEqual(result.steps, 4)
+    self.assertEqual(self.cpu.pc, 16)
+    self.assertEqual(translator.run(self.cpu).steps, 6)
+    self.assertEqual(self.cpu.registers[1], 10)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -7,6 +7,7 @@ import unittest
 import os
 from cpu import CPU
 from parser import Parser
+from hooks import attach
 
 class TestTutorials(unittest.TestCase):
     def setUp(self):
@@ -19,19 +20,9 @@ class TestTutorials(unittest.TestCase):
             source = f.read()
         
         parse_result = self.parser.parse_program(source)
-        program = parse_result['instructions']
+        program = attach(parse_result['instructions'], parse_result['hooks'], parse_result['fallthrough_hooks'])
         
-        while not self.cpu.halted:
-            if self.cpu.pc in program:
-                for obj in program[self.cpu.pc]:
-                    res = obj.execute(self.cpu)
-                    if res is not None:
-                        self.cpu.pc = res
-                        break
-                else:
-                    self.cpu.pc += 4 * len(program[self.cpu.pc])
-            else:
-                break
+        self.cpu.run(program)
         self.assertFalse(self.cpu.halted, f"Tutorial {filename} halted with error")
 
     # Phase 1: Basic Mechanics
@@ -269,7 +260,8 @@ class TestTutorials(unittest.TestCase):
 
     def test_48_call_ret_pseudos(self):
         self.run_tutorial("48_call_ret_pseudos.s")
-        self.assertEqual(self.cpu.registers['ra'], 8)
+        # call relaxes to a single jal
+        self.assertEqual(self.cpu.registers['ra'], 4)
 
     def test_49_logic_pseudos(self):
         self.run_tutorial("49_logic_pseudos.s")
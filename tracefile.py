@@ -0,0 +1,210 @@
+"""
+This module provides the binary execution trace of the RISC-V emulator.
+CPU.run(program, trace=TraceWriter(f)) packs one fixed-size record per
+executed instruction into a preallocated buffer and writes it out a
+buffer at a time, optionally through a zlib stream. In ring mode only the
+last N records are kept, and they are written when the run stops for any
+reason other than the exit syscall or its step budget: a trap, a stack
+check halt or the PC leaving the program.
+read_trace() decodes a trace lazily, one record at a time.
+
+Layout (little-endian):
+  header    magic, format version, record size, flags, name table size,
+            then the instruction class names, one per line; a record's
+            instruction id is a line number in this table
+  records   pc u32, instruction id u16, rd u8, flags u8, rd value u32,
+            memory address u32, memory value u32; zlib compressed as one
+            stream when the header says so
+"""
+
+import struct
+import zlib
+from collections import namedtuple
+
+import instructions as instr
+from cpu import StopReason
+from program import OPCODES, OPCODE_IDS
+
+MAGIC = b"RVTR"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct('<4sHHHI')
+RECORD = struct.Struct('<IHBBIII')
+
+# Header flags.
+COMPRESSED = 0x1
+
+# Record flags.
+WROTE_RD = 0x1
+LOAD = 0x2
+STORE = 0x4
+FAULT = 0x8
+
+# Instruction id of classes missing from the name table.
+UNKNOWN = 0xFFFF
+
+# Access sizes of loads and stores.
+_SIZES = {instr.Lw: 4, instr.Lh: 2, instr.Lhu: 2, instr.Lb: 1, instr.Lbu: 1,
+          instr.Sw: 4, instr.Sh: 2, instr.Sb: 1}
+
+Record = namedtuple('Record', 'pc instruction rd value mem_op addr data fault')
+Record.__doc__ = """
+A decoded trace record. rd and value are None when the instruction wrote
+no register; mem_op is 'load', 'store' or None, with the address accessed
+and the value loaded or stored. fault is True for an instruction that
+trapped, which is the last record of its run.
+"""
+
+def _subclasses(cls):
+  # Every subclass of cls, recursively.
+  for sub in cls.__subclasses__():
+    yield sub
+    yield from _subclasses(sub)
+
+def instruction_classes():
+  # The instruction id table: the opcodes of program.OPCODES in order, then
+  # every other concrete instruction class by name (system, meta and fused
+  # instructions).
+  table = [cls for cls, _, _ in OPCODES]
+  others = {cls for cls in _subclasses(instr.Instruction) if cls not in OPCODE_IDS}
+  return table + sorted(others, key=lambda cls: (cls.__module__, cls.__name__))
+
+class TraceWriter:
+  """
+  Writes trace records to a binary stream. Records are packed into a
+  buffer of buffer_records records that is written when full; with ring,
+  the buffer holds the last ring records and is only written by dump(),
+  which stop() calls when a run ends abnormally.
+  """
+
+  def __init__(self, out, compress=False, ring=None, buffer_records=4096):
+    self.out = out
+    self.ring = ring
+    self.capacity = ring if ring else buffer_records
+    self.buffer = bytearray(RECORD.size * self.capacity)
+    self.used = 0
+    self.wrapped = False
+    self.records = 0
+    self.dumped = False
+    self.classes = instruction_classes()
+    self.ids = {cls: i for i, cls in enumerate(self.classes)}
+    self.compressor = zlib.compressobj() if compress else None
+    names = "\n".join(cls.__name__ for cls in self.classes).encode()
+    out.write(_HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size, COMPRESSED if compress else 0, len(names)))
+    out.write(names)
+
+  def plan(self, ins):
+    # What to record for ins: (instruction id, rd or None, record flags,
+    # base register, offset, access size). Hooked and fused instructions
+    # record the register of the instruction they end with.
+    while getattr(ins, 'instruction', None) is not None:
+      ins = ins.instruction
+    ident = self.ids.get(type(ins), UNKNOWN)
+    inner = getattr(ins, 'second', ins)
+    rd = getattr(inner, 'rd', None)
+    if rd is None:
+      rd = getattr(getattr(ins, 'first', None), 'rd', None)
+    if isinstance(inner, instr.Load) and hasattr(ins, 'addr'):
+      # A fused auipc + load reads a fixed address
+      return ident, rd, LOAD, 0, ins.addr, ins.size
+    if isinstance(inner, instr.Load):
+      return ident, rd, LOAD, inner.rs1, inner.imm, _SIZES[type(inner)]
+    if isinstance(inner, instr.SType):
+      return ident, None, STORE, inner.rs1, inner.imm, _SIZES[type(inner)]
+    return ident, rd, 0, 0, 0, 0
+
+  def record(self, cpu, pc, plan, addr):
+    # Adds the record of the instruction at pc, planned by plan(), after it
+    # ran. addr is the memory address it accessed, computed before it ran.
+    ident, rd, flags, _, _, size = plan
+    value = data = 0
+    if rd is not None:
+      value = cpu.registers.regs[rd]
+      flags |= WROTE_RD
+    if size:
+      data = cpu.memory.read(addr, size)
+    self._append(pc, ident, rd or 0, flags, value, addr, data)
+
+  def fault(self, pc, plan):
+    # Adds the record of the instruction at pc that faulted.
+    self._append(pc, plan[0] if plan else UNKNOWN, 0, FAULT, 0, 0, 0)
+
+  def stop(self, reason):
+    # Called with the StopReason of each traced run. Dumps the ring unless
+    # the program exited or the run only used up its step budget, after
+    # which it may be resumed.
+    if self.ring and reason not in (StopReason.EXIT, StopReason.STEP_LIMIT):
+      self.dump()
+
+  def _append(self, *fields):
+    if self.used == self.capacity:
+      if self.ring:
+        self.used, self.wrapped = 0, True
+      else:
+        self.flush()
+    RECORD.pack_into(self.buffer, self.used * RECORD.size, *fields)
+    self.used += 1
+    self.records += 1
+
+  def _write(self, data):
+    if self.compressor is not None:
+      data = self.compressor.compress(data)
+    self.out.write(data)
+
+  def flush(self):
+    # Writes the buffered records; in ring mode use dump().
+    if not self.ring:
+      self._write(memoryview(self.buffer)[:self.used * RECORD.size])
+      self.used = 0
+
+  def dump(self):
+    # Writes the records kept in the ring, oldest first. A ring is dumped
+    # at most once.
+    if self.dumped:
+      return
+    self.dumped = True
+    end = self.used * RECORD.size
+    view = memoryview(self.buffer)
+    if self.wrapped:
+      self._write(view[end:])
+    self._write(view[:end])
+
+  def close(self):
+    # Writes what is left and ends the compressed stream; the output stream
+    # stays open.
+    self.flush()
+    if self.compressor is not None:
+      self.out.write(self.compressor.flush())
+      self.compressor = None
+
+def read_trace(f, chunk_size=1 << 16):
+  # Yields the Records of the trace in binary stream f as they are read.
+  header = f.read(_HEADER.size)
+  if len(header) < _HEADER.size:
+    raise ValueError("Truncated trace header")
+  magic, version, size, flags, names_size = _HEADER.unpack(header)
+  if magic != MAGIC:
+    raise ValueError("Not a trace file")
+  if version != FORMAT_VERSION or size != RECORD.size:
+    raise ValueError(f"Unsupported trace format version {version}")
+  names = f.read(names_size).decode().split("\n")
+  decompressor = zlib.decompressobj() if flags & COMPRESSED else None
+  pending = b""
+  done = False
+  while not done:
+    chunk = f.read(chunk_size)
+    done = not chunk
+    if decompressor is not None:
+      # A chunk may decompress to nothing before the stream ends
+      chunk = decompressor.decompress(chunk) if chunk else decompressor.flush()
+    pending += chunk
+    whole = len(pending) - len(pending) % size
+    for pc, ident, rd, rflags, value, addr, data in RECORD.iter_unpack(pending[:whole]):
+      mem_op = 'load' if rflags & LOAD else 'store' if rflags & STORE else None
+      wrote = rflags & WROTE_RD
+      yield Record(pc, names[ident] if ident < len(names) else None,
+                   rd if wrote else None, value if wrote else None,
+                   mem_op, addr if mem_op else None, data if mem_op else None, bool(rflags & FAULT))
+    pending = pending[whole:]
+  if pending:
+    raise ValueError("Truncated trace record")
@@ -0,0 +1,387 @@
+"""
+This module provides the basic-block translator for the RISC-V emulator.
+Straight-line runs of instructions are compiled once into closures that
+operate directly on the raw register list, with register numbers and
+sign-extended immediates baked in as constants.
+"""
+
+import instructions as instr
+from cpu import RunResult, StopReason
+from registers import MASK32
+from traps import Trap
+
+SIGN32 = 0x80000000
+
+class _Fault(Exception):
+  # Raised inside a block when a memory access traps; index is the
+  # position of the faulting instruction within the block.
+  def __init__(self, index, trap=None):
+    super().__init__(index)
+    self.index = index
+    self.trap = trap
+
+class _StackFault(_Fault):
+  # Raised inside a block when sp leaves the stack bounds after an
+  # instruction that uses the 'sp' alias.
+  pass
+
+# --- Straight-line operations: op(r, mem) ---
+
+def _op_add(rd, a, b):
+  def op(r, mem): r[rd] = (r[a] + r[b]) & MASK32
+  return op
+
+def _op_sub(rd, a, b):
+  def op(r, mem): r[rd] = (r[a] - r[b]) & MASK32
+  return op
+
+def _op_sll(rd, a, b):
+  def op(r, mem): r[rd] = (r[a] << (r[b] & 0x1F)) & MASK32
+  return op
+
+def _op_slt(rd, a, b):
+  def op(r, mem): r[rd] = 1 if (r[a] ^ SIGN32) < (r[b] ^ SIGN32) else 0
+  return op
+
+def _op_sltu(rd, a, b):
+  def op(r, mem): r[rd] = 1 if r[a] < r[b] else 0
+  return op
+
+def _op_xor(rd, a, b):
+  def op(r, mem): r[rd] = r[a] ^ r[b]
+  return op
+
+def _op_srl(rd, a, b):
+  def op(r, mem): r[rd] = r[a] >> (r[b] & 0x1F)
+  return op
+
+def _op_sra(rd, a, b):
+  def op(r, mem): r[rd] = (((r[a] ^ SIGN32) - SIGN32) >> (r[b] & 0x1F)) & MASK32
+  return op
+
+def _op_or(rd, a, b):
+  def op(r, mem): r[rd] = r[a] | r[b]
+  return op
+
+def _op_and(rd, a, b):
+  def op(r, mem): r[rd] = r[a] & r[b]
+  return op
+
+def _op_mul(rd, a, b):
+  def op(r, mem): r[rd] = (r[a] * r[b]) & MASK32
+  return op
+
+def _op_addi(rd, a, imm):
+  if a == 0:
+    value = imm & MASK32
+    def op(r, mem): r[rd] = value
+  else:
+    def op(r, mem): r[rd] = (r[a] + imm) & MASK32
+  return op
+
+def _op_slti(rd, a, imm):
+  def op(r, mem): r[rd] = 1 if ((r[a] ^ SIGN32) - SIGN32) < imm else 0
+  return op
+
+def _op_sltiu(rd, a, imm):
+  bound = imm & MASK32
+  def op(r, mem): r[rd] = 1 if r[a] < bound else 0
+  return op
+
+def _op_xori(rd, a, imm):
+  value = imm & MASK32
+  def op(r, mem): r[rd] = r[a] ^ value
+  return op
+
+def _op_ori(rd, a, imm):
+  value = imm & MASK32
+  def op(r, mem): r[rd] = r[a] | value
+  return op
+
+def _op_andi(rd, a, imm):
+  value = imm & MASK32
+  def op(r, mem): r[rd] = r[a] & value
+  return op
+
+def _op_slli(rd, a, imm):
+  shamt = imm & 0x1F
+  def op(r, mem): r[rd] = (r[a] << shamt) & MASK32
+  return op
+
+def _op_srli(rd, a, imm):
+  shamt = imm & 0x1F
+  def op(r, mem): r[rd] = r[a] >> shamt
+  return op
+
+def _op_srai(rd, a, imm):
+  shamt = imm & 0x1F
+  def op(r, mem): r[rd] = (((r[a] ^ SIGN32) - SIGN32) >> shamt) & MASK32
+  return op
+
+_R_OPS = {
+  instr.Add: _op_add, instr.Sub: _op_sub, instr.Sll: _op_sll, instr.Slt: _op_slt,
+  instr.Sltu: _op_sltu, instr.Xor: _op_xor, instr.Srl: _op_srl, instr.Sra: _op_sra,
+  instr.Or: _op_or, instr.And: _op_and, instr.Mul: _op_mul,
+}
+
+_I_OPS = {
+  instr.Addi: _op_addi, instr.Slti: _op_slti, instr.Sltiu: _op_sltiu, instr.Xori: _op_xori,
+  instr.Ori: _op_ori, instr.Andi: _op_andi, instr.Slli: _op_slli, instr.Srli: _op_srli,
+  instr.Srai: _op_srai,
+}
+
+# (size, signed) for each load, size for each store.
+_LOADS = {instr.Lw: (4, True), instr.Lh: (2, True), instr.Lhu: (2, False),
+          instr.Lb: (1, True), instr.Lbu: (1, False)}
+_STORES = {instr.Sw: 4, instr.Sh: 2, instr.Sb: 1}
+
+def _op_load(rd, a, imm, size, signed, index):
+  if rd == 0:
+    def op(r, mem):
+      try:
+        mem.read((r[a] + imm) & MASK32, size, signed)
+      except Trap as trap:
+        raise _Fault(index, trap)
+  else:
+    def op(r, mem):
+      try:
+        r[rd] = mem.read((r[a] + imm) & MASK32, size, signed) & MASK32
+      except Trap as trap:
+        raise _Fault(index, trap)
+  return op
+
+def _op_store(a, b, imm, size, index):
+  def op(r, mem):
+    try:
+      mem.write((r[a] + imm) & MASK32, size, r[b])
+    except Trap as trap:
+      raise _Fault(index, trap)
+  return op
+
+def _op_stack_check(op, limit, base, index):
+  # Wraps op with the 'sp' bounds check that CPU.run applies after it.
+  def checked(r, mem):
+    if op is not None:
+      op(r, mem)
+    if not limit <= r[2] <= base:
+      raise _StackFault(index)
+  return checked
+
+def _translate_op(ins, index, pc):
+  # Returns (op, is_op) for a straight-line instruction: op is None when the
+  # instruction has no architectural effect. Returns (None, False) when the
+  # instruction cannot be translated as straight-line code.
+  cls = type(ins)
+  if cls in _R_OPS:
+    return (_R_OPS[cls](ins.rd, ins.rs1, ins.rs2) if ins.rd else None), True
+  if cls in _I_OPS:
+    return (_I_OPS[cls](ins.rd, ins.rs1, ins.imm) if ins.rd else None), True
+  if cls in _LOADS:
+    size, signed = _LOADS[cls]
+    return _op_load(ins.rd, ins.rs1, ins.imm, size, signed, index), True
+  if cls in _STORES:
+    return _op_store(ins.rs1, ins.rs2, ins.imm, _STORES[cls], index), True
+  if cls is instr.Lui or cls is instr.Auipc:
+    if not ins.rd:
+      return None, True
+    value = ins.imm << 12
+    if cls is instr.Auipc:
+      value = (pc + value) & MASK32
+    rd = ins.rd
+    def op(r, mem): r[rd] = value
+    return op, True
+  if cls is instr.Fence:
+    return None, True
+  return None, False
+
+# --- Block terminators: term(cpu, r) -> next pc ---
+
+def _term_branch(cls, a, b, taken, fall):
+  if cls is instr.Beq:
+    def term(cpu, r): return taken if r[a] == r[b] else fall
+  elif cls is instr.Bne:
+    def term(cpu, r): return taken if r[a] != r[b] else fall
+  elif cls is instr.Blt:
+    def term(cpu, r): return taken if (r[a] ^ SIGN32) < (r[b] ^ SIGN32) else fall
+  elif cls is instr.Bge:
+    def term(cpu, r): return taken if (r[a] ^ SIGN32) >= (r[b] ^ SIGN32) else fall
+  elif cls is instr.Bltu:
+    def term(cpu, r): return taken if r[a] < r[b] else fall
+  else:
+    def term(cpu, r): return taken if r[a] >= r[b] else fall
+  return term
+
+def _translate_terminator(ins, pc):
+  # Builds the closure that ends a block at a control transfer, or runs
+  # any other instruction through its own execute() method.
+  cls = type(ins)
+  if isinstance(ins, instr.BType):
+    return _term_branch(cls, ins.rs1, ins.rs2, (pc + ins.imm) & MASK32, pc + 4)
+  if cls is instr.Jal:
+    rd, link, target = ins.rd, (pc + 4) & MASK32, (pc + ins.imm) & MASK32
+    if rd == 0:
+      def term(cpu, r): return target
+    else:
+      def term(cpu, r):
+        r[rd] = link
+        return target
+    return term
+  if cls is instr.Jalr:
+    rd, a, imm, link = ins.rd, ins.rs1, ins.imm, (pc + 4) & MASK32
+    def term(cpu, r):
+      target = (r[a] + imm) & 0xFFFFFFFE
+      if rd:
+        r[rd] = link
+      return target
+    return term
+  execute = ins.execute
+  def term(cpu, r):
+    cpu.pc = pc
+    target = execute(cpu)
+    return pc + 4 if target is None else target
+  return term
+
+def _make_block(ops, term):
+  # Combines the straight-line ops and the terminator into one function.
+  if not ops:
+    return lambda cpu, r, mem: term(cpu, r)
+  if len(ops) == 1:
+    op0 = ops[0]
+    def run_block(cpu, r, mem):
+      op0(r, mem)
+      return term(cpu, r)
+    return run_block
+  ops = tuple(ops)
+  def run_block(cpu, r, mem):
+    for op in ops:
+      op(r, mem)
+    return term(cpu, r)
+  return run_block
+
+class Block:
+  """
+  A translated basic block: its start address, instruction count, whether
+  the stack check applies after its terminator, and the compiled function.
+  """
+
+  __slots__ = ('start', 'length', 'check_stack', 'fn')
+
+  def __init__(self, start, length, check_stack, fn):
+    self.start = start
+    self.length = length
+    self.check_stack = check_stack
+    self.fn = fn
+
+class BlockTranslator:
+  """
+  Translates and caches basic blocks of a parsed program, keyed by start PC.
+  Blocks end at branches, jumps, system and meta instructions.
+  """
+
+  def __init__(self, program=None):
+    self.program = program
+    self.blocks = {}
+    self.hits = 0
+    self.misses = 0
+    # (stack_limit, stack_base) baked into the cached blocks.
+    self.stack_bounds = None
+
+  @property
+  def hit_rate(self):
+    # Fraction of block lookups that found an already translated block.
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.0
+
+  def invalidate(self, program=None):
+    # Drops every translated block, optionally switching to a new program.
+    if program is not None:
+      self.program = program
+    self.blocks = {}
+
+  def translate(self, pc):
+    # Translates the block starting at pc, or returns None if pc holds no instruction.
+    program = self.program
+    limit, base = self.stack_bounds
+    ops = []
+    addr = pc
+    term = None
+    check_stack = False
+    while True:
+      entry = program.get(addr)
+      if entry is None:
+        break
+      if len(entry) != 1:
+        raise ValueError(f"Cannot translate address 0x{addr:08X}: expected one instruction")
+      ins = entry[0]
+      index = (addr - pc) >> 2
+      op, straight = _translate_op(ins, index, addr)
+      if not straight:
+        term = _translate_terminator(ins, addr)
+        addr += 4
+        check_stack = "use_sp" in ins.tags
+        break
+      if "use_sp" in ins.tags:
+        op = _op_stack_check(op, limit, base, index)
+      if op is not None:
+        ops.append(op)
+      addr += 4
+    if addr == pc:
+      return None
+    if term is None:
+      end = addr
+      term = lambda cpu, r: end
+    block = Block(pc, (addr - pc) >> 2, check_stack, _make_block(ops, term))
+    self.blocks[pc] = block
+    return block
+
+  def run(self, cpu, program=None, max_steps=None):
+    # Runs from cpu.pc like CPU.run(), one translated block at a time.
+    # Passing a different program invalidates all cached blocks.
+    if program is not None and program is not self.program:
+      self.invalidate(program)
+    bounds = (cpu.stack_limit, cpu.stack_base)
+    if bounds != self.stack_bounds:
+      self.invalidate()
+      self.stack_bounds = bounds
+    blocks = self.blocks
+    r = cpu.registers.regs
+    mem = cpu.memory
+    steps = 0
+    while True:
+      pc = cpu.pc
+      block = blocks.get(pc)
+      if block is None:
+        self.misses += 1
+        block = self.translate(pc)
+        if block is None:
+          return cpu._end(pc, steps)
+      else:
+        self.hits += 1
+      if max_steps is not None and steps + block.length > max_steps:
+        # Not enough budget left for a whole block: single-step the rest.
+        result = cpu.run(self.program, max_steps=max_steps - steps)
+        return RunResult(result.reason, steps + result.steps, result.pc)
+      try:
+        cpu.pc = block.fn(cpu, r, mem)
+      except _StackFault as fault:
+        # Matches CPU.run: the instruction retires, then the check halts.
+        steps += fault.index + 1
+        cpu.pc = (pc + 4 * (fault.index + 1)) & MASK32
+        cpu._check_stack()
+        return RunResult(StopReason.HALT, steps, cpu.pc)
+      except _Fault as fault:
+        # A load or store trapped; the instructions before it retired.
+        steps += fault.index
+        cpu._take_trap(fault.trap, (pc + 4 * fault.index) & MASK32)
+        return RunResult(StopReason.TRAP, steps, cpu.pc)
+      except Trap as trap:
+        # Raised by the terminator, the last instruction of the block.
+        steps += block.length - 1
+        cpu._take_trap(trap, (pc + 4 * (block.length - 1)) & MASK32)
+        return RunResult(StopReason.TRAP, steps, cpu.pc)
+      steps += block.length
+      if block.check_stack:
+        cpu._check_stack()
+      if cpu.halted:
+        reason = StopReason.HALT if cpu.exit_code is None else StopReason.EXIT
+        return RunResult(reason, steps, cpu.pc)
@@ -0,0 +1,62 @@
+"""
+This module defines the traps of the RISC-V emulator.
+Faults are raised as Trap exceptions where they are detected (memory
+accesses, system and meta instructions) and caught once at the run-loop
+boundary, which records the trap on the CPU and halts.
+"""
+
+class Trap(Exception):
+  """
+  Base class for synchronous traps. Carries the pc of the trapping
+  instruction, a cause name with its RISC-V mcause code where one exists,
+  and the faulting address for memory traps. A pc of None is filled in by
+  the run loop that catches the trap.
+  """
+
+  cause = "trap"
+  code = None
+
+  def __init__(self, message, pc=None, addr=None):
+    super().__init__(message)
+    self.message = message
+    self.pc = pc
+    self.addr = addr
+
+  def report(self):
+    # Machine-readable description of the trap.
+    return {"cause": self.cause, "code": self.code, "pc": self.pc,
+            "addr": self.addr, "message": self.message}
+
+class MisalignedAccess(Trap):
+  """Instruction fetch from a pc that is not word-aligned."""
+  cause = "misaligned_fetch"
+  code = 0
+
+class IllegalInstruction(Trap):
+  """No executable instruction at pc."""
+  cause = "illegal_instruction"
+  code = 2
+
+class Breakpoint(Trap):
+  """EBREAK."""
+  cause = "breakpoint"
+  code = 3
+
+class LoadAccessFault(Trap):
+  """Load from an address outside memory."""
+  cause = "load_access_fault"
+  code = 5
+
+class StoreAccessFault(Trap):
+  """Store to an address outside memory."""
+  cause = "store_access_fault"
+  code = 7
+
+class EnvironmentCall(Trap):
+  """ECALL with a syscall number the emulator does not implement."""
+  cause = "environment_call"
+  code = 8
+
+class AssertionFailure(Trap, AssertionError):
+  """A failed @assert meta instruction."""
+  cause = "assertion_failure"
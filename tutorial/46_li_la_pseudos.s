@@ -10,7 +10,7 @@ li a1, 0x12345678
 @assert eq(a1, 0x12345678)
 
 # 2. LA (Load Address): la rd, label
-# This is a pseudo for AUIPC + ADDI.
+# This is a pseudo for ADDI from x0 (if the address is small) or AUIPC + ADDI.
 la a2, .my_label
 .my_label:
 @print a2
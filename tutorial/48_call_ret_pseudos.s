@@ -2,8 +2,8 @@
 # The standard function abstractions.
 
 # 1. CALL label
-# Pseudo for: auipc ra, offset_hi; jalr ra, ra, offset_lo
-# (Simplified: it calls a function and saves RA)
+# Pseudo for: jal ra, label when the target is within +/-512 KiB,
+# otherwise auipc ra, offset_hi; jalr ra, ra, offset_lo
 
 call .test_func
 @assert eq(a0, 1)
@@ -19,7 +19,7 @@ addi a0, a0, 1
 @print sub(a0, 0xABC)
 
 # NEW: Memory inspection with calculated addresses
-li sp, 0x1000
+li sp, 0xF000
 li t0, 0xDEADBEEF
 sw t0, 4(sp)
 
@@ -0,0 +1,5 @@
+"""
+This module records the version of the RISC-V emulator.
+"""
+
+__version__ = "1.1.0"